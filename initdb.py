@@ -9,24 +9,22 @@ import django
 django.setup()
 
 from marketplace.models import *
+from marketplace.search import get_search_backend
 
 
 def setup_users():
-    user01 = MarketplaceUser.objects.create_superuser(
+    MarketplaceUser.objects.create_superuser(
         username="test01",
         email="test01@mymarketplace.com",
         password="01test"
     )
 
-    user02 = MarketplaceUser.objects.create_user(
+    MarketplaceUser.objects.create_user(
         username="test02",
         email="test02@mymarketplace.com",
         password="02test"
     )
 
-    user01.save()
-    user02.save()
-
 
 def setup_products():
     products = [
@@ -62,13 +60,10 @@ def setup_products():
         },
     ]
 
-    for product in products:
-        new_product = Product.objects.create(
-            title=product["title"],
-            price=product["price"],
-            inventory_count=product["inventory_count"]
-        )
-        new_product.save()
+    # A single INSERT, the search index is then rebuilt since bulk_create
+    # does not fire the signals of Product
+    Product.objects.bulk_create([Product(**product) for product in products])
+    get_search_backend().rebuild()
 
 
 def run():
@@ -0,0 +1,147 @@
+"""Bulk provisioning of user accounts, e.g. when migrating the customers of
+another shop.
+
+Accounts are created in batches, each with two INSERT statements: one for the
+users and one for their carts, since bulk inserts skip the signal handler
+creating the cart of a new user. Password hashing is slow on purpose, so the
+passwords of a batch are hashed by a pool of processes, using every core of
+the machine. Users without a password get an unusable one, they can set it
+through a password reset.
+"""
+from itertools import islice
+import os
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import reset_queries, transaction
+
+from .auth import start_hashing_pool
+from .models import Cart, MarketplaceUser
+
+FIELDS = ("username", "email", "password", "first_name", "last_name")
+
+# Number of rejected rows reported with their error by a provisioning
+REPORTED_ERRORS = 20
+
+
+def _check_row(row):
+    """Builds the user of a row, without its password.
+
+    :raises ValidationError
+    """
+    user = MarketplaceUser(**{field: row[field] for field in FIELDS if field in row and field != "password"})
+    if not user.username:
+        raise ValidationError("Missing username.")
+    if not user.email:
+        raise ValidationError("Missing email.")
+
+    user.username = user.normalize_username(user.username)
+    user.email = MarketplaceUser.objects.normalize_email(user.email)
+    for field in ("username", "email", "first_name", "last_name"):
+        model_field = MarketplaceUser._meta.get_field(field)
+        model_field.run_validators(getattr(user, field))
+    validate_email(user.email)
+
+    return user
+
+
+def _provision_batch(rows, executor, seen):
+    """Creates the users of a batch of rows, along with their carts, in a
+    single transaction.
+
+    Returns the number of users created and the list of (username, error) of
+    the rows rejected
+    """
+    users = []
+    passwords = []
+    errors = []
+
+    for row in rows:
+        try:
+            user = _check_row(row)
+        except ValidationError as error:
+            errors.append((row.get("username"), " ".join(error.messages)))
+            continue
+        if user.username in seen or user.email.lower() in seen:
+            errors.append((user.username, "Username or email listed more than once."))
+            continue
+        seen.update((user.username, user.email.lower()))
+        users.append(user)
+        passwords.append(row.get("password"))
+
+    # Accounts which already exist are left untouched
+    existing = set(MarketplaceUser.objects.filter(username__in=[user.username for user in users]).values_list(
+        "username", flat=True
+    ))
+    existing.update(MarketplaceUser.objects.filter(email__in=[user.email for user in users]).values_list(
+        "email", flat=True
+    ))
+    new_users = []
+    new_passwords = []
+    for user, password in zip(users, passwords):
+        if user.username in existing or user.email in existing:
+            errors.append((user.username, "Username or email already exists."))
+        else:
+            new_users.append(user)
+            new_passwords.append(password)
+
+    if executor is None:
+        hashes = map(make_password, new_passwords)
+    else:
+        hashes = executor.map(make_password, new_passwords, chunksize=max(1, len(new_passwords) // 64))
+    for user, password_hash in zip(new_users, hashes):
+        user.password = password_hash
+
+    with transaction.atomic():
+        MarketplaceUser.objects.bulk_create(new_users)
+        Cart.objects.bulk_create([Cart(user_id=user.id) for user in new_users])
+
+    return len(new_users), errors
+
+
+def provision_users(rows, batch_size=1000, workers=None, progress=None):
+    """Creates user accounts and their carts in bulk, see the module docstring.
+
+    Rows are dicts of user fields: username and email are required, and
+    password, first_name and last_name are optional. Rows which are invalid,
+    or whose username or email is taken, are rejected, the other rows are
+    imported. progress is called after every batch with the statistics so
+    far.
+
+    :param rows: Iterable of rows, consumed one batch at a time
+    :param workers: Number of processes hashing passwords, all the cores by
+        default, or 0 to hash them in this process
+    :return: The statistics of the provisioning: number of rows read, users
+        created and rows rejected, the first rejected rows as (username,
+        error), the elapsed time and the number of rows read per second
+    """
+    stats = {"rows": 0, "created": 0, "rejected": 0, "errors": [], "seconds": 0.0, "rows_per_second": 0.0}
+    rows = iter(rows)
+    seen = set()
+    start = time.perf_counter()
+
+    workers = os.cpu_count() if workers is None else workers
+    executor = start_hashing_pool(workers)
+    try:
+        while batch := list(islice(rows, batch_size)):
+            created, errors = _provision_batch(batch, executor, seen)
+            # With DEBUG on, every statement would be kept in the query log
+            reset_queries()
+
+            stats["rows"] += len(batch)
+            stats["created"] += created
+            stats["rejected"] += len(errors)
+            stats["errors"].extend(errors[:max(0, REPORTED_ERRORS - len(stats["errors"]))])
+            stats["seconds"] = time.perf_counter() - start
+            stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+            if progress:
+                progress(stats)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
@@ -3,18 +3,52 @@ from django.contrib.auth.admin import UserAdmin
 
 from .forms import CustomUserCreationForm, CustomUserChangeForm
 from .models import *
+from .routers import use_replicas
 
 # Register your models here.
 
 
-class CustomUserAdmin(UserAdmin):
+class ReplicaReadsMixin:
+    """Reads the change lists from the read replicas. Bulk actions, which are
+    POST requests, read and write on the primary"""
+    def changelist_view(self, request, extra_context=None):
+        if request.method != "GET":
+            return super().changelist_view(request, extra_context)
+        with use_replicas():
+            response = super().changelist_view(request, extra_context)
+            # The results are only fetched when the template is rendered
+            if hasattr(response, "render"):
+                response.render()
+        return response
+
+
+class CustomUserAdmin(ReplicaReadsMixin, UserAdmin):
     add_form = CustomUserCreationForm
     form = CustomUserChangeForm
     model = MarketplaceUser
     list_display = ['email', 'username',]
 
 
+class CartAdmin(ReplicaReadsMixin, admin.ModelAdmin):
+    # Cart.__str__ shows the user
+    list_select_related = ["user"]
+
+
+class CartEntryAdmin(ReplicaReadsMixin, admin.ModelAdmin):
+    # CartEntry.__str__ shows the owner of the cart and the product
+    list_select_related = ["associated_cart__user", "product"]
+
+
+class ProductAdmin(ReplicaReadsMixin, admin.ModelAdmin):
+    pass
+
+
+class InventoryShardAdmin(ReplicaReadsMixin, admin.ModelAdmin):
+    pass
+
+
 admin.site.register(MarketplaceUser, CustomUserAdmin)
-admin.site.register(Product)
-admin.site.register(Cart)
-admin.site.register(CartEntry)
+admin.site.register(Product, ProductAdmin)
+admin.site.register(Cart, CartAdmin)
+admin.site.register(CartEntry, CartEntryAdmin)
+admin.site.register(InventoryShard, InventoryShardAdmin)
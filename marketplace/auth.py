@@ -0,0 +1,157 @@
+"""Authentication with password hashing offloaded to a pool of processes.
+
+Password hashers are slow on purpose, so during a storm of logins hashing
+takes every core of the web workers and starves the catalog requests. The
+PooledModelBackend checks passwords in a pool of MARKETPLACE_PASSWORD_WORKERS
+processes, which bounds the cores taken by hashing. The thread serving a
+login waits for the pool without holding the GIL, so the other requests of
+the process keep being served meanwhile.
+
+A password hashed by another hasher than the preferred one, the first of
+PASSWORD_HASHERS, or with outdated parameters, is hashed again when its user
+logs in. Both hashes are computed by the same task of the pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import os
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.utils.module_loading import import_string
+
+_pool = None
+# Number of processes and process ID of the pool, which is started again when
+# the setting changes or when the process serving the site was forked
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def _setup_hasher():
+    """Initializer of the hashing processes, which may not have set Django up
+    when started with the spawn method"""
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def start_hashing_pool(workers):
+    """Starts a pool of processes hashing passwords, used for the logins and
+    for the bulk provisioning of accounts.
+
+    :param workers: Number of processes of the pool
+    :return: The pool, or None if workers is 0
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_setup_hasher) if workers else None
+
+
+@functools.lru_cache(maxsize=None)
+def _load_hashers(paths):
+    """Returns the hashers of a list of dotted paths, loaded once per
+    process"""
+    return [import_string(path)() for path in paths]
+
+
+def _check_password(password, encoded, paths):
+    """Checks a password against its hash, with the hashers of paths.
+
+    Returns whether the password is correct, and its new hash if it must be
+    hashed again with the preferred hasher
+    """
+    hashers = _load_hashers(paths)
+    algorithm = encoded.split("$", 1)[0] if encoded else None
+    hasher = next((hasher for hasher in hashers if hasher.algorithm == algorithm), None)
+    # Unusable passwords match no hasher
+    if hasher is None or not hasher.verify(password, encoded):
+        return False, None
+
+    preferred = hashers[0]
+    if hasher.algorithm != preferred.algorithm or preferred.must_update(encoded):
+        return True, preferred.encode(password, preferred.salt())
+    return True, None
+
+
+def _hash_password(password, paths):
+    """Hashes a password with the preferred hasher of paths"""
+    preferred = _load_hashers(paths)[0]
+    return preferred.encode(password, preferred.salt())
+
+
+def get_pool():
+    """Returns the pool of processes hashing passwords, or None if passwords
+    are hashed in the calling thread"""
+    global _pool, _pool_key
+    workers = settings.MARKETPLACE_PASSWORD_WORKERS
+    with _pool_lock:
+        if _pool_key != (workers, os.getpid()):
+            if _pool is not None and _pool_key[1] == os.getpid():
+                _pool.shutdown(wait=False)
+            _pool = start_hashing_pool(workers)
+            _pool_key = (workers, os.getpid())
+        return _pool
+
+
+def shutdown_pool():
+    """Stops the processes of the pool, a new pool is started when a password
+    is hashed again"""
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None and _pool_key[1] == os.getpid():
+            _pool.shutdown()
+        _pool = _pool_key = None
+
+
+def _run(function, *args):
+    """Runs a hashing function in the pool, or in this thread if there is no
+    pool"""
+    pool = get_pool()
+    if pool is None:
+        return function(*args)
+    try:
+        return pool.submit(function, *args).result()
+    except BrokenProcessPool:
+        # A process of the pool died, e.g. killed for lack of memory. The
+        # next call starts a new pool
+        shutdown_pool()
+        return function(*args)
+
+
+def check_password(password, encoded):
+    """Checks a password against its hash in the pool, see _check_password"""
+    return _run(_check_password, password, encoded, tuple(settings.PASSWORD_HASHERS))
+
+
+def make_password(password):
+    """Hashes a password with the preferred hasher, in the pool"""
+    return _run(_hash_password, password, tuple(settings.PASSWORD_HASHERS))
+
+
+class PooledModelBackend(ModelBackend):
+    """Authentication backend of the site users, checking their password in
+    the pool of processes"""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash the password anyway, so that the response time does not
+            # tell whether the user exists
+            make_password(password)
+            return None
+
+        valid, new_hash = check_password(password, user.password)
+        if not valid:
+            return None
+        if new_hash is not None:
+            user.password = new_hash
+            user.save(update_fields=["password"])
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,527 @@
+"""Query count, latency and memory benchmarks of the marketplace endpoints.
+
+Every URL of marketplace/urls.py is driven through the Django test client
+against a catalog and a cart of a given size. For each scenario we record the
+number of SQL queries of a request, the p50/p99 wall time over several
+repetitions and the peak memory allocated while serving one request.
+
+Results are compared against the budgets of perf_budgets.json, so that an
+endpoint quietly going from 3 queries to 30 fails the benchmark tests. The
+budgets are the documented performance envelope of each endpoint, up to the
+largest default scale of 1M products and 500 cart entries:
+
+    max_queries: Maximum number of queries of one request, checked at every
+        scale. Loading the session and the user of a logged in client costs
+        two of them
+    p99_ms: Maximum 99th percentile of the wall time of a request
+    peak_kb: Maximum memory allocated while serving one request
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
+import asyncio
+import gc
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import URLResolver, get_resolver, reverse
+from django.utils import timezone
+
+from .auth import shutdown_pool
+from .cache import get_cache
+from .models import Cart, CartEntry, CheckoutJob, MarketplaceUser, Product
+from .search import get_search_backend
+
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_budgets.json")
+
+CATEGORIES = ["books", "electronics", "garden", "home", "music", "sports", "toys"]
+
+
+@contextmanager
+def throwaway_database():
+    """Runs the benchmarks in a test database, created for the occasion and
+    destroyed afterwards, so that the real data is never touched"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def empty_database():
+    """Removes the data of a previous benchmark, and the cached responses built
+    from it"""
+    call_command("flush", interactive=False, verbosity=0)
+    for cache in caches.all():
+        cache.clear()
+
+
+def seed_catalog(product_count, cart_size, seed=0, batch_size=5000):
+    """Fills the database with product_count products and a benchmark user,
+    a staff member, whose cart holds cart_size entries. Rows are inserted in bulk, and the
+    search index and cart totals are rebuilt once at the end.
+
+    Returns the benchmark user
+    """
+    rng = random.Random(seed)
+
+    for start in range(0, product_count, batch_size):
+        Product.objects.bulk_create([
+            Product(
+                title=f"Product {i:07d}",
+                price=Decimal(rng.randint(100, 100000)) / 100,
+                # Leave a few products out of stock for the availability filter
+                inventory_count=0 if i % 10 == 9 else 10 ** 6,
+                category=rng.choice(CATEGORIES),
+                description=f"Description of product {i}"
+            )
+            for i in range(start, min(start + batch_size, product_count))
+        ])
+    get_search_backend().rebuild()
+
+    user = MarketplaceUser.objects.create_user(
+        username="benchmark", email="benchmark@mymarketplace.com", is_staff=True
+    )
+    fill_cart(user.cart.id, cart_size)
+
+    return user
+
+
+def fill_cart(cart_id, cart_size):
+    """Makes a cart hold an entry for each of the first cart_size products in
+    stock, with their items held for the cart as done by the add to cart
+    endpoints"""
+    CartEntry.objects.filter(associated_cart_id=cart_id).delete()
+    product_ids = Product.objects.filter(inventory_count__gt=0).order_by("id").values_list("id", flat=True)
+    Cart.add_products(cart_id, {product_id: 1 for product_id in product_ids[:cart_size]}, hold=True)
+
+
+def get_scenarios(user):
+    """Returns the benchmark scenarios, one or more per endpoint. Each scenario
+    is a dict holding the HTTP method, the URL and the data of the request,
+    and optionally a setup function run (and not measured) before every
+    repetition."""
+    cart = Cart.objects.get(user=user)
+    product = Product.objects.filter(inventory_count__gt=0).order_by("-id").first()
+    search_word = product.title.split()[0].lower()
+    cart_size = CartEntry.objects.filter(associated_cart=cart).count()
+    bulk_products = list(
+        Product.objects.filter(inventory_count__gt=0).order_by("-id").values_list("id", flat=True)[:10]
+    )
+    # Rows of the inventory updates: a few deltas and counts naming products
+    # by ID and title, and a whole chunk of deltas
+    inventory_rows = [{"product_id": product_id, "delta": 1} for product_id in bulk_products[:5]] + [
+        {"title": title, "count": 10 ** 6}
+        for title in Product.objects.filter(id__in=bulk_products[5:]).values_list("title", flat=True)
+    ]
+    inventory_chunk = [
+        {"product_id": product_id, "delta": 1}
+        for product_id in Product.objects.order_by("id").values_list("id", flat=True)[
+            :settings.MARKETPLACE_INVENTORY_UPDATE_CHUNK_SIZE
+        ]
+    ]
+    checkout_job = {}
+
+    def cart_entry_id():
+        return CartEntry.objects.filter(associated_cart=cart).order_by("id").values_list("id", flat=True).first()
+
+    def remove_product_from_cart():
+        CartEntry.objects.filter(associated_cart=cart, product=product).delete()
+
+    def refill_cart():
+        fill_cart(cart.id, cart_size)
+
+    def remove_bulk_products_from_cart():
+        CartEntry.objects.filter(associated_cart=cart, product_id__in=bulk_products).delete()
+
+    def finish_checkout_job():
+        CheckoutJob.objects.filter(cart=cart).delete()
+        # A job done checking out the whole cart
+        entries = CartEntry.objects.filter(associated_cart=cart).values(
+            "product_id", "product__title", "product_count", "cost"
+        )
+        checkout_job["id"] = CheckoutJob.objects.create(
+            cart=cart, status=CheckoutJob.DONE, finished_at=timezone.now(),
+            checked_out=[{**entry, "cost": str(entry["cost"])} for entry in entries]
+        ).id
+
+    return {
+        "index": {"method": "get", "url": reverse("marketplace:index")},
+        "products_list": {"method": "get", "url": reverse("marketplace:api_view_products")},
+        "products_available": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_products"),
+            "data": {"availability": "true"},
+        },
+        "products_category": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_products"),
+            "data": {"category": product.category, "availability": "true"},
+        },
+        "products_search": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_products"),
+            "data": {"product": search_word, "availability": "true", "sort": "relevance"},
+        },
+        "products_export": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_products"),
+            "data": {"format": "ndjson"},
+        },
+        "product_detail": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_single_product", args=[product.id]),
+        },
+        "product_detail_uncached": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_single_product", args=[product.id]),
+            "setup": lambda: get_cache().clear(),
+        },
+        "add_to_cart_form": {"method": "get", "url": reverse("marketplace:api_add_to_cart", args=[product.id])},
+        "add_to_cart": {
+            "method": "post",
+            "url": reverse("marketplace:api_add_to_cart", args=[product.id]),
+            "data": {"product_count": 1},
+            "setup": remove_product_from_cart,
+        },
+        "bulk_add_to_cart": {
+            "method": "post",
+            "url": reverse("marketplace:api_bulk_add_to_cart"),
+            "data": json.dumps([{"product_id": product_id, "count": 1} for product_id in bulk_products]),
+            "content_type": "application/json",
+            "setup": remove_bulk_products_from_cart,
+        },
+        "checkout_product": {
+            "method": "post",
+            "url": reverse("marketplace:api_checkout_product", args=[product.id]),
+        },
+        "cart_view": {"method": "get", "url": reverse("marketplace:api_view_cart")},
+        "cart_view_uncached": {
+            "method": "get",
+            "url": reverse("marketplace:api_view_cart"),
+            "setup": lambda: get_cache().clear(),
+        },
+        "update_cart_entry_form": {
+            "method": "get",
+            "url": lambda: reverse("marketplace:api_update_cart_entry", args=[cart_entry_id()]),
+            "setup": refill_cart,
+        },
+        "update_cart_entry": {
+            "method": "post",
+            "url": lambda: reverse("marketplace:api_update_cart_entry", args=[cart_entry_id()]),
+            "data": {"product_count": 2},
+            "setup": refill_cart,
+        },
+        "checkout_cart_entry": {
+            "method": "post",
+            "url": lambda: reverse("marketplace:api_checkout_cart_entry", args=[cart_entry_id()]),
+            "setup": refill_cart,
+        },
+        "checkout_cart": {
+            "method": "post",
+            "url": reverse("marketplace:api_checkout_cart"),
+            "setup": refill_cart,
+        },
+        "checkout_cart_queued": {
+            "method": "post",
+            "url": reverse("marketplace:api_checkout_cart"),
+            "headers": {"Prefer": "respond-async"},
+            "setup": lambda: CheckoutJob.objects.filter(cart=cart).delete(),
+        },
+        "checkout_job": {
+            "method": "get",
+            "url": lambda: reverse("marketplace:api_checkout_job", args=[checkout_job["id"]]),
+            "setup": finish_checkout_job,
+        },
+        "update_inventory": {
+            "method": "post",
+            "url": reverse("marketplace:api_update_inventory"),
+            "data": json.dumps(inventory_rows),
+            "content_type": "application/json",
+        },
+        "update_inventory_chunk": {
+            "method": "post",
+            "url": reverse("marketplace:api_update_inventory"),
+            "data": json.dumps(inventory_chunk),
+            "content_type": "application/json",
+        },
+        "query_profile": {"method": "get", "url": reverse("marketplace:api_query_profile")},
+    }
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _send(client, scenario):
+    """Sends the request of a scenario and consumes the whole response"""
+    url = scenario["url"]() if callable(scenario["url"]) else scenario["url"]
+    kwargs = {}
+    if "content_type" in scenario:
+        kwargs["content_type"] = scenario["content_type"]
+    if "headers" in scenario:
+        kwargs["headers"] = scenario["headers"]
+
+    response = getattr(client, scenario["method"])(url, scenario.get("data"), **kwargs)
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def measure_scenario(client, scenario, repeat=20):
+    """Measures a scenario over several repetitions. The setup of the scenario
+    is run before every repetition and is not measured.
+
+    Returns a dict with the maximum number of queries of a request, the
+    p50/p99 wall time in milliseconds and the peak memory in KiB
+    """
+    timings = []
+    query_counts = []
+
+    for _ in range(repeat):
+        if "setup" in scenario:
+            scenario["setup"]()
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = _send(client, scenario)
+            timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{scenario['url']} returned {response.status_code}")
+        query_counts.append(len(queries))
+
+    # Tracing allocations slows requests down, so memory is measured on a
+    # separate request
+    if "setup" in scenario:
+        scenario["setup"]()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        _send(client, scenario)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "queries": max(query_counts),
+        "p50_ms": round(_percentile(timings, 50), 3),
+        "p99_ms": round(_percentile(timings, 99), 3),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(product_count, cart_size, repeat=20, only=None, seed=0):
+    """Seeds the database at the given scale, then measures every scenario.
+    The database must be empty, e.g. a test database.
+
+    Returns a dict mapping scenario names to their measurements
+    """
+    user = seed_catalog(product_count, cart_size, seed=seed)
+
+    client = Client()
+    client.force_login(user)
+
+    results = {}
+    for name, scenario in get_scenarios(user).items():
+        if only and name not in only:
+            continue
+        results[name] = measure_scenario(client, scenario, repeat=repeat)
+
+    return results
+
+
+def scale_name(product_count, cart_size):
+    """Name of a scale in baselines, e.g. "10000 products, 50 cart entries" """
+    return f"{product_count} products, {cart_size} cart entries"
+
+
+def load_budgets(path=BUDGETS_PATH):
+    with open(path) as budgets_file:
+        return json.load(budgets_file)
+
+
+def check_budgets(results, budgets, check_timing=True):
+    """Compares benchmark results against budgets. Query budgets are always
+    checked, wall time and memory budgets only if check_timing is True since
+    they depend on the machine.
+
+    Returns the list of budget violations, as readable messages
+    """
+    checked = ["max_queries"]
+    if check_timing:
+        checked += ["p99_ms", "peak_kb"]
+    measured = {"max_queries": "queries", "p99_ms": "p99_ms", "peak_kb": "peak_kb"}
+
+    violations = []
+    for name, measurements in results.items():
+        budget = budgets.get(name)
+        if budget is None:
+            violations.append(f"{name}: no budget configured")
+            continue
+        for key in checked:
+            if key in budget and measurements[measured[key]] > budget[key]:
+                violations.append(f"{name}: {measured[key]} {measurements[measured[key]]} exceeds budget {budget[key]}")
+
+    return violations
+
+
+@contextmanager
+def asgi_views():
+    """Routes the URLs of the site to the asynchronous variants of their views
+    while the block runs, as they are routed under ASGI. The views of this
+    process were picked for WSGI, see views.asgi_variant"""
+    swapped = []
+
+    def swap(patterns):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                swap(pattern.url_patterns)
+            elif hasattr(pattern.callback, "asgi_view"):
+                swapped.append((pattern, pattern.callback))
+                pattern.callback = pattern.callback.asgi_view
+
+    swap(get_resolver().url_patterns)
+    try:
+        yield
+    finally:
+        for pattern, callback in swapped:
+            pattern.callback = callback
+
+
+def compare_servers(user, paths, clients=100, requests_per_client=20, wsgi_threads=8):
+    """Compares the throughput of the WSGI and ASGI handlers of the site under
+    the same load: a number of concurrent clients, each sending its requests
+    one after the other, in turn to every path.
+
+    Under WSGI, requests are served by a pool of wsgi_threads threads, like the
+    threads of a WSGI server worker. Under ASGI, they are all served by the
+    event loop of the current thread, through the asynchronous views. Both run in this process, so limiting the
+    CPU affinity of the process gives both the same number of cores.
+
+    Returns a dict with the throughput and the p50/p99 latency of both
+    """
+    local = threading.local()
+    # Every client shares the same session, opened once
+    login_client = Client()
+    login_client.force_login(user)
+
+    def wsgi_request(path):
+        # Test clients are not thread-safe, every server thread gets its own
+        if not hasattr(local, "client"):
+            local.client = Client()
+            local.client.cookies = login_client.cookies
+        response = local.client.get(path)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+    async_client = AsyncClient()
+    async_client.cookies = login_client.cookies
+
+    async def asgi_request(path):
+        response = await async_client.get(path)
+        if response.streaming:
+            async for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+    async def run_clients(send):
+        latencies = []
+
+        async def run_client(index):
+            for request in range(requests_per_client):
+                start = time.perf_counter()
+                status = await send(paths[(index + request) % len(paths)])
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    raise RuntimeError(f"{paths[(index + request) % len(paths)]} returned {status}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*[run_client(index) for index in range(clients)])
+        elapsed = time.perf_counter() - start
+
+        return {
+            "requests": len(latencies),
+            "throughput": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        }
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=wsgi_threads) as pool:
+        async def send_wsgi(path):
+            return await asyncio.get_running_loop().run_in_executor(pool, wsgi_request, path)
+
+        results["wsgi"] = asyncio.run(run_clients(send_wsgi))
+    with asgi_views():
+        results["asgi"] = asyncio.run(run_clients(asgi_request))
+
+    return results
+
+
+def measure_logins(hasher, workers, logins=50, clients=8):
+    """Measures the throughput of logins checked by the authentication
+    backends of the site, with hasher, a name of PASSWORD_HASHER_PROFILES, as
+    the preferred hasher and a pool of workers processes checking passwords
+    (0 to check them in the threads logging in). clients threads log in at
+    the same time, each one after the other.
+
+    Returns a dict with the number of cores hashing passwords, the number of
+    logins per second, per second and per core, and the p50/p99 latency
+
+    :raises ValueError: if the hasher is not installed
+    """
+    path = settings.PASSWORD_HASHER_PROFILES[hasher]
+    hashers = [path] + [other for other in settings.PASSWORD_HASHERS if other != path]
+    available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    cores = min(workers or clients, available_cores)
+    username = f"benchmark-{hasher}"
+    password = "benchmark-password"
+
+    def log_in(_):
+        start = time.perf_counter()
+        if authenticate(username=username, password=password) is None:
+            raise RuntimeError(f"{username} could not log in")
+        return time.perf_counter() - start
+
+    with override_settings(PASSWORD_HASHERS=hashers, MARKETPLACE_PASSWORD_WORKERS=workers):
+        MarketplaceUser.objects.update_or_create(username=username, defaults={
+            "email": f"{username}@example.com",
+            "password": make_password(password),
+        })
+        try:
+            # The first login starts the processes of the pool
+            log_in(None)
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                start = time.perf_counter()
+                latencies = list(pool.map(log_in, range(logins)))
+                elapsed = time.perf_counter() - start
+        finally:
+            shutdown_pool()
+
+    return {
+        "cores": cores,
+        "logins_per_second": round(logins / elapsed, 2),
+        "logins_per_second_per_core": round(logins / elapsed / cores, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+    }
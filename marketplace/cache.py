@@ -0,0 +1,301 @@
+"""Read-through caching of API responses on top of Django's cache framework.
+
+Serialized product details and cart snapshots are cached under keys embedding two version
+numbers: one for the product itself and one for the whole catalog. Changing a
+product bumps its version, which makes every previously cached payload of the
+product unreachable without having to delete it, and bulk changes bump the
+catalog version instead. Cart snapshots are versioned the same way, per user
+and for all carts at once. Version keys which are missing from the cache (never
+set, or evicted) are initialized with a fresh time based value, so that a lost
+version can never point back to stale payloads.
+
+The cache used is the one named by the MARKETPLACE_CACHE_ALIAS setting, so any
+backend supported by Django can be plugged in.
+
+The in-memory search index of every process is versioned as well, see
+marketplace/search.py: for the changes made by a process to reach the others,
+the cache must be shared by the processes serving the site.
+
+Loaders filling the cache always read from the primary database. A row read
+from a lagging replica would otherwise be cached under the new version, and
+served long after the replica caught up.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .metrics import CACHE_LOOKUP_SECONDS, CACHE_LOOKUPS
+from .routers import primary_reads
+
+CATALOG_VERSION_KEY = "marketplace:catalog:version"
+CARTS_VERSION_KEY = "marketplace:carts:version"
+SEARCH_VERSION_KEY = "marketplace:search:version"
+
+_stats = {"hits": 0, "misses": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the cache used by the marketplace"""
+    return caches[settings.MARKETPLACE_CACHE_ALIAS]
+
+
+def _product_version_key(pk):
+    return f"marketplace:product:{pk}:version"
+
+
+def _cart_version_key(cart_id):
+    return f"marketplace:cart:{cart_id}:version"
+
+
+def _user_cart_key(user_id):
+    return f"marketplace:user:{user_id}:cart"
+
+
+def _get_versions(keys):
+    """Returns the current value of a list of version keys, initializing the
+    missing ones"""
+    cache = get_cache()
+    versions = cache.get_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+
+    return [versions[key] for key in keys]
+
+
+async def _aget_versions(keys):
+    """Asynchronous version of _get_versions"""
+    cache = get_cache()
+    versions = await cache.aget_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, time.time_ns(), timeout=None)
+            versions[key] = await cache.aget(key)
+
+    return [versions[key] for key in keys]
+
+
+def _bump_version(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+
+
+def invalidate_products(pks):
+    """Makes the cached payloads of some products stale once the current
+    transaction is committed. Bumping the versions before the commit would let
+    a concurrent request cache the old data again."""
+    pks = list(pks)
+    if pks:
+        transaction.on_commit(lambda: [_bump_version(_product_version_key(pk)) for pk in pks])
+
+
+def invalidate_catalog():
+    """Makes the cached payloads of every product stale once the current
+    transaction is committed"""
+    transaction.on_commit(lambda: _bump_version(CATALOG_VERSION_KEY))
+
+
+def invalidate_carts(cart_ids):
+    """Makes the cached snapshots of some carts stale once the current
+    transaction is committed"""
+    cart_ids = list(cart_ids)
+    if cart_ids:
+        transaction.on_commit(lambda: [_bump_version(_cart_version_key(cart_id)) for cart_id in cart_ids])
+
+
+def invalidate_all_carts():
+    """Makes the cached snapshots of every cart stale once the current
+    transaction is committed"""
+    transaction.on_commit(lambda: _bump_version(CARTS_VERSION_KEY))
+
+
+def forget_user_cart(user_id):
+    """Forgets which cart belongs to a user, e.g. after the cart was removed"""
+    transaction.on_commit(lambda: get_cache().delete(_user_cart_key(user_id)))
+
+
+def get_search_version():
+    """Returns the version of the search index, bumped by every process
+    changing the indexed products"""
+    return _get_versions([SEARCH_VERSION_KEY])[0]
+
+
+def bump_search_version():
+    """Bumps the version of the search index, and returns the new version or
+    None if the version was missing from the cache"""
+    try:
+        return get_cache().incr(SEARCH_VERSION_KEY)
+    except ValueError:
+        get_cache().add(SEARCH_VERSION_KEY, time.time_ns(), timeout=None)
+        return None
+
+
+def get_cart_snapshot(user_id, loader):
+    """Returns the snapshot of the cart of a user, i.e. its totals and entries,
+    from the cache if possible. On a cache miss, loader(user_id) is called to
+    build the snapshot and must return the ID of the cart along with the
+    snapshot, which is then cached.
+
+    Snapshots are versioned by cart rather than by user, so that cart changes
+    can be invalidated from the cart ID alone. Which cart belongs to a user is
+    cached as well, since it never changes.
+    """
+    cache = get_cache()
+
+    cart_id = cache.get(_user_cart_key(user_id))
+    if cart_id is None:
+        # The versions must be read before loading the snapshot, which cannot
+        # be done without knowing the cart. So only which cart belongs to the
+        # user is remembered this time.
+        with primary_reads():
+            cart_id, snapshot = loader(user_id)
+        cache.set(_user_cart_key(user_id), cart_id, timeout=None)
+        return snapshot
+
+    key = _cart_snapshot_key(cart_id, _get_versions([CARTS_VERSION_KEY, _cart_version_key(cart_id)]))
+
+    snapshot = cache.get(key)
+    if snapshot is None:
+        with primary_reads():
+            loaded_cart_id, snapshot = loader(user_id)
+        if loaded_cart_id == cart_id:
+            cache.set(key, snapshot, timeout=settings.MARKETPLACE_CART_CACHE_TIMEOUT)
+        else:
+            cache.set(_user_cart_key(user_id), loaded_cart_id, timeout=None)
+
+    return snapshot
+
+
+async def aget_cart_snapshot(user_id, loader):
+    """Asynchronous version of get_cart_snapshot, loader being a coroutine
+    function"""
+    cache = get_cache()
+
+    cart_id = await cache.aget(_user_cart_key(user_id))
+    if cart_id is None:
+        with primary_reads():
+            cart_id, snapshot = await loader(user_id)
+        await cache.aset(_user_cart_key(user_id), cart_id, timeout=None)
+        return snapshot
+
+    key = _cart_snapshot_key(cart_id, await _aget_versions([CARTS_VERSION_KEY, _cart_version_key(cart_id)]))
+
+    snapshot = await cache.aget(key)
+    if snapshot is None:
+        with primary_reads():
+            loaded_cart_id, snapshot = await loader(user_id)
+        if loaded_cart_id == cart_id:
+            await cache.aset(key, snapshot, timeout=settings.MARKETPLACE_CART_CACHE_TIMEOUT)
+        else:
+            await cache.aset(_user_cart_key(user_id), loaded_cart_id, timeout=None)
+
+    return snapshot
+
+
+def _cart_snapshot_key(cart_id, versions):
+    carts_version, cart_version = versions
+    return f"marketplace:cart:{cart_id}:{carts_version}.{cart_version}"
+
+
+def get_product_payload(pk, loader):
+    """Returns the serialized details of a product and their ETag, from the
+    cache if possible. On a cache miss, loader(pk) is called to build the
+    details, which are then cached. The third value returned tells whether the
+    payload came from the cache.
+
+    Any exception raised by loader, e.g. Http404, is propagated and nothing is
+    cached.
+    """
+    start = time.perf_counter()
+    cache = get_cache()
+
+    key = _product_payload_key(pk, _get_versions([CATALOG_VERSION_KEY, _product_version_key(pk)]))
+
+    cached = cache.get(key)
+    if cached is not None:
+        _record("hits", "hit_seconds", time.perf_counter() - start)
+        return cached["body"], cached["etag"], True
+
+    with primary_reads():
+        payload = _encode_payload(loader(pk))
+    cache.set(key, payload, timeout=settings.MARKETPLACE_PRODUCT_CACHE_TIMEOUT)
+
+    _record("misses", "miss_seconds", time.perf_counter() - start)
+    return payload["body"], payload["etag"], False
+
+
+async def aget_product_payload(pk, loader):
+    """Asynchronous version of get_product_payload, loader being a coroutine
+    function"""
+    start = time.perf_counter()
+    cache = get_cache()
+
+    key = _product_payload_key(pk, await _aget_versions([CATALOG_VERSION_KEY, _product_version_key(pk)]))
+
+    cached = await cache.aget(key)
+    if cached is not None:
+        _record("hits", "hit_seconds", time.perf_counter() - start)
+        return cached["body"], cached["etag"], True
+
+    with primary_reads():
+        payload = _encode_payload(await loader(pk))
+    await cache.aset(key, payload, timeout=settings.MARKETPLACE_PRODUCT_CACHE_TIMEOUT)
+
+    _record("misses", "miss_seconds", time.perf_counter() - start)
+    return payload["body"], payload["etag"], False
+
+
+def _product_payload_key(pk, versions):
+    catalog_version, product_version = versions
+    return f"marketplace:product:{pk}:{catalog_version}.{product_version}"
+
+
+def _encode_payload(details):
+    body = DjangoJSONEncoder().encode(details).encode()
+    return {"body": body, "etag": f'"{hashlib.md5(body).hexdigest()}"'}
+
+
+def etag_matches(request, etag):
+    """Checks whether the If-None-Match header of a request matches an ETag"""
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    # Weak comparison, as recommended for If-None-Match
+    return "*" in candidates or etag in [candidate.replace("W/", "", 1) for candidate in candidates]
+
+
+def _record(counter, timer, seconds):
+    with _stats_lock:
+        _stats[counter] += 1
+        _stats[timer] += seconds
+
+    result = "hit" if counter == "hits" else "miss"
+    CACHE_LOOKUPS.inc(result=result)
+    CACHE_LOOKUP_SECONDS.inc(seconds, result=result)
+
+
+def cache_stats():
+    """Returns the hit ratio and mean lookup latency of the product cache in
+    the current process"""
+    with _stats_lock:
+        stats = dict(_stats)
+
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+    stats["mean_hit_seconds"] = stats["hit_seconds"] / stats["hits"] if stats["hits"] else 0.0
+    stats["mean_miss_seconds"] = stats["miss_seconds"] / stats["misses"] if stats["misses"] else 0.0
+    return stats
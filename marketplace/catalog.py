@@ -0,0 +1,253 @@
+"""Bulk import of supplier catalogs.
+
+A catalog is a CSV file with a header row, or an NDJSON file holding one JSON
+object per line, whose columns or keys are fields of Product: title, price,
+inventory_count, category, description and seller (the seller's username).
+Only the title is required.
+
+The input is streamed and loaded in chunks, each of them in its own
+transaction, so the memory used stays the same whatever the size of the
+catalog. Every chunk is upserted by a single INSERT ... ON CONFLICT statement
+keyed on the unique product title: new products are inserted, and the fields
+given for existing products are overwritten. The sellers are looked up once
+per chunk for the usernames not seen yet. Product signals are not fired by
+the upserts, the search index is rebuilt and the cached product details are
+invalidated once at the end instead.
+
+As with Product.update_inventory, an imported inventory_count cannot leave
+fewer items in stock than are held for carts, and the stock of a sharded
+product, which lives in its inventory shards, cannot be overwritten: such rows
+are rejected.
+"""
+from contextlib import contextmanager, nullcontext
+from itertools import groupby, islice
+import csv
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection, reset_queries, transaction
+
+from .cache import invalidate_catalog
+from .models import MarketplaceUser, Product
+from .search import get_search_backend
+
+FIELDS = ("title", "price", "inventory_count", "category", "description", "seller")
+
+# Maximum number of seller usernames kept by the lookup cache of an import
+SELLER_CACHE_SIZE = 10000
+
+# Number of rejected rows reported with their error by an import
+REPORTED_ERRORS = 20
+
+
+class CatalogImportError(Exception):
+    """The catalog cannot be imported, e.g. because of an unknown column"""
+
+
+def read_rows(stream, format="csv", fields=FIELDS):
+    """Yields the rows of a catalog read from a text stream as dicts, along
+    with their line number. Empty values are left out of the rows.
+
+    :raises CatalogImportError: if a column is not one of the given fields
+        (the product fields by default), or a line is not a JSON object
+    """
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        unknown = set(reader.fieldnames or ()) - set(fields)
+        if unknown:
+            raise CatalogImportError(f"Unknown columns: {', '.join(sorted(unknown))}.")
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items() if value not in ("", None)}
+    elif format == "ndjson":
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                raise CatalogImportError(f"Line {line_num} is not valid JSON: {error}.")
+            if not isinstance(row, dict):
+                raise CatalogImportError(f"Line {line_num} is not a JSON object.")
+            unknown = set(row) - set(fields)
+            if unknown:
+                raise CatalogImportError(f"Unknown keys on line {line_num}: {', '.join(sorted(unknown))}.")
+            yield line_num, {key: value for key, value in row.items() if value not in ("", None)}
+    else:
+        raise CatalogImportError(f"Unknown catalog format {format!r}.")
+
+
+class SellerCache:
+    """Maps seller usernames to user IDs, looking up all the usernames of a
+    chunk not seen yet with a single query. Unknown usernames are cached as
+    None. The cache is emptied whenever it grows beyond max_size"""
+
+    def __init__(self, max_size=SELLER_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = {}
+
+    def resolve(self, usernames):
+        """Returns a dict mapping each of the given usernames to the ID of
+        the user, or None if there is no such user"""
+        missing = set(usernames) - self._ids.keys()
+        if missing:
+            if len(self._ids) + len(missing) > self.max_size:
+                self._ids.clear()
+            self._ids.update(dict.fromkeys(missing))
+            self._ids.update(MarketplaceUser.objects.filter(username__in=missing).values_list("username", "id"))
+        return {username: self._ids[username] for username in usernames}
+
+
+def _build_product(row, sellers):
+    """Builds the product of a catalog row, with its values converted and
+    validated as the fields of a product form would.
+
+    :raises ValidationError
+    """
+    product = Product()
+    for field in FIELDS:
+        if field not in row:
+            continue
+        if field == "seller":
+            product.seller_id = sellers[row["seller"]]
+            if product.seller_id is None:
+                raise ValidationError(f"Unknown seller {row['seller']!r}.")
+        else:
+            model_field = Product._meta.get_field(field)
+            value = model_field.to_python(row[field])
+            model_field.run_validators(value)
+            setattr(product, field, value)
+
+    if "title" not in row:
+        raise ValidationError("Missing title.")
+    if product.inventory_count < 0:
+        raise ValidationError("Negative inventory count.")
+
+    return product
+
+
+def _upsert_chunk(rows, sellers):
+    """Upserts the products of a chunk of rows in a single transaction.
+
+    Rows of a chunk may give different fields, and only the fields given are
+    overwritten on existing products, so the chunk is upserted with one
+    statement per set of fields. A title seen twice in a chunk is only
+    upserted from its last row. The existing products whose inventory count
+    is given are locked first, to reject the counts they cannot take.
+
+    Returns the number of rows upserted and the list of (line number, error)
+    of the rows rejected
+    """
+    seller_ids = sellers.resolve({row["seller"] for _, row in rows if "seller" in row})
+    products = {}
+    errors = []
+
+    for line_num, row in rows:
+        try:
+            product = _build_product(row, seller_ids)
+        except ValidationError as error:
+            errors.append((line_num, " ".join(error.messages)))
+        else:
+            products.pop(product.title, None)
+            products[product.title] = (line_num, frozenset(row), product)
+
+    with transaction.atomic():
+        counted = [title for title, (_, fields, _) in products.items() if "inventory_count" in fields]
+        stocks = Product.objects.select_for_update().filter(title__in=counted).values_list(
+            "title", "reserved_count", "shard_count"
+        )
+        for title, reserved_count, shard_count in stocks:
+            line_num, _, product = products[title]
+            if shard_count:
+                errors.append((line_num, "Sharded product, its stock lives in its inventory shards."))
+            elif product.inventory_count < reserved_count:
+                errors.append((line_num, f"Inventory count below the {reserved_count} items held for carts."))
+            else:
+                continue
+            del products[title]
+        errors.sort()
+
+        by_fields = sorted(products.values(), key=lambda item: sorted(item[1]))
+        for fields, group in groupby(by_fields, key=lambda item: item[1]):
+            update_fields = sorted(fields - {"title"})
+            group = [product for _, _, product in group]
+            if update_fields:
+                Product.objects.bulk_create(
+                    group,
+                    update_conflicts=True,
+                    unique_fields=["title"],
+                    update_fields=update_fields
+                )
+            else:
+                # Nothing to overwrite on existing products
+                Product.objects.bulk_create(group, ignore_conflicts=True)
+
+    return len(products), errors
+
+
+@contextmanager
+def deferred_indexes(model):
+    """Drops the secondary indexes declared in the Meta of a model while the
+    block runs, and creates them once it is over, which is faster than
+    updating them for every inserted row. Indexes missing beforehand, e.g.
+    after an interrupted import, are created as well. Unique constraints are
+    kept, the upserts rely on them.
+
+    Schema changes cannot run inside a transaction on SQLite.
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    with connection.schema_editor() as editor:
+        for index in model._meta.indexes:
+            if index.name in constraints:
+                editor.remove_index(model, index)
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            for index in model._meta.indexes:
+                editor.add_index(model, index)
+
+
+def import_catalog(stream, format="csv", chunk_size=5000, defer_indexes=False, progress=None):
+    """Imports a catalog from a text stream, see the module docstring.
+
+    Rows with invalid values are rejected, the other rows are imported.
+    progress is called after every chunk with the statistics so far.
+
+    Returns the statistics of the import: number of rows read, upserted and
+    rejected, the first rejected rows as (line number, error), the elapsed
+    time and the number of rows read per second
+
+    :raises CatalogImportError
+    """
+    stats = {"rows": 0, "upserted": 0, "rejected": 0, "errors": [], "seconds": 0.0, "rows_per_second": 0.0}
+    sellers = SellerCache()
+    rows = read_rows(stream, format)
+    start = time.perf_counter()
+
+    with deferred_indexes(Product) if defer_indexes else nullcontext():
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            upserted, errors = _upsert_chunk(chunk, sellers)
+            # With DEBUG on, every statement would be kept in the query log
+            reset_queries()
+
+            stats["rows"] += len(chunk)
+            stats["upserted"] += upserted
+            stats["rejected"] += len(errors)
+            stats["errors"].extend(errors[:max(0, REPORTED_ERRORS - len(stats["errors"]))])
+            stats["seconds"] = time.perf_counter() - start
+            stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+            if progress:
+                progress(stats)
+
+    if stats["upserted"]:
+        get_search_backend().rebuild()
+        invalidate_catalog()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
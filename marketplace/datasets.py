@@ -0,0 +1,246 @@
+"""Synthetic datasets at production scale, for benchmarks and load tests.
+
+The generator is deterministic: the same seed and sizes always produce the
+same users, products and cart entries.
+
+- Users are named <prefix>0000001, <prefix>0000002... and all share the same
+  password, hashed once. Each of them gets an empty cart, as done by
+  create_default_cart_for_new_user for registered users.
+- Products get a title made of words of their category, a category drawn
+  from a skewed distribution (a few large categories and a long tail), a
+  log-normal price around the typical price of their category, ending in .99
+  or .49 most of the time, and a stock of which a share is sold out.
+- Cart entries are spread over random carts, and their products are drawn
+  from a Zipf distribution of popularity, so a few best sellers appear in a
+  large share of the carts.
+
+Every row is written by bulk inserts, which skip the per-row signal handlers.
+The totals of every cart are then recomputed in one pass, the search index is
+rebuilt and the caches are invalidated.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from decimal import Decimal
+from itertools import accumulate
+import math
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.db import reset_queries, transaction
+
+from .cache import invalidate_catalog
+from .models import Cart, CartEntry, MarketplaceUser, Product
+from .search import get_search_backend
+
+# Categories with their relative size, typical price and words of titles
+CATEGORIES = {
+    "books": (30, 15, ["Guide", "Novel", "Handbook", "Atlas", "Cookbook", "Anthology", "Diary", "Primer"]),
+    "electronics": (18, 120, ["Headphones", "Charger", "Speaker", "Camera", "Monitor", "Keyboard", "Router"]),
+    "home": (14, 35, ["Lamp", "Mug", "Blanket", "Vase", "Shelf", "Pillow", "Kettle", "Clock"]),
+    "toys": (10, 20, ["Puzzle", "Robot", "Doll", "Kite", "Blocks", "Train", "Yo-yo"]),
+    "sports": (8, 45, ["Ball", "Racket", "Helmet", "Gloves", "Bottle", "Mat", "Skates"]),
+    "garden": (6, 25, ["Shovel", "Hose", "Planter", "Seeds", "Rake", "Bench"]),
+    "music": (5, 60, ["Album", "Guitar strings", "Drumsticks", "Ukulele", "Harmonica"]),
+    "beauty": (4, 18, ["Soap", "Lotion", "Perfume", "Brush", "Shampoo"]),
+    "grocery": (3, 6, ["Coffee", "Tea", "Chocolate", "Honey", "Olive oil", "Pasta"]),
+    "automotive": (2, 40, ["Wiper", "Floor mat", "Jump starter", "Polish"]),
+}
+
+ADJECTIVES = [
+    "Classic", "Compact", "Deluxe", "Eco", "Essential", "Handmade", "Heavy-duty", "Lightweight", "Modern",
+    "Portable", "Premium", "Rustic", "Smart", "Vintage", "Wireless",
+]
+
+# Exponent of the Zipf distribution of product popularity
+POPULARITY_EXPONENT = 1.1
+
+# Share of the products which are sold out
+SOLD_OUT_RATIO = 0.08
+
+
+class ZipfSampler:
+    """Draws indexes in range(n) with a Zipf distribution: the index of rank r
+    is drawn with a probability proportional to 1 / r ** exponent. Ranks are
+    scattered over the indexes, so that popularity does not follow insertion
+    order"""
+
+    def __init__(self, n, exponent, rng):
+        self.n = n
+        self.rng = rng
+        self.cum_weights = array("d", accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+        # Multiplying by a number coprime with n is a permutation of range(n)
+        self.stride = 7919
+        while math.gcd(self.stride, n) != 1:
+            self.stride += 1
+
+    def sample(self):
+        """Returns a random index"""
+        rank = bisect_left(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+        return min(rank, self.n - 1) * self.stride % self.n
+
+
+def _batches(count, batch_size):
+    """Yields the (start, stop) bounds of the batches of a range"""
+    for start in range(0, count, batch_size):
+        yield start, min(start + batch_size, count)
+
+
+def generate_users(count, rng, prefix="user", password="marketplace", batch_size=5000):
+    """Inserts count users along with their empty cart.
+
+    Returns the list of the cart IDs
+    """
+    # Hashing is slow on purpose, the users share a single hash
+    password_hash = make_password(password)
+    cart_ids = []
+
+    for start, stop in _batches(count, batch_size):
+        with transaction.atomic():
+            users = MarketplaceUser.objects.bulk_create([
+                MarketplaceUser(
+                    username=f"{prefix}{i + 1:07d}",
+                    email=f"{prefix}{i + 1:07d}@example.com",
+                    password=password_hash,
+                )
+                for i in range(start, stop)
+            ])
+            carts = Cart.objects.bulk_create([Cart(user_id=user.id) for user in users])
+        cart_ids.extend(cart.id for cart in carts)
+        reset_queries()
+
+    return cart_ids
+
+
+def generate_products(count, rng, batch_size=5000):
+    """Inserts count products.
+
+    Returns the arrays of the IDs of the products and of their prices in cents
+    """
+    names = list(CATEGORIES)
+    cum_sizes = list(accumulate(size for size, _, _ in CATEGORIES.values()))
+    product_ids = array("q")
+    prices = array("q")
+
+    for start, stop in _batches(count, batch_size):
+        products = []
+        for i in range(start, stop):
+            category = rng.choices(names, cum_weights=cum_sizes)[0]
+            _, typical_price, words = CATEGORIES[category]
+            # Prices are log-normal, most of them end in .99 or .49
+            dollars = max(int(rng.lognormvariate(math.log(typical_price), 0.6)), 1)
+            price = dollars * 100 - rng.choices([1, 51, 0], weights=[6, 3, 1])[0]
+            inventory_count = 0 if rng.random() < SOLD_OUT_RATIO else int(rng.paretovariate(1.2) * 10)
+
+            products.append(Product(
+                # The index suffix keeps titles unique
+                title=f"{rng.choice(ADJECTIVES)} {rng.choice(words)} {i + 1:07d}",
+                price=Decimal(price) / 100,
+                inventory_count=inventory_count,
+                category=category,
+                description=f"{category.capitalize()} item number {i + 1}",
+            ))
+
+        with transaction.atomic():
+            Product.objects.bulk_create(products)
+        product_ids.extend(product.id for product in products)
+        prices.extend(int(product.price * 100) for product in products)
+        reset_queries()
+
+    return product_ids, prices
+
+
+def generate_cart_entries(count, cart_ids, product_ids, prices, rng, batch_size=5000):
+    """Inserts count cart entries, spread over random carts, with products
+    drawn by popularity. A cart holds a product at most once.
+
+    Returns the number of entries inserted, fewer than count if the carts
+    cannot hold them all
+    """
+    if not cart_ids or not product_ids:
+        return 0
+
+    sampler = ZipfSampler(len(product_ids), POPULARITY_EXPONENT, rng)
+    entries_per_cart = Counter(rng.randrange(len(cart_ids)) for _ in range(count))
+    inserted = 0
+    entries = []
+
+    for cart_index in sorted(entries_per_cart):
+        chosen = set()
+        wanted = min(entries_per_cart[cart_index], len(product_ids))
+        for _ in range(10 * wanted):
+            if len(chosen) == wanted:
+                break
+            chosen.add(sampler.sample())
+        else:
+            # The cart holds most of a small catalog, the least popular
+            # products are unlikely to ever be drawn
+            missing = sorted(set(range(len(product_ids))) - chosen)
+            chosen.update(rng.sample(missing, wanted - len(chosen)))
+
+        for product_index in sorted(chosen):
+            product_count = rng.choices([1, 2, 3, 5], weights=[70, 18, 8, 4])[0]
+            entries.append(CartEntry(
+                associated_cart_id=cart_ids[cart_index],
+                product_id=product_ids[product_index],
+                product_count=product_count,
+                cost=Decimal(prices[product_index] * product_count) / 100,
+            ))
+
+        if len(entries) >= batch_size:
+            with transaction.atomic():
+                CartEntry.objects.bulk_create(entries)
+            inserted += len(entries)
+            entries = []
+            reset_queries()
+
+    if entries:
+        with transaction.atomic():
+            CartEntry.objects.bulk_create(entries)
+        inserted += len(entries)
+
+    return inserted
+
+
+def generate_dataset(users, products, cart_entries, seed=0, prefix="user", password="marketplace",
+                     batch_size=5000, progress=None):
+    """Generates a dataset, see the module docstring. progress is called
+    with a message after every step.
+
+    Returns the number of users, products and cart entries inserted, and the
+    time taken by each step
+    """
+    rng = random.Random(seed)
+    report = {"seconds": {}}
+    start = time.perf_counter()
+
+    def step(name, message):
+        now = time.perf_counter()
+        report["seconds"][name] = now - step.last
+        step.last = now
+        if progress:
+            progress(f"{message} in {report['seconds'][name]:.1f}s")
+    step.last = start
+
+    cart_ids = generate_users(users, rng, prefix, password, batch_size)
+    report["users"] = len(cart_ids)
+    step("users", f"Inserted {len(cart_ids)} users and their carts")
+
+    product_ids, prices = generate_products(products, rng, batch_size)
+    report["products"] = len(product_ids)
+    step("products", f"Inserted {len(product_ids)} products")
+
+    report["cart_entries"] = generate_cart_entries(cart_entries, cart_ids, product_ids, prices, rng, batch_size)
+    step("cart_entries", f"Inserted {report['cart_entries']} cart entries")
+
+    # The entry signal handlers did not run, the totals are computed at once
+    Cart.recompute_totals()
+    step("cart_totals", "Recomputed the cart totals")
+
+    get_search_backend().rebuild()
+    invalidate_catalog()
+    step("search_index", "Rebuilt the search index")
+
+    report["seconds"]["total"] = time.perf_counter() - start
+    return report
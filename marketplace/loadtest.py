@@ -0,0 +1,307 @@
+"""Concurrent load harness of the checkout paths.
+
+Several workers, either threads or processes, share a few products with a
+limited stock and randomly add products to their cart (holding the items),
+check out single products, single cart entries and whole carts, all at the
+same time. Each worker owns one cart, so it knows exactly how many items each
+of its checkouts sold, and the harness then checks that the stock left in the
+database accounts for every sold item: no product was oversold, no decrement
+was lost and the items held for the carts match the reserved counts.
+
+Along with the correctness checks, the harness reports the throughput of the
+workers, the latency of each operation, the time spent in locking statements
+(SELECT ... FOR UPDATE and writes, which is where transactions wait for each
+other's locks) and the rate of lock errors, i.e. deadlocks and "database is
+locked" errors.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import random
+import time
+import uuid
+import warnings
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connection, connections
+from django.db.models import Sum
+
+from .exceptions import ItemLeftInCartWarning, ProductNotAvailableException
+from .models import Cart, CartEntry, InventoryShard, MarketplaceUser, Product
+
+OPERATIONS = {
+    "checkout_product": 40,
+    "add_to_cart": 30,
+    "checkout_entry": 15,
+    "checkout_cart": 15,
+}
+
+_LOCKING_STATEMENTS = ("UPDATE", "DELETE", "INSERT")
+
+
+def setup_fixtures(product_count, stock, worker_count, shards=0):
+    """Creates the products shared by the workers, and one user (and thus one
+    cart) per worker. The stock of the products is split into inventory
+    shards if shards is not 0.
+
+    Returns a dict describing the fixtures, to be passed to the workers
+    """
+    run = uuid.uuid4().hex[:8]
+    products = Product.objects.bulk_create([
+        Product(title=f"Load test {run} product {i}", price=10, inventory_count=stock)
+        for i in range(product_count)
+    ])
+    if shards:
+        for product in products:
+            Product.enable_sharding(product.id, shards)
+    users = [
+        MarketplaceUser.objects.create_user(username=f"loadtest-{run}-{i}", email=f"loadtest-{run}-{i}@mymarketplace.com")
+        for i in range(worker_count)
+    ]
+
+    return {
+        "run": run,
+        "product_ids": [product.id for product in products],
+        "cart_ids": list(Cart.objects.filter(user__in=users).order_by("user_id").values_list("id", flat=True)),
+        "user_ids": [user.id for user in users],
+        "initial_stock": {product.id: stock for product in products},
+    }
+
+
+def cleanup_fixtures(fixtures):
+    """Removes the products and users created by setup_fixtures"""
+    MarketplaceUser.objects.filter(id__in=fixtures["user_ids"]).delete()
+    Product.objects.filter(id__in=fixtures["product_ids"]).delete()
+
+
+def _classify_error(error):
+    message = str(error).lower()
+    if "deadlock" in message:
+        return "deadlocks"
+    if "locked" in message or "could not obtain lock" in message or "could not serialize" in message:
+        return "locked"
+    return "errors"
+
+
+def _own_entries(cart_id):
+    return {
+        entry_id: (product_id, product_count)
+        for entry_id, product_id, product_count in CartEntry.objects.filter(
+            associated_cart_id=cart_id
+        ).values_list("id", "product_id", "product_count")
+    }
+
+
+def run_worker(cart_id, product_ids, operations, seed):
+    """Runs a number of random operations against the shared products, using
+    the cart with the given ID. Only this worker may use the cart.
+
+    Returns the statistics of the worker: the outcome counts and latencies of
+    every operation, the time spent in locking statements and the number of
+    items sold per product
+    """
+    rng = random.Random(seed)
+    names, weights = zip(*OPERATIONS.items())
+    stats = {
+        "outcomes": defaultdict(Counter),
+        "latencies": defaultdict(list),
+        "lock_wait_seconds": 0.0,
+        "sold": Counter(),
+        "error_messages": Counter(),
+    }
+
+    def time_locking_statements(execute, sql, params, many, context):
+        statement = sql.lstrip().upper()
+        if not (statement.startswith(_LOCKING_STATEMENTS) or "FOR UPDATE" in statement):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats["lock_wait_seconds"] += time.perf_counter() - start
+
+    try:
+        with connection.execute_wrapper(time_locking_statements):
+            for _ in range(operations):
+                name = rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    outcome = _run_operation(name, cart_id, product_ids, rng, stats["sold"])
+                except DatabaseError as error:
+                    outcome = _classify_error(error)
+                    stats["error_messages"][f"{type(error).__name__}: {error}"] += 1
+                stats["latencies"][name].append(time.perf_counter() - start)
+                stats["outcomes"][name][outcome] += 1
+    finally:
+        # Every worker thread opens its own connection
+        connection.close()
+
+    return stats
+
+
+def _run_operation(name, cart_id, product_ids, rng, sold):
+    """Runs one operation, records what it sold and returns its outcome"""
+    if name == "checkout_product":
+        product_id = rng.choice(product_ids)
+        try:
+            Product.checkout_product(product_id)
+        except ProductNotAvailableException:
+            return "sold_out"
+        sold[product_id] += 1
+        return "ok"
+
+    if name == "add_to_cart":
+        product_id = rng.choice(product_ids)
+        result = Cart.add_products(cart_id, {product_id: rng.randint(1, 3)}, hold=True)
+        return "ok" if result[product_id] is None else "rejected"
+
+    entries = _own_entries(cart_id)
+    if not entries:
+        return "empty_cart"
+
+    if name == "checkout_entry":
+        entry_id = rng.choice(list(entries))
+        try:
+            CartEntry.checkout_entry(entry_id)
+        except ProductNotAvailableException:
+            return "sold_out"
+        product_id, product_count = entries[entry_id]
+        sold[product_id] += product_count
+        return "ok"
+
+    fulfilled_entries = Cart.checkout_cart(cart_id)
+    for entry_id in fulfilled_entries:
+        product_id, product_count = entries[entry_id]
+        sold[product_id] += product_count
+    return "ok" if len(fulfilled_entries) == len(entries) else "partial"
+
+
+def _run_process_worker(args):
+    """Entry point of process workers, which may not have set Django up when
+    started with the spawn method"""
+    if not apps.ready:
+        import django
+        django.setup()
+    connections.close_all()
+
+    return run_worker(*args)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def verify_inventory(fixtures, sold):
+    """Checks that the stock left of every product accounts for the items
+    sold by the workers.
+
+    Returns a dict with the number of items oversold, the products whose stock
+    does not match the sales, the number of carts whose totals drifted from
+    their entries and the number of products whose reserved count drifted
+    from the items held by the carts
+    """
+    stock = dict(Product.objects.filter(id__in=fixtures["product_ids"]).values_list("id", "inventory_count"))
+    sharded = dict(
+        InventoryShard.objects.filter(product_id__in=fixtures["product_ids"]).values("product_id").annotate(
+            total=Sum("inventory_count")
+        ).values_list("product_id", "total")
+    )
+    stock.update(sharded)
+
+    oversold = 0
+    mismatched = []
+    for product_id, initial in fixtures["initial_stock"].items():
+        oversold += max(sold[product_id] - initial, 0)
+        if stock[product_id] < 0 or initial - stock[product_id] != sold[product_id]:
+            mismatched.append(product_id)
+
+    return {
+        "oversold": oversold,
+        "mismatched_products": mismatched,
+        "drifted_carts": Cart.count_drifted_totals(fixtures["cart_ids"]),
+        "drifted_reservations": Product.count_drifted_reservations(fixtures["product_ids"]),
+    }
+
+
+def run_load(workers=8, mode="thread", operations=200, product_count=5, stock=100, shards=0, seed=0, keep=False):
+    """Sets up the fixtures, runs the workers concurrently, verifies the
+    inventory and removes the fixtures unless keep is True.
+
+    Process workers need a database shared between processes, i.e. not an
+    in-memory SQLite database.
+
+    Returns the report of the run
+    """
+    fixtures = setup_fixtures(product_count, stock, workers, shards)
+    tasks = [
+        (cart_id, fixtures["product_ids"], operations, seed * 1000 + i)
+        for i, cart_id in enumerate(fixtures["cart_ids"])
+    ]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ItemLeftInCartWarning)
+        start = time.perf_counter()
+        if mode == "process":
+            # Children must not share the connection of the parent
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_run_process_worker, tasks))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda task: run_worker(*task), tasks))
+        elapsed = time.perf_counter() - start
+
+    try:
+        report = _build_report(results, elapsed, workers, mode)
+        report.update(verify_inventory(fixtures, report.pop("sold")))
+    finally:
+        if not keep:
+            cleanup_fixtures(fixtures)
+
+    return report
+
+
+def _build_report(results, elapsed, workers, mode):
+    outcomes = defaultdict(Counter)
+    latencies = defaultdict(list)
+    sold = Counter()
+    error_messages = Counter()
+    lock_wait = 0.0
+
+    for stats in results:
+        for name, counter in stats["outcomes"].items():
+            outcomes[name].update(counter)
+        for name, values in stats["latencies"].items():
+            latencies[name].extend(values)
+        sold.update(stats["sold"])
+        error_messages.update(stats["error_messages"])
+        lock_wait += stats["lock_wait_seconds"]
+
+    total = sum(sum(counter.values()) for counter in outcomes.values())
+    totals = sum(outcomes.values(), Counter())
+
+    return {
+        "database": f"{connection.vendor} ({getattr(settings, 'MARKETPLACE_DB_PROFILE', 'custom')} profile)",
+        "mode": mode,
+        "workers": workers,
+        "operations": total,
+        "elapsed_seconds": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "lock_wait_seconds": lock_wait,
+        "lock_wait_share": lock_wait / (elapsed * workers) if elapsed else 0.0,
+        "deadlock_rate": totals["deadlocks"] / total if total else 0.0,
+        "locked_rate": totals["locked"] / total if total else 0.0,
+        "error_rate": totals["errors"] / total if total else 0.0,
+        "per_operation": {
+            name: {
+                "outcomes": dict(outcomes[name]),
+                "p50_ms": _percentile(latencies[name], 50) * 1000,
+                "p99_ms": _percentile(latencies[name], 99) * 1000,
+            }
+            for name in outcomes
+        },
+        "error_messages": dict(error_messages.most_common(5)),
+        "sold": sold,
+    }
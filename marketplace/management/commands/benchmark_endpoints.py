@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.benchmarks import (
+    BUDGETS_PATH, check_budgets, empty_database, load_budgets, run_benchmarks, scale_name, throwaway_database
+)
+
+
+class Command(BaseCommand):
+    """Benchmarks every marketplace endpoint at several catalog and cart sizes,
+    in a throwaway test database, and checks the results against the
+    performance budgets of the endpoints"""
+    help = "Measures query counts, latency and memory of the API endpoints and enforces their budgets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--products", type=int, nargs="+", default=[100, 10000, 1000000],
+            help="Numbers of products in the catalog to benchmark with"
+        )
+        parser.add_argument(
+            "--cart-sizes", type=int, nargs="+", default=[1, 50, 500],
+            help="Numbers of entries in the cart to benchmark with"
+        )
+        parser.add_argument("--repeat", type=int, default=20, help="Number of requests measured per endpoint")
+        parser.add_argument("--only", nargs="+", help="Only run these scenarios")
+        parser.add_argument("--output", help="Write the results to this JSON file, to be used as a baseline")
+        parser.add_argument("--budgets", default=BUDGETS_PATH, help="JSON file holding the budgets")
+        parser.add_argument(
+            "--no-timing-budgets", action="store_true",
+            help="Only enforce query budgets, e.g. on shared CI machines"
+        )
+
+    def handle(self, *args, **options):
+        budgets = load_budgets(options["budgets"])
+        baseline = {}
+        violations = []
+
+        with throwaway_database():
+            for product_count in options["products"]:
+                for cart_size in options["cart_sizes"]:
+                    if cart_size > product_count:
+                        continue
+                    name = scale_name(product_count, cart_size)
+                    self.stdout.write(f"Benchmarking with {name}...")
+
+                    empty_database()
+                    results = run_benchmarks(product_count, cart_size, repeat=options["repeat"], only=options["only"])
+                    baseline[name] = results
+
+                    for scenario, measurements in results.items():
+                        self.stdout.write(
+                            f"  {scenario:<24} {measurements['queries']:>3} queries  "
+                            f"p50 {measurements['p50_ms']:>9.2f} ms  p99 {measurements['p99_ms']:>9.2f} ms  "
+                            f"peak {measurements['peak_kb']:>9.1f} KiB"
+                        )
+                    violations += [
+                        f"[{name}] {violation}"
+                        for violation in check_budgets(results, budgets, not options["no_timing_budgets"])
+                    ]
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(baseline, output, indent=2, sort_keys=True)
+            self.stdout.write(f"Wrote the results to {options['output']}")
+
+        if violations:
+            for violation in violations:
+                self.stderr.write(violation)
+            raise CommandError(f"{len(violations)} budget violations")
+        self.stdout.write(self.style.SUCCESS("Every endpoint is within its budget"))
+
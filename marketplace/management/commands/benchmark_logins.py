@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.benchmarks import measure_logins, throwaway_database
+
+
+def _list(value, type=str):
+    return [type(item) for item in value.split(",") if item]
+
+
+class Command(BaseCommand):
+    """Measures how many logins per second and per core the site checks with
+    every password hasher, in a throwaway test database"""
+    help = "Measures the login throughput of every password hasher and pool size"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hashers", type=_list, default=list(settings.PASSWORD_HASHER_PROFILES),
+            help=f"Comma-separated hashers to measure, among {', '.join(settings.PASSWORD_HASHER_PROFILES)}"
+        )
+        parser.add_argument(
+            "--workers", type=lambda value: _list(value, int), default=[0, settings.MARKETPLACE_PASSWORD_WORKERS],
+            help="Comma-separated sizes of the pool checking passwords, 0 to check them in the threads logging in"
+        )
+        parser.add_argument("--logins", type=int, default=50, help="Number of logins measured per configuration")
+        parser.add_argument("--clients", type=int, default=8, help="Number of threads logging in at the same time")
+
+    def handle(self, *args, **options):
+        unknown = set(options["hashers"]) - set(settings.PASSWORD_HASHER_PROFILES)
+        if unknown:
+            raise CommandError(
+                f"Unknown hashers {', '.join(sorted(unknown))}, use some of "
+                f"{', '.join(settings.PASSWORD_HASHER_PROFILES)}."
+            )
+        if options["logins"] < 1 or options["clients"] < 1 or any(workers < 0 for workers in options["workers"]):
+            raise CommandError("The number of logins and clients must be positive, and pool sizes not negative.")
+
+        self.stdout.write(f"{options['logins']} logins by {options['clients']} concurrent clients")
+        with throwaway_database():
+            for hasher in options["hashers"]:
+                for workers in dict.fromkeys(options["workers"]):
+                    pool = f"pool of {workers}" if workers else "no pool"
+                    try:
+                        result = measure_logins(hasher, workers, logins=options["logins"], clients=options["clients"])
+                    except ValueError as error:
+                        self.stdout.write(f"  {hasher:<8} {pool:<11}: skipped, {error}")
+                        break
+                    self.stdout.write(
+                        f"  {hasher:<8} {pool:<11}: {result['logins_per_second']:>8.2f} logins/s  "
+                        f"{result['logins_per_second_per_core']:>8.2f} logins/s per core ({result['cores']} cores)  "
+                        f"p50 {result['p50_ms']:>8.1f} ms  p99 {result['p99_ms']:>8.1f} ms"
+                    )
@@ -0,0 +1,57 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from marketplace.benchmarks import compare_servers, seed_catalog, throwaway_database
+from marketplace.models import Product
+
+
+class Command(BaseCommand):
+    """Compares the throughput of the site served through WSGI and through
+    ASGI on the same number of cores, in a throwaway test database"""
+    help = "Compares WSGI and ASGI throughput of the catalog and cart endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cores", type=int, help="Number of CPU cores to run on, all of them by default")
+        parser.add_argument("--clients", type=int, default=100, help="Number of concurrent clients")
+        parser.add_argument("--requests", type=int, default=20, help="Number of requests sent by each client")
+        parser.add_argument(
+            "--wsgi-threads", type=int, default=8,
+            help="Number of threads serving requests under WSGI"
+        )
+        parser.add_argument("--products", type=int, default=10000, help="Number of products in the catalog")
+        parser.add_argument("--cart-size", type=int, default=50, help="Number of entries in the cart")
+
+    def handle(self, *args, **options):
+        if options["cores"]:
+            if not hasattr(os, "sched_setaffinity"):
+                raise CommandError("Limiting the number of cores is not supported on this platform.")
+            os.sched_setaffinity(0, set(sorted(os.sched_getaffinity(0))[:options["cores"]]))
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+        with throwaway_database():
+            user = seed_catalog(options["products"], options["cart_size"])
+            product = Product.objects.order_by("id").first()
+            paths = [
+                reverse("marketplace:api_view_products"),
+                reverse("marketplace:api_view_single_product", args=[product.id]),
+                reverse("marketplace:api_view_cart"),
+            ]
+
+            self.stdout.write(
+                f"{options['clients']} clients sending {options['requests']} requests each, on {cores} cores"
+            )
+            results = compare_servers(
+                user,
+                paths,
+                clients=options["clients"],
+                requests_per_client=options["requests"],
+                wsgi_threads=options["wsgi_threads"],
+            )
+
+        for handler, measurements in results.items():
+            self.stdout.write(
+                f"  {handler.upper()}: {measurements['throughput']:>8.1f} requests/s  "
+                f"p50 {measurements['p50_ms']:>8.2f} ms  p99 {measurements['p99_ms']:>8.2f} ms"
+            )
@@ -0,0 +1,56 @@
+import difflib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.benchmarks import throwaway_database
+from marketplace.query_plans import BASELINE_PATH, audit_endpoints, render_audit
+
+
+class Command(BaseCommand):
+    """Prints the query plan of every statement run by the marketplace
+    endpoints, in a throwaway test database, and compares the plans with the
+    committed baseline"""
+    help = "Explains the queries of the API endpoints and checks their plans against the baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000, help="Number of products in the catalog")
+        parser.add_argument("--cart-size", type=int, default=50, help="Number of entries in the cart")
+        parser.add_argument("--only", nargs="+", help="Only explain these scenarios")
+        parser.add_argument(
+            "--output", nargs="?", const=BASELINE_PATH,
+            help="Write the plans to this file, the committed baseline by default"
+        )
+        parser.add_argument(
+            "--check", nargs="?", const=BASELINE_PATH,
+            help="Fail if the plans differ from this file, the committed baseline by default"
+        )
+
+    def handle(self, *args, **options):
+        if options["cart_size"] > options["products"]:
+            raise CommandError("The cart cannot hold more entries than there are products.")
+
+        with throwaway_database():
+            audit = audit_endpoints(options["products"], options["cart_size"], only=options["only"])
+        plans = render_audit(audit)
+        self.stdout.write(plans)
+
+        warnings = sum(len(statement["warnings"]) for statements in audit.values() for statement in statements)
+        self.stdout.write(f"{warnings} plan warnings")
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(plans)
+            self.stdout.write(f"Wrote the plans to {options['output']}")
+
+        if options["check"]:
+            with open(options["check"]) as baseline:
+                expected = baseline.read()
+            diff = list(difflib.unified_diff(
+                expected.splitlines(), plans.splitlines(), options["check"], "current plans", lineterm=""
+            ))
+            if diff:
+                self.stderr.write("\n".join(diff))
+                raise CommandError(
+                    "The query plans changed, review them and update the baseline with --output if intended"
+                )
+            self.stdout.write(self.style.SUCCESS("The query plans match the baseline"))
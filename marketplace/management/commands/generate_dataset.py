@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from marketplace.datasets import generate_dataset
+
+
+class Command(BaseCommand):
+    """Fills the configured database with a deterministic synthetic dataset
+    of users, products and cart entries, see marketplace/datasets.py"""
+    help = "Generates users, products and cart entries in bulk for benchmarks and load tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000, help="Number of users, each with a cart")
+        parser.add_argument("--products", type=int, default=10000, help="Number of products")
+        parser.add_argument("--cart-entries", type=int, default=5000, help="Number of cart entries")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+        parser.add_argument("--prefix", default="user", help="Prefix of the usernames")
+        parser.add_argument("--password", default="marketplace", help="Password of every user")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Number of rows inserted at a time")
+
+    def handle(self, *args, **options):
+        try:
+            report = generate_dataset(
+                users=options["users"],
+                products=options["products"],
+                cart_entries=options["cart_entries"],
+                seed=options["seed"],
+                prefix=options["prefix"],
+                password=options["password"],
+                batch_size=options["batch_size"],
+                progress=self.stdout.write,
+            )
+        except IntegrityError as e:
+            raise CommandError(
+                f"The dataset clashes with existing rows ({e}), use another --prefix or an empty database."
+            )
+
+        self.stdout.write(
+            f"Generated {report['users']} users, {report['products']} products and "
+            f"{report['cart_entries']} cart entries in {report['seconds']['total']:.1f}s"
+        )
@@ -0,0 +1,52 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.catalog import CatalogImportError, import_catalog
+
+
+class Command(BaseCommand):
+    """Streams a supplier catalog from a CSV or NDJSON file into the products
+    table, inserting the new products and updating the existing ones by title
+    in chunked transactions, see marketplace/catalog.py"""
+    help = "Imports or updates products in bulk from a CSV or NDJSON catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Catalog file, or - to read it from the standard input")
+        parser.add_argument(
+            "--format", choices=["csv", "ndjson"],
+            help="Format of the catalog, guessed from the file extension by default (CSV otherwise)"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=5000,
+            help="Number of rows upserted by each transaction"
+        )
+        parser.add_argument(
+            "--defer-indexes", action="store_true",
+            help="Drop the secondary product indexes during the import and create them at the end"
+        )
+        parser.add_argument("--quiet", action="store_true", help="Do not report the progress after every chunk")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv")
+        progress = None if options["quiet"] else self._write_progress
+
+        try:
+            if path == "-":
+                stats = import_catalog(sys.stdin, format, options["chunk_size"], options["defer_indexes"], progress)
+            else:
+                with open(path, newline="", encoding="utf-8") as stream:
+                    stats = import_catalog(stream, format, options["chunk_size"], options["defer_indexes"], progress)
+        except (OSError, CatalogImportError) as e:
+            raise CommandError(str(e))
+
+        for line_num, error in stats["errors"]:
+            self.stderr.write(f"Line {line_num} rejected: {error}")
+        self.stdout.write(
+            f"Imported {stats['upserted']} products from {stats['rows']} rows "
+            f"({stats['rejected']} rejected) in {stats['seconds']:.2f}s: {stats['rows_per_second']:.0f} rows/s"
+        )
+
+    def _write_progress(self, stats):
+        self.stdout.write(f"{stats['rows']} rows read, {stats['rows_per_second']:.0f} rows/s")
@@ -0,0 +1,81 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from marketplace.loadtest import run_load
+
+
+class Command(BaseCommand):
+    """Hammers the checkout and add-to-cart paths with concurrent workers
+    sharing a few products, then checks that no product was oversold. The
+    load test products and users are created in the configured database and
+    removed afterwards"""
+    help = "Runs concurrent checkouts and reports throughput, lock contention and inventory correctness"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8, help="Number of concurrent workers")
+        parser.add_argument(
+            "--mode", choices=["thread", "process"], default="thread",
+            help="Run the workers as threads of this process or as separate processes"
+        )
+        parser.add_argument("--operations", type=int, default=200, help="Number of operations per worker")
+        parser.add_argument("--products", type=int, default=5, help="Number of products shared by the workers")
+        parser.add_argument("--stock", type=int, default=100, help="Initial inventory count of each product")
+        parser.add_argument(
+            "--shards", type=int, default=0,
+            help="Split the stock of every product into this many inventory shards"
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random operations")
+        parser.add_argument("--keep", action="store_true", help="Keep the load test products and users")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options["mode"] == "process" and connection.vendor == "sqlite" and connection.is_in_memory_db():
+            raise CommandError("Process workers cannot share an in-memory database.")
+
+        report = run_load(
+            workers=options["workers"],
+            mode=options["mode"],
+            operations=options["operations"],
+            product_count=options["products"],
+            stock=options["stock"],
+            shards=options["shards"],
+            seed=options["seed"],
+            keep=options["keep"],
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._write_report(report)
+
+        if (report["oversold"] or report["mismatched_products"] or report["drifted_carts"]
+                or report["drifted_reservations"]):
+            raise CommandError("The inventory does not account for the items sold.")
+
+    def _write_report(self, report):
+        self.stdout.write(
+            f"{report['operations']} operations by {report['workers']} {report['mode']} workers "
+            f"in {report['elapsed_seconds']:.2f}s on {report['database']}: {report['throughput']:.1f} operations/s"
+        )
+        self.stdout.write(
+            f"Time in locking statements: {report['lock_wait_seconds']:.2f}s "
+            f"({report['lock_wait_share']:.1%} of the workers' time)"
+        )
+        self.stdout.write(
+            f"Deadlocks: {report['deadlock_rate']:.2%}, database locked: {report['locked_rate']:.2%}, "
+            f"other errors: {report['error_rate']:.2%}"
+        )
+        for name, operation in sorted(report["per_operation"].items()):
+            outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(operation["outcomes"].items()))
+            self.stdout.write(
+                f"  {name:<18} p50 {operation['p50_ms']:8.2f} ms  p99 {operation['p99_ms']:8.2f} ms  ({outcomes})"
+            )
+        for message, count in report["error_messages"].items():
+            self.stdout.write(f"  {count} x {message}")
+        self.stdout.write(
+            f"Oversold items: {report['oversold']}, mismatched products: {len(report['mismatched_products'])}, "
+            f"carts with drifted totals: {report['drifted_carts']}, "
+            f"products with drifted reservations: {report['drifted_reservations']}"
+        )
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from marketplace.worker import run_pool
+
+
+class Command(BaseCommand):
+    """Runs a pool of workers checking out the carts of the queued checkout
+    jobs, until interrupted or, with --drain, until every job is over"""
+    help = "Processes the queued cart checkouts with a pool of workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Number of workers")
+        parser.add_argument(
+            "--mode", choices=["thread", "process"], default="process",
+            help="Run the workers as separate processes or as threads of this process"
+        )
+        parser.add_argument(
+            "--poll-interval", type=float, default=0.5,
+            help="Number of seconds an idle worker waits before polling the queue again"
+        )
+        parser.add_argument(
+            "--lease", type=float, default=60,
+            help="Number of seconds after which a job still running is queued again"
+        )
+        parser.add_argument(
+            "--max-attempts", type=int, default=3,
+            help="Number of times a job is attempted before it is failed"
+        )
+        parser.add_argument("--drain", action="store_true", help="Stop once no job is queued or running")
+
+    def handle(self, *args, **options):
+        if options["mode"] == "process" and connection.vendor == "sqlite" and connection.is_in_memory_db():
+            raise CommandError("Process workers cannot share an in-memory database.")
+
+        start = time.perf_counter()
+        try:
+            processed = run_pool(
+                workers=options["workers"],
+                mode=options["mode"],
+                poll_interval=options["poll_interval"],
+                lease_seconds=options["lease"],
+                max_attempts=options["max_attempts"],
+                drain=options["drain"],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted")
+            return
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"Attempted {processed} checkout jobs with {options['workers']} workers in {elapsed:.2f}s"
+        )
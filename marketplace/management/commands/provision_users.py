@@ -0,0 +1,58 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.accounts import FIELDS, provision_users
+from marketplace.catalog import CatalogImportError, read_rows
+
+
+class Command(BaseCommand):
+    """Creates user accounts and their carts in bulk from a CSV or NDJSON
+    file, hashing the passwords with a pool of processes, see
+    marketplace/accounts.py"""
+    help = "Creates user accounts in bulk from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File of accounts, or - to read it from the standard input")
+        parser.add_argument(
+            "--format", choices=["csv", "ndjson"],
+            help="Format of the file, guessed from its extension by default (CSV otherwise)"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of accounts created by each transaction"
+        )
+        parser.add_argument(
+            "--workers", type=int,
+            help="Number of processes hashing passwords, all the cores by default, 0 to hash them in this process"
+        )
+        parser.add_argument("--quiet", action="store_true", help="Do not report the progress after every batch")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv")
+        progress = None if options["quiet"] else self._write_progress
+
+        try:
+            if path == "-":
+                stats = self._provision(sys.stdin, format, options, progress)
+            else:
+                with open(path, newline="", encoding="utf-8") as stream:
+                    stats = self._provision(stream, format, options, progress)
+        except (OSError, CatalogImportError) as e:
+            raise CommandError(str(e))
+
+        for username, error in stats["errors"]:
+            self.stderr.write(f"User {username} rejected: {error}")
+        self.stdout.write(
+            f"Created {stats['created']} users from {stats['rows']} rows "
+            f"({stats['rejected']} rejected) in {stats['seconds']:.2f}s: {stats['rows_per_second']:.0f} rows/s"
+        )
+
+    @staticmethod
+    def _provision(stream, format, options, progress):
+        rows = (row for _, row in read_rows(stream, format, FIELDS))
+        return provision_users(rows, options["batch_size"], options["workers"], progress)
+
+    def _write_progress(self, stats):
+        self.stdout.write(f"{stats['rows']} rows read, {stats['rows_per_second']:.0f} rows/s")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Cart
+
+
+class Command(BaseCommand):
+    """Rebuilds the totals of carts from their entries, to repair any drift of
+    the totals maintained incrementally when entries change"""
+    help = "Recomputes the item count and total cost of carts from their entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--cart", type=int, action="append", dest="carts",
+            help="Only recompute the cart with this ID, can be repeated"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report the number of carts whose totals drifted"
+        )
+
+    def handle(self, *args, **options):
+        drifted = Cart.count_drifted_totals(options["carts"])
+        self.stdout.write(f"{drifted} carts have drifted totals")
+
+        if not options["dry_run"]:
+            recomputed = Cart.recompute_totals(options["carts"])
+            self.stdout.write(f"Recomputed the totals of {recomputed} carts")
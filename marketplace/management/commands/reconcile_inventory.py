@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Product
+
+
+class Command(BaseCommand):
+    """Folds the inventory shards of hot products back into
+    Product.inventory_count, either once or periodically in the background"""
+    help = "Reconciles the inventory count of sharded products with their inventory shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product", type=int, action="append", dest="products",
+            help="Only reconcile the product with this ID, can be repeated"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=0,
+            help="Keep reconciling every INTERVAL seconds instead of running once"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            reconciled = Product.reconcile_inventory(options["products"])
+            self.stdout.write(f"Reconciled {reconciled} sharded products")
+
+            if options["interval"] <= 0:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.models import CartEntry
+
+
+class Command(BaseCommand):
+    """Releases the items held by cart entries whose hold expired, so that
+    they can be added to other carts again, either once or periodically in
+    the background"""
+    help = "Releases the items held for carts whose hold expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of entries released by each transaction"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=0,
+            help="Keep releasing every INTERVAL seconds instead of running once"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            released = CartEntry.release_expired_holds(options["batch_size"])
+            self.stdout.write(f"Released the expired holds of {released} cart entries")
+
+            if options["interval"] <= 0:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.models import Product
+
+
+class Command(BaseCommand):
+    """Flags a product as hot by splitting its stock across inventory shards,
+    or folds the shards back into a single inventory count"""
+    help = "Splits the inventory of a product across several shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument("product", type=int, help="ID of the product")
+        parser.add_argument("--shards", type=int, default=8, help="Number of inventory shards")
+        parser.add_argument(
+            "--disable", action="store_true",
+            help="Fold the shards back into the product's inventory count"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options["disable"]:
+                Product.disable_sharding(options["product"])
+                self.stdout.write(f"Product {options['product']} is no longer sharded")
+            else:
+                Product.enable_sharding(options["product"], options["shards"])
+                self.stdout.write(f"Product {options['product']} is split across {options['shards']} shards")
+        except Product.DoesNotExist:
+            raise CommandError(f"Product {options['product']} does not exist")
+        except ValueError as e:
+            raise CommandError(str(e))
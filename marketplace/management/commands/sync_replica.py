@@ -0,0 +1,46 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    """Copies the SQLite primary database into its read replica files, either
+    once or periodically in the background. This stands in for the
+    replication of a database server when running the site locally, the delay
+    between two copies acting as the replication lag"""
+    help = "Copies the SQLite primary database into its read replicas"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=0,
+            help="Keep copying every INTERVAL seconds instead of running once"
+        )
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != "sqlite" or primary.is_in_memory_db():
+            raise CommandError("Only an SQLite file can be copied, database servers replicate themselves.")
+        if not settings.MARKETPLACE_READ_REPLICAS:
+            raise CommandError("No read replica is configured, see MARKETPLACE_DB_REPLICAS.")
+
+        while True:
+            # The backup API copies a consistent snapshot, even while the
+            # primary is being written to
+            source = sqlite3.connect(primary.settings_dict["NAME"])
+            try:
+                for alias in settings.MARKETPLACE_READ_REPLICAS:
+                    target = sqlite3.connect(connections[alias].settings_dict["NAME"])
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(f"Copied the primary database to {len(settings.MARKETPLACE_READ_REPLICAS)} replicas")
+
+            if options["interval"] <= 0:
+                break
+            time.sleep(options["interval"])
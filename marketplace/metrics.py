@@ -0,0 +1,347 @@
+"""Metrics of the marketplace, exposed in the Prometheus text format.
+
+Counters and histograms are aggregated in the memory of each process, each
+metric guarded by its own lock held for a couple of dict operations only. When
+the site runs in several worker processes, e.g. under gunicorn or uWSGI,
+point the MARKETPLACE_METRICS_DIR setting to a directory shared by the workers
+and emptied on every deployment: every process then periodically writes its
+values to a file of its own, and the /metrics endpoint adds up the files of
+all processes, like the multiprocess mode of the Prometheus client does.
+
+The checkout paths and the cart signal handlers are wrapped by instrumented(),
+which records their latency by outcome, the time they spent in locking
+statements and the number of rows they wrote. The latency of every view is
+recorded by MetricsMiddleware.
+"""
+from bisect import bisect_left
+import contextvars
+import functools
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+
+from .exceptions import ProductNotAvailableException
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_WRITE_STATEMENTS = ("UPDATE", "DELETE", "INSERT")
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+
+_observation = contextvars.ContextVar("marketplace_observation", default=None)
+
+
+class Metric:
+    """Base class of the metrics, holding one value per combination of label
+    values"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        with _registry_lock:
+            _registry[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {', '.join(self.labelnames)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.documentation, "labels": self.labelnames, "values": values}
+
+
+class Counter(Metric):
+    """Monotonically increasing value, e.g. a number of rows written"""
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _maybe_flush()
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies, in buckets. Each value
+    is stored as its per-bucket counts (the last bucket being +Inf) followed by
+    the sum of the observations"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, amount, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, amount)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            value[index] += 1
+            value[-1] += amount
+        _maybe_flush()
+
+    def count(self, **labels):
+        with self._lock:
+            value = self._values.get(self._key(labels))
+            return sum(value[:-1]) if value else 0
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(key), list(value)] for key, value in self._values.items()]
+        return {
+            "type": self.type,
+            "help": self.documentation,
+            "labels": self.labelnames,
+            "buckets": self.buckets,
+            "values": values,
+        }
+
+
+OPERATION_SECONDS = Histogram(
+    "marketplace_operation_seconds",
+    "Latency of the checkout paths and cart signal handlers, by outcome",
+    ["operation", "outcome"]
+)
+LOCK_WAIT_SECONDS = Histogram(
+    "marketplace_operation_lock_wait_seconds",
+    "Time spent in locking statements (SELECT ... FOR UPDATE and writes) by operation",
+    ["operation"]
+)
+ROWS_WRITTEN = Counter(
+    "marketplace_operation_rows_written_total",
+    "Number of rows inserted, updated or deleted by operation",
+    ["operation"]
+)
+REQUEST_SECONDS = Histogram(
+    "marketplace_http_request_seconds",
+    "Latency of the HTTP requests by view, method and status code",
+    ["view", "method", "status"]
+)
+CACHE_LOOKUPS = Counter(
+    "marketplace_product_cache_lookups_total",
+    "Lookups of product details in the cache, by result",
+    ["result"]
+)
+CACHE_LOOKUP_SECONDS = Counter(
+    "marketplace_product_cache_lookup_seconds_total",
+    "Time spent looking up product details in the cache, by result",
+    ["result"]
+)
+
+
+class _Observation:
+    """Database execute wrapper measuring the locking statements and the rows
+    written by an instrumented operation"""
+
+    def __init__(self):
+        self.outcome = "success"
+        self.lock_wait = 0.0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        statement = sql.lstrip()[:6].upper()
+        is_write = statement in _WRITE_STATEMENTS
+        if not (is_write or "FOR UPDATE" in sql):
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.lock_wait += time.perf_counter() - start
+            if is_write:
+                self.rows += max(context["cursor"].rowcount, 0)
+
+
+def instrumented(operation):
+    """Decorator recording the latency, outcome, lock wait and rows written of
+    an operation. The outcome is "success", "not_available" if the operation
+    raised ProductNotAvailableException, "not_found" if it raised
+    DoesNotExist, "error" if it raised anything else, or whatever the
+    operation reported with set_outcome(). Nothing is recorded, and the
+    operation is called directly, if the MARKETPLACE_METRICS setting is
+    off"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(settings, "MARKETPLACE_METRICS", True):
+                return func(*args, **kwargs)
+
+            observation = _Observation()
+            token = _observation.set(observation)
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(observation):
+                    return func(*args, **kwargs)
+            except ProductNotAvailableException:
+                observation.outcome = "not_available"
+                raise
+            except ObjectDoesNotExist:
+                observation.outcome = "not_found"
+                raise
+            except Exception:
+                observation.outcome = "error"
+                raise
+            finally:
+                _observation.reset(token)
+                OPERATION_SECONDS.observe(time.perf_counter() - start, operation=operation, outcome=observation.outcome)
+                LOCK_WAIT_SECONDS.observe(observation.lock_wait, operation=operation)
+                if observation.rows:
+                    ROWS_WRITTEN.inc(observation.rows, operation=operation)
+        return wrapper
+    return decorator
+
+
+def set_outcome(outcome):
+    """Reports the outcome of the instrumented operation currently running,
+    e.g. "item_left" when a cart was only partially checked out"""
+    observation = _observation.get()
+    if observation is not None:
+        observation.outcome = outcome
+
+
+def _metrics_dir():
+    return getattr(settings, "MARKETPLACE_METRICS_DIR", None)
+
+
+def _maybe_flush():
+    """Writes the values of this process to the metrics directory, at most
+    once per MARKETPLACE_METRICS_FLUSH_INTERVAL seconds. A thread finding
+    another one flushing does not wait for it."""
+    global _last_flush
+
+    if not _metrics_dir():
+        return
+    now = time.monotonic()
+    if now - _last_flush < getattr(settings, "MARKETPLACE_METRICS_FLUSH_INTERVAL", 1.0):
+        return
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _last_flush = now
+        flush()
+    finally:
+        _flush_lock.release()
+
+
+def flush():
+    """Writes the values of this process to its file in the metrics
+    directory. The file is replaced atomically, so readers never see it half
+    written."""
+    directory = _metrics_dir()
+    if not directory:
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as snapshot_file:
+        json.dump(snapshot(), snapshot_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def snapshot():
+    """Returns the values of every metric of this process"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+def collect():
+    """Returns the values of every metric, added up over every process if a
+    metrics directory is configured"""
+    directory = _metrics_dir()
+    if not directory:
+        return snapshot()
+
+    flush()
+    merged = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path) as snapshot_file:
+                process_snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            # The file of a process was removed while being read
+            continue
+
+        for name, metric in process_snapshot.items():
+            merged_metric = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                if key not in merged_metric["values"]:
+                    merged_metric["values"][key] = value
+                elif metric["type"] == "histogram":
+                    merged_metric["values"][key] = [a + b for a, b in zip(merged_metric["values"][key], value)]
+                else:
+                    merged_metric["values"][key] += value
+
+    for metric in merged.values():
+        metric["values"] = [[list(key), value] for key, value in metric["values"].items()]
+    return merged
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None):
+    """Renders metrics in the Prometheus text exposition format"""
+    if metrics is None:
+        metrics = collect()
+
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        for key, value in sorted(metric["values"]):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip([*metric["buckets"], math.inf], value[:-1]):
+                    cumulative += count
+                    labels = _format_labels(metric["labels"], key, [("le", _format_number(bound))])
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = _format_labels(metric["labels"], key)
+                lines.append(f"{name}_sum{labels} {_format_number(value[-1])}")
+                lines.append(f"{name}_count{labels} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(metric['labels'], key)} {_format_number(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,253 @@
+"""Per-request SQL profiling.
+
+QueryProfilerMiddleware captures every query run while serving a request,
+through database execute wrappers, so it works with DEBUG turned off. Queries
+are grouped by fingerprint, i.e. their SQL with the literals and IN lists
+normalized away. A fingerprint repeated several times in a request is flagged
+as an N+1 candidate, along with the line of our code which ran it: this is
+what lazy loads of foreign keys in a loop look like.
+
+Totals are sent in the Server-Timing header of every response, and the last
+requests profiled are kept in memory for the staff report endpoint.
+
+The middleware is opt-in: it removes itself from the middleware chain unless
+the MARKETPLACE_QUERY_PROFILER setting is True.
+
+MetricsMiddleware records the latency of every request in the metrics exposed
+at /metrics, see marketplace/metrics.py.
+"""
+from collections import Counter, deque
+from contextlib import ExitStack
+import os
+import re
+import sys
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+import django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .metrics import REQUEST_SECONDS
+
+_DJANGO_DIR = os.path.dirname(os.path.abspath(django.__file__))
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*(?:%s|\?|NULL)\s*,?)+\)", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_history = deque(maxlen=200)
+_history_lock = threading.Lock()
+
+
+def fingerprint(sql):
+    """Normalizes a query so that queries only differing by their parameters
+    have the same fingerprint"""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    sql = _IN_LIST_RE.sub("IN (...)", sql)
+    return _WHITESPACE_RE.sub(" ", sql).strip()
+
+
+def _call_site():
+    """Returns the innermost frame of the project's own code, as "file:line
+    in function", skipping Django and third-party packages"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (
+            filename != __file__
+            and filename.startswith(settings.BASE_DIR)
+            and not filename.startswith(_DJANGO_DIR)
+            and "site-packages" not in filename
+        ):
+            return f"{os.path.relpath(filename, settings.BASE_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+class QueryProfile:
+    """Database execute wrapper recording the queries it runs"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                "alias": context["connection"].alias,
+                "fingerprint": fingerprint(sql),
+                "seconds": time.perf_counter() - start,
+                "call_site": _call_site(),
+            })
+
+    @property
+    def seconds(self):
+        return sum(query["seconds"] for query in self.queries)
+
+    def n_plus_one_candidates(self, threshold):
+        """Returns the fingerprints run at least threshold times, most
+        repeated first, along with the call sites which ran them"""
+        counts = Counter(query["fingerprint"] for query in self.queries)
+        candidates = []
+
+        for query_fingerprint, count in counts.most_common():
+            if count < threshold:
+                break
+            queries = [query for query in self.queries if query["fingerprint"] == query_fingerprint]
+            candidates.append({
+                "fingerprint": query_fingerprint,
+                "count": count,
+                "seconds": sum(query["seconds"] for query in queries),
+                "call_sites": sorted({query["call_site"] for query in queries if query["call_site"]}),
+            })
+
+        return candidates
+
+
+class QueryProfilerMiddleware:
+    """Middleware profiling the SQL queries of every request. It should be the
+    first middleware, so that the queries of the other middlewares (sessions,
+    authentication) are captured as well.
+
+    Queries run while a streaming response is consumed happen after the
+    middleware returned, and are not captured. Under ASGI, enabling the
+    profiler makes Django run every view in a thread, since the queries of a
+    request can only be captured from the thread which runs them.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "MARKETPLACE_QUERY_PROFILER", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = getattr(settings, "MARKETPLACE_QUERY_PROFILER_THRESHOLD", 3)
+        _resize_history(getattr(settings, "MARKETPLACE_QUERY_PROFILER_HISTORY", 200))
+
+    def __call__(self, request):
+        profile = QueryProfile()
+        start = time.perf_counter()
+
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(profile))
+            response = self.get_response(request)
+
+        total_seconds = time.perf_counter() - start
+        candidates = profile.n_plus_one_candidates(self.threshold)
+
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={profile.seconds * 1000:.2f};desc="{len(profile.queries)} queries"',
+            f'app;dur={total_seconds * 1000:.2f}',
+            f'nplusone;desc="{len(candidates)} candidates"',
+        ])
+
+        _record_request({
+            "time": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "queries": len(profile.queries),
+            "db_ms": round(profile.seconds * 1000, 3),
+            "total_ms": round(total_seconds * 1000, 3),
+            "n_plus_one": candidates,
+        })
+
+        return response
+
+
+class MetricsMiddleware:
+    """Middleware recording the latency of every request by view, method and
+    status code. It can be turned off with the MARKETPLACE_METRICS setting.
+
+    It supports both WSGI and ASGI, so that asynchronous views are not
+    switched to a thread because of it.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "MARKETPLACE_METRICS", True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def _record(request, response, seconds):
+        match = request.resolver_match
+        REQUEST_SECONDS.observe(
+            seconds,
+            view=match.view_name if match else "<unresolved>",
+            method=request.method,
+            status=response.status_code
+        )
+
+
+def _resize_history(size):
+    global _history
+
+    with _history_lock:
+        if _history.maxlen != size:
+            _history = deque(_history, maxlen=size)
+
+
+def _record_request(summary):
+    with _history_lock:
+        _history.append(summary)
+
+
+def profiler_report():
+    """Returns the requests profiled recently, most recent first, and the N+1
+    candidates found in them grouped by fingerprint, most frequent first"""
+    with _history_lock:
+        requests = list(_history)
+    requests.reverse()
+
+    candidates = {}
+    for summary in requests:
+        for candidate in summary["n_plus_one"]:
+            grouped = candidates.setdefault(candidate["fingerprint"], {
+                "fingerprint": candidate["fingerprint"],
+                "requests": 0,
+                "queries": 0,
+                "paths": set(),
+                "call_sites": set(),
+            })
+            grouped["requests"] += 1
+            grouped["queries"] += candidate["count"]
+            grouped["paths"].add(summary["path"])
+            grouped["call_sites"].update(candidate["call_sites"])
+
+    n_plus_one = sorted(candidates.values(), key=lambda grouped: -grouped["queries"])
+    for grouped in n_plus_one:
+        grouped["paths"] = sorted(grouped["paths"])
+        grouped["call_sites"] = sorted(grouped["call_sites"])
+
+    return {"requests": requests, "n_plus_one": n_plus_one}
+
+
+def clear_profiler_report():
+    with _history_lock:
+        _history.clear()
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0007_auto_20190115_1839'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='InventoryShard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('index', models.PositiveSmallIntegerField()),
+                ('inventory_count', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='marketplace.product')),
+            ],
+            options={
+                'unique_together': {('product', 'index')},
+            },
+        ),
+    ]
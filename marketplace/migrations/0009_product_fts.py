@@ -0,0 +1,41 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+FTS_TABLE = "marketplace_product_fts"
+
+
+def create_fts_index(apps, schema_editor):
+    """Creates the FTS5 index of products on SQLite, and fills it with the
+    existing products. Other databases use the in-process search index."""
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    try:
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            f"USING fts5(title, category, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    except OperationalError:
+        # SQLite was built without FTS5
+        return
+
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, category) "
+        f"SELECT id, title, COALESCE(category, '') FROM marketplace_product"
+    )
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0008_inventoryshard'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0009_product_fts'),
+    ]
+
+    operations = [
+        # The covering index is created before the index of the foreign key is
+        # dropped, so that cart lookups are never left without an index
+        migrations.AddIndex(
+            model_name='cartentry',
+            index=models.Index(fields=['associated_cart', 'id', 'product', 'product_count', 'cost'], name='cart_listing_idx'),
+        ),
+        migrations.AlterField(
+            model_name='cartentry',
+            name='associated_cart',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='marketplace.cart'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('inventory_count__gt', 0)), fields=['title'], name='product_in_stock_title_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0011_checkoutjob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='cartentry',
+            name='cart_listing_idx',
+        ),
+        migrations.AddField(
+            model_name='cartentry',
+            name='held_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cartentry',
+            name='hold_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reserved_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='cartentry',
+            index=models.Index(fields=['associated_cart', 'id', 'product', 'product_count', 'cost', 'held_count'], name='cart_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cartentry',
+            index=models.Index(condition=models.Q(('held_count__gt', 0)), fields=['hold_expires_at'], name='cart_entry_hold_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.contrib.auth import BACKEND_SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import migrations
+from django.utils import timezone
+
+MODEL_BACKEND = "django.contrib.auth.backends.ModelBackend"
+POOLED_MODEL_BACKEND = "marketplace.auth.PooledModelBackend"
+
+# Number of sessions rewritten per UPDATE
+BATCH_SIZE = 1000
+
+
+def _rename_backend(apps, old, new):
+    """Rewrites the authentication backend stored in the live sessions of the
+    database, which log their user out once the backend is no longer listed
+    in AUTHENTICATION_BACKENDS"""
+    Session = apps.get_model("sessions", "Session")
+    # Session data is signed with a salt naming the class of the store
+    codec = SessionStore()
+    renamed = []
+
+    for session in Session.objects.filter(expire_date__gt=timezone.now()).iterator(chunk_size=BATCH_SIZE):
+        data = codec.decode(session.session_data)
+        if data.get(BACKEND_SESSION_KEY) == old:
+            data[BACKEND_SESSION_KEY] = new
+            session.session_data = codec.encode(data)
+            renamed.append(session)
+        if len(renamed) >= BATCH_SIZE:
+            Session.objects.bulk_update(renamed, ["session_data"])
+            renamed = []
+    Session.objects.bulk_update(renamed, ["session_data"])
+
+
+def use_pooled_backend(apps, schema_editor):
+    _rename_backend(apps, MODEL_BACKEND, POOLED_MODEL_BACKEND)
+
+
+def use_model_backend(apps, schema_editor):
+    _rename_backend(apps, POOLED_MODEL_BACKEND, MODEL_BACKEND)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0012_cart_holds'),
+        ('sessions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(use_pooled_backend, use_model_backend),
+    ]
@@ -1,15 +1,32 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models, transaction
-from django.db.models.signals import pre_save, post_save, pre_delete
-from django.db.utils import IntegrityError
+from django.db import connection, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.shortcuts import reverse
+from datetime import timedelta
+import random
+import time
 import warnings
 
+from .cache import forget_user_cart, invalidate_all_carts, invalidate_carts, invalidate_catalog, invalidate_products
 from .exceptions import ProductNotAvailableException, ItemLeftInCartWarning
+from .metrics import instrumented, set_outcome
+from .search import INDEXED_FIELDS, get_search_backend
 
 # Create your models here.
 
+# Number of seconds a process trusts the shard count of a sharded product
+# before reading it again, see Product.checkout_product
+SHARD_COUNT_CACHE_SECONDS = 60
+
+# Shard counts of the sharded products checked out by this process, by
+# product ID, with the time they were read
+_shard_counts = {}
+
 
 class MarketplaceUser(AbstractUser):
     """This class represents a user model used in our marketplace. We are not
@@ -34,6 +51,13 @@ class Product(models.Model):
         category (str): Category of product
         description (str): Description of product
         seller (MarketplaceUser): The account selling the product
+        shard_count (int): Number of inventory shards of a hot product, 0 if
+            the product is not sharded. The stock of a sharded product lives in
+            its InventoryShard rows, and inventory_count is only a snapshot
+            refreshed by reconcile_inventory
+        reserved_count (int): Number of items in stock held for carts, see
+            CartEntry.held_count. Held items are not available to other
+            buyers, and are part of inventory_count until checked out
     """
     id = models.AutoField(primary_key=True)
     title = models.CharField(max_length=100, unique=True)
@@ -42,21 +66,267 @@ class Product(models.Model):
     category = models.CharField(max_length=100, default="miscellaneous", null=True, blank=True)
     description = models.TextField(default="", null=True, blank=True)
     seller = models.ForeignKey(MarketplaceUser, on_delete=models.CASCADE, default=None, null=True)
+    shard_count = models.PositiveSmallIntegerField(default=0)
+    reserved_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Listing of the products in stock (availability=true), sorted by
+            # title. Out of stock products are left out of the index, so pages
+            # are read without skipping over them.
+            models.Index(fields=["title"], condition=Q(inventory_count__gt=0), name="product_in_stock_title_idx"),
+        ]
+
+    @property
+    def available_count(self):
+        """Number of items in stock which are not held for a cart"""
+        return max(self.inventory_count - self.reserved_count, 0)
 
     @classmethod
-    @transaction.atomic
-    def checkout_product(cls, pk):
-        """Performs checkout on a single product. Only one item of product is
-        checked out to user.
+    @instrumented("checkout_product")
+    def checkout_product(cls, pk, quantity=1):
+        """Performs checkout on a single product. By default only one item of
+        product is checked out to user.
+
+        No row lock is taken: the inventory is decremented by a single
+        conditional UPDATE, and the number of affected rows tells whether
+        there were enough items in stock. Concurrent buyers therefore never
+        queue up behind each other on the product row. Sharded products are
+        checked out from their inventory shards instead, and the process
+        remembers their shard count for SHARD_COUNT_CACHE_SECONDS so that
+        their next checkouts go to the shards right away.
+
+        Items held for carts cannot be bought, see reserve.
 
         :raises ProductNotAvailableException
+        :raises Product.DoesNotExist
+        """
+        if quantity <= 0:
+            raise ValueError("Must checkout a positive amount of items.")
+
+        # Hot products go straight to their shards once they are known to be
+        # sharded, instead of first running an UPDATE that cannot match
+        shard_count, read_at = _shard_counts.get(pk, (0, 0))
+        if shard_count and time.monotonic() - read_at < SHARD_COUNT_CACHE_SECONDS:
+            try:
+                InventoryShard.checkout(pk, shard_count, quantity)
+                return
+            except ProductNotAvailableException:
+                # The shards may have been folded back meanwhile, the shard
+                # count is read again below
+                _shard_counts.pop(pk, None)
+
+        updated = cls.objects.filter(
+            pk=pk,
+            shard_count=0,
+            inventory_count__gte=F("reserved_count") + quantity
+        ).update(inventory_count=F("inventory_count") - quantity)
+
+        if not updated:
+            # Only pay for an extra query on the failure path
+            shard_count = cls.objects.filter(pk=pk).values_list("shard_count", flat=True).first()
+
+            if shard_count is None:
+                raise cls.DoesNotExist("Product matching query does not exist.")
+            if not shard_count:
+                raise ProductNotAvailableException("There are not enough items in inventory.")
+            _shard_counts[pk] = (shard_count, time.monotonic())
+            InventoryShard.checkout(pk, shard_count, quantity)
+        else:
+            invalidate_products([pk])
+
+    @classmethod
+    def reserve(cls, pk, quantity):
+        """Holds a number of items of a product for a cart, with a single
+        conditional UPDATE which fails if fewer items are available. Sharded
+        products are never held, their items are taken from the shards at
+        checkout.
+
+        Returns whether the items were held
         """
+        reserved = cls.objects.filter(
+            pk=pk,
+            shard_count=0,
+            inventory_count__gte=F("reserved_count") + quantity
+        ).update(reserved_count=F("reserved_count") + quantity)
+
+        if reserved:
+            invalidate_products([pk])
+        return bool(reserved)
+
+    @classmethod
+    def release(cls, pk, quantity):
+        """Gives back a number of held items of a product to the other
+        buyers"""
+        if quantity:
+            cls.objects.filter(pk=pk).update(reserved_count=F("reserved_count") - quantity)
+            invalidate_products([pk])
+
+    @classmethod
+    def count_drifted_reservations(cls, pks=None):
+        """Returns the number of products whose reserved count differs from
+        the items held by cart entries"""
+        products = cls.objects.all() if pks is None else cls.objects.filter(pk__in=pks)
+        held = CartEntry.objects.filter(product=OuterRef("pk")).values("product").annotate(
+            total=Sum("held_count")
+        ).values("total")
+
+        return products.annotate(held=Coalesce(Subquery(held), 0)).exclude(reserved_count=F("held")).count()
+
+    @classmethod
+    @transaction.atomic
+    def enable_sharding(cls, pk, shard_count):
+        """Splits the inventory of a product evenly across shard_count
+        inventory shards. Checkouts of the product will then be spread over
+        the shards instead of contending on the product row. Sharded products
+        are not held for carts, so the items held for carts are released.
+
+        This static method is decorated with transaction.atomic to prevent any
+        possible race condition
+        """
+        if shard_count <= 0:
+            raise ValueError("A sharded product needs at least one shard.")
+
         product = cls.objects.select_for_update().get(pk=pk)
+        if product.shard_count:
+            # Fold the current shards back before splitting them again
+            product.inventory_count = InventoryShard.objects.filter(product=product).aggregate(
+                total=Coalesce(Sum("inventory_count"), 0)
+            )["total"]
+            InventoryShard.objects.filter(product=product).delete()
+        CartEntry.objects.filter(product=product, held_count__gt=0).update(held_count=0, hold_expires_at=None)
 
-        if product.inventory_count <= 0:
-            raise ProductNotAvailableException("There are not enough items in inventory.")
-        product.inventory_count -= 1
-        product.save()
+        share, remainder = divmod(product.inventory_count, shard_count)
+        InventoryShard.objects.bulk_create([
+            InventoryShard(product=product, index=index, inventory_count=share + (index < remainder))
+            for index in range(shard_count)
+        ])
+
+        product.shard_count = shard_count
+        product.reserved_count = 0
+        product.save(update_fields=["inventory_count", "shard_count", "reserved_count"])
+        _shard_counts.pop(pk, None)
+
+    @classmethod
+    @transaction.atomic
+    def disable_sharding(cls, pk):
+        """Folds the inventory shards of a product back into its inventory
+        count and removes the shards.
+
+        This static method is decorated with transaction.atomic to prevent any
+        possible race condition
+        """
+        product = cls.objects.select_for_update().get(pk=pk)
+        shards = InventoryShard.objects.select_for_update().filter(product=product)
+
+        product.inventory_count = shards.aggregate(total=Coalesce(Sum("inventory_count"), 0))["total"]
+        product.shard_count = 0
+        shards.delete()
+        product.save(update_fields=["inventory_count", "shard_count"])
+        _shard_counts.pop(pk, None)
+
+    @classmethod
+    def reconcile_inventory(cls, pks=None):
+        """Folds the inventory shards of sharded products back into their
+        inventory count, so that reads of inventory_count stay close to the
+        real amount in stock. Only the listed products are reconciled if pks
+        is given.
+
+        Returns the number of products reconciled
+        """
+        shard_totals = InventoryShard.objects.filter(product=OuterRef("pk")).values("product").annotate(
+            total=Sum("inventory_count")
+        ).values("total")
+
+        products = cls.objects.filter(shard_count__gt=0)
+        if pks is not None:
+            products = products.filter(pk__in=pks)
+
+        invalidate_products(products.values_list("id", flat=True))
+        return products.update(inventory_count=Coalesce(Subquery(shard_totals), 0))
+
+    @classmethod
+    @transaction.atomic
+    def update_inventory(cls, updates):
+        """Applies a batch of inventory updates, e.g. from a warehouse sync.
+        Each update either adds a delta (possibly negative) to the stock of a
+        product, or sets its stock to an absolute count, optionally only if
+        the stock is still the count expected by the caller.
+
+        No row lock is taken beforehand: all the deltas are applied by a single
+        UPDATE, and all the absolute counts by another, which read the values
+        of every product from a VALUES list and return the updated rows. Deltas
+        are relative to the stock at the time of the UPDATE, so they never
+        clobber concurrent checkouts, and no update can leave fewer items in
+        stock than are held for carts. The products left out are read
+        afterwards to report why. Sharded products are left out, their stock
+        lives in their inventory shards. UPDATE ... FROM and RETURNING require
+        PostgreSQL or SQLite 3.35.
+
+        This static method is decorated with transaction.atomic to prevent any
+        possible race condition
+
+        :param updates: Dict mapping product IDs to (delta, count, expected)
+            tuples, with either delta or count set to None. Each product
+            takes 3 query parameters
+        :return: Dict mapping each product ID to a (inventory count, reason)
+            tuple, the reason being None if the product was updated
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        deltas = [(pk, delta) for pk, (delta, count, expected) in updates.items() if delta is not None]
+        counts = [(pk, count, expected) for pk, (delta, count, expected) in updates.items() if delta is None]
+        results = {}
+
+        with connection.cursor() as cursor:
+            if deltas:
+                cursor.execute(
+                    f"UPDATE {table} SET inventory_count = inventory_count + updates.column2 "
+                    f"FROM (VALUES {', '.join(['(%s, %s)'] * len(deltas))}) AS updates "
+                    f"WHERE id = updates.column1 AND shard_count = 0 "
+                    f"AND inventory_count + updates.column2 >= reserved_count "
+                    f"RETURNING id, inventory_count",
+                    [value for row in deltas for value in row]
+                )
+                results.update((pk, (inventory_count, None)) for pk, inventory_count in cursor.fetchall())
+            if counts:
+                # The expected counts are cast since PostgreSQL cannot tell
+                # the type of a column of NULL values
+                cursor.execute(
+                    f"UPDATE {table} SET inventory_count = updates.column2 "
+                    f"FROM (VALUES {', '.join(['(%s, %s, CAST(%s AS INTEGER))'] * len(counts))}) AS updates "
+                    f"WHERE id = updates.column1 AND shard_count = 0 AND updates.column2 >= reserved_count "
+                    f"AND (updates.column3 IS NULL OR inventory_count = updates.column3) "
+                    f"RETURNING id, inventory_count",
+                    [value for row in counts for value in row]
+                )
+                results.update((pk, (inventory_count, None)) for pk, inventory_count in cursor.fetchall())
+
+        if len(results) > 1:
+            # A cache round trip per product would cost more than the UPDATE,
+            # a batch bumps the version of the whole catalog instead
+            invalidate_catalog()
+        else:
+            invalidate_products(list(results))
+
+        # Only pay for an extra query on the failure path
+        left_out = cls.objects.filter(pk__in=[pk for pk in updates if pk not in results]).values_list(
+            "id", "inventory_count", "reserved_count", "shard_count"
+        )
+        for pk, inventory_count, reserved_count, shard_count in left_out:
+            delta, count, expected = updates[pk]
+            if shard_count:
+                reason = "The stock of a sharded product lives in its inventory shards."
+            elif delta is None and expected is not None and inventory_count != expected:
+                reason = "The inventory count changed meanwhile."
+            elif reserved_count:
+                reason = f"Cannot leave fewer items in stock than the {reserved_count} held for carts."
+            else:
+                reason = "There are not enough items in inventory."
+            results[pk] = (inventory_count, reason)
+        for pk in updates:
+            results.setdefault(pk, (None, "Product does not exist."))
+
+        return results
 
     def get_url_view_single_product(self):
         """Returns the URL to view this product details"""
@@ -71,6 +341,74 @@ class Product(models.Model):
         return f"Product: {self.title}, price: {self.price}. Amount in store: {self.inventory_count}"
 
 
+class InventoryShard(models.Model):
+    """This class represents one slice of the inventory of a hot product.
+    Splitting the stock of a product across several rows lets concurrent
+    checkouts decrement different rows instead of queueing on a single one.
+
+    Attributes:
+        id (int): Shard's unique identifier
+        product (Product): The product this shard holds items for
+        index (int): Position of the shard, from 0 to product.shard_count - 1
+        inventory_count (int): Indicate the amount of items in this shard
+    """
+    id = models.AutoField(primary_key=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField()
+    inventory_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('product', 'index'),)
+
+    @classmethod
+    def checkout(cls, product_id, shard_count, quantity):
+        """Checks out a number of items of a sharded product. A random shard is
+        tried first, falling back to the next shards when one runs dry. If no
+        single shard holds enough items, the items are taken from several
+        shards under lock.
+
+        :raises ProductNotAvailableException
+        """
+        start = random.randrange(shard_count)
+
+        for offset in range(shard_count):
+            updated = cls.objects.filter(
+                product_id=product_id,
+                index=(start + offset) % shard_count,
+                inventory_count__gte=quantity
+            ).update(inventory_count=F("inventory_count") - quantity)
+
+            if updated:
+                return
+
+        cls._checkout_across_shards(product_id, quantity)
+
+    @classmethod
+    @transaction.atomic
+    def _checkout_across_shards(cls, product_id, quantity):
+        """Takes the requested items from as many shards as needed.
+
+        :raises ProductNotAvailableException
+        """
+        shards = list(cls.objects.select_for_update().filter(product_id=product_id).order_by("index"))
+
+        if sum(shard.inventory_count for shard in shards) < quantity:
+            raise ProductNotAvailableException("There are not enough items in inventory.")
+
+        for shard in shards:
+            taken = min(shard.inventory_count, quantity)
+            if taken > 0:
+                shard.inventory_count -= taken
+                shard.save(update_fields=["inventory_count"])
+                quantity -= taken
+            if quantity == 0:
+                break
+
+    def __str__(self):
+        """Returns the string representation of this inventory shard"""
+        return f"Shard {self.index} of product {self.product_id}. Amount in shard: {self.inventory_count}"
+
+
 class Cart(models.Model):
     """This class represents a cart model used in our marketplace. Each single
     cart is associated with a registered user of our website.
@@ -87,29 +425,261 @@ class Cart(models.Model):
     total_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
 
     @classmethod
+    @instrumented("checkout_cart")
     @transaction.atomic
     def checkout_cart(cls, pk):
         """Performs checkout on all cart entries. Skips any entry with
         insufficient supply.
 
+        The whole cart is checked out with a fixed number of statements no
+        matter how many entries it holds: the cart row and its entries are
+        locked up front, the inventory of every product is decremented by a
+        single conditional UPDATE, the fulfilled entries are deleted at once
+        and the cart totals are recomputed a single time.
+
+        Entries whose items are held for the cart are sold without locking
+        their product, the held items being out of reach of other buyers. Only
+        the products of the other entries are locked and checked (in primary
+        key order so that concurrent checkouts cannot deadlock each other). The
+        UPDATE still skips a product whose stock fell below the items of the
+        entry, e.g. set by a catalog import, and the entry is left in the cart.
+
         This static method is decorated with transaction.atomic to prevent any
         possible race condition
 
+        :return: List of the IDs of the entries checked out
         :raises ItemLeftInCartWarning
         """
-        cart_entries = CartEntry.objects.select_for_update().filter(associated_cart__id=pk)
+        cls.objects.select_for_update().get(pk=pk)
+
+        # Locking the entries keeps their holds from being released meanwhile
+        cart_entries = list(
+            CartEntry.objects.select_for_update().filter(associated_cart__id=pk).values_list(
+                "id", "product_id", "product_count", "held_count"
+            )
+        )
+        product_ids = {product_id for _, product_id, product_count, held_count in cart_entries
+                       if held_count < product_count}
+        # Sharded products are left out of the lock, their stock lives in
+        # their inventory shards
+        products = {
+            product_id: inventory_count - reserved_count
+            for product_id, inventory_count, reserved_count in Product.objects.select_for_update().filter(
+                id__in=product_ids,
+                shard_count=0
+            ).order_by("id").values_list("id", "inventory_count", "reserved_count")
+        }
+        sharded_products = {}
+        if len(products) < len(product_ids):
+            sharded_products = dict(
+                Product.objects.filter(
+                    id__in=product_ids - products.keys()
+                ).values_list("id", "shard_count")
+            )
+
+        fulfilled_ids = set()
+        # Entry ID of every product decremented by the UPDATE below
+        requested_entries = {}
         item_left = False
 
-        # TODO: We may improve this by using map() function
-        for entry in cart_entries:
-            try:
-                CartEntry.checkout_entry(entry.id)
-            except ProductNotAvailableException:
+        for entry_id, product_id, product_count, held_count in cart_entries:
+            if held_count >= product_count:
+                requested_entries[product_id] = entry_id
+            elif product_id in sharded_products:
+                try:
+                    InventoryShard.checkout(product_id, sharded_products[product_id], product_count)
+                    fulfilled_ids.add(entry_id)
+                except ProductNotAvailableException:
+                    item_left = True
+            elif products.get(product_id, 0) < product_count - held_count:
+                item_left = True
+            else:
+                requested_entries[product_id] = entry_id
+
+        if requested_entries:
+            # Each product appears at most once per cart, so a single UPDATE
+            # can decrement all of them and release their held items, joining
+            # the entries of the cart. The inventory guard of the WHERE clause
+            # keeps it from overselling the products of held items, which are
+            # not locked: the products it skips are told by the rows returned,
+            # and their entries are left in the cart. UPDATE ... FROM and
+            # RETURNING require PostgreSQL or SQLite 3.35.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {connection.ops.quote_name(Product._meta.db_table)} "
+                    f"SET inventory_count = inventory_count - entries.product_count, "
+                    f"reserved_count = reserved_count - entries.held_count "
+                    f"FROM (SELECT product_id, product_count, held_count "
+                    f"FROM {connection.ops.quote_name(CartEntry._meta.db_table)} "
+                    f"WHERE associated_cart_id = %s) AS entries "
+                    f"WHERE id = entries.product_id AND id IN ({', '.join(['%s'] * len(requested_entries))}) "
+                    f"AND inventory_count >= entries.product_count "
+                    f"RETURNING id",
+                    [pk, *requested_entries]
+                )
+                sold_products = [product_id for product_id, in cursor.fetchall()]
+            fulfilled_ids.update(requested_entries[product_id] for product_id in sold_products)
+            if len(sold_products) < len(requested_entries):
                 item_left = True
+            invalidate_products(sold_products)
+
+        fulfilled_entries = [entry_id for entry_id, *_ in cart_entries if entry_id in fulfilled_ids]
+        if fulfilled_entries:
+            # Deleting through the queryset would fire remove_entry_from_cart
+            # once per entry, releasing the held items a second time, and the
+            # cart totals are recomputed below instead. Entries have no
+            # dependent rows, so a plain DELETE is enough.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {connection.ops.quote_name(CartEntry._meta.db_table)} "
+                    f"WHERE id IN ({', '.join(['%s'] * len(fulfilled_entries))})",
+                    fulfilled_entries
+                )
+
+            cls.recompute_totals([pk])
 
         if item_left:
+            set_outcome("item_left")
             warnings.warn("There are items not checked out", ItemLeftInCartWarning)
 
+        return fulfilled_entries
+
+    @classmethod
+    @transaction.atomic
+    def add_products(cls, pk, product_counts, hold=False):
+        """Adds several products to a cart at once. The products are looked up
+        with a single query, all new entries are inserted with a single
+        statement, and the cart totals are updated once.
+
+        If hold is True, the items added are held for the cart, see
+        CartEntry.held_count: the products are locked while they are looked
+        up, and the items are held by a single UPDATE.
+
+        This static method is decorated with transaction.atomic to prevent any
+        possible race condition
+
+        :param pk: Cart's ID
+        :param product_counts: Dict mapping product IDs to the number of items
+            to add to the cart
+        :param hold: Whether to hold the items added for the cart
+        :return: Dict mapping each product ID to None if it was added, or to
+            the reason why it was not
+        :raises IntegrityError: if an entry was concurrently added for one of
+            the products, in which case nothing is added
+        """
+        products = Product.objects.order_by("id")
+        if hold:
+            products = products.select_for_update()
+        products = products.in_bulk(list(product_counts))
+        existing_products = set(
+            CartEntry.objects.filter(
+                associated_cart_id=pk,
+                product_id__in=list(product_counts)
+            ).values_list("product_id", flat=True)
+        )
+
+        new_entries = []
+        results = {}
+        hold_expires_at = CartEntry.hold_expiry()
+
+        for product_id, product_count in product_counts.items():
+            product = products.get(product_id)
+
+            if product is None:
+                results[product_id] = "Product does not exist."
+            elif product_id in existing_products:
+                results[product_id] = "Cart entry already exists!"
+            elif product.available_count < product_count:
+                results[product_id] = "Cannot add more than the current number of available items."
+            else:
+                # bulk_create skips CartEntry.save, so the cost and the hold
+                # are set here. The items of sharded products are not held
+                held = hold and not product.shard_count
+                new_entries.append(CartEntry(
+                    associated_cart_id=pk,
+                    product=product,
+                    product_count=product_count,
+                    cost=product.price * product_count,
+                    held_count=product_count if held else 0,
+                    hold_expires_at=hold_expires_at if held else None
+                ))
+                results[product_id] = None
+
+        held_products = [entry.product_id for entry in new_entries if entry.held_count]
+
+        if new_entries:
+            # The entry signal handlers are not fired by bulk_create, the cart
+            # totals are updated once for all the new entries instead
+            CartEntry.objects.bulk_create(new_entries)
+            cls.objects.filter(pk=pk).update(
+                item_count=F("item_count") + sum(entry.product_count for entry in new_entries),
+                total_cost=F("total_cost") + sum(entry.cost for entry in new_entries)
+            )
+            invalidate_carts([pk])
+
+        if held_products:
+            # The products are locked above, the items are held by a single
+            # UPDATE reading the count of every new entry
+            Product.objects.filter(id__in=held_products).update(
+                reserved_count=F("reserved_count") + Subquery(
+                    CartEntry.objects.filter(associated_cart_id=pk, product_id=OuterRef("pk")).values("held_count")
+                )
+            )
+            invalidate_products(held_products)
+
+        return results
+
+    @classmethod
+    def recompute_totals(cls, pks=None):
+        """Rebuilds the item count and total cost of carts from the aggregates
+        of their entries, with a single UPDATE statement. This repairs any
+        drift of the totals maintained incrementally by the cart entry signal
+        handlers. Only the listed carts are recomputed if pks is given.
+
+        Returns the number of carts recomputed
+        """
+        carts = cls.objects.all() if pks is None else cls.objects.filter(pk__in=pks)
+        updated = carts.update(**cls._aggregated_totals())
+
+        if pks is None:
+            invalidate_all_carts()
+        else:
+            invalidate_carts(pks)
+        return updated
+
+    @classmethod
+    def count_drifted_totals(cls, pks=None):
+        """Returns the number of carts whose totals differ from the aggregates
+        of their entries"""
+        carts = cls.objects.all() if pks is None else cls.objects.filter(pk__in=pks)
+        aggregated_totals = cls._aggregated_totals()
+
+        return carts.annotate(
+            expected_item_count=aggregated_totals["item_count"],
+            expected_total_cost=aggregated_totals["total_cost"]
+        ).exclude(
+            item_count=F("expected_item_count"),
+            total_cost=F("expected_total_cost")
+        ).count()
+
+    @staticmethod
+    def _aggregated_totals():
+        """Returns the expressions computing the totals of a cart from its
+        entries"""
+        entries = CartEntry.objects.filter(associated_cart=OuterRef("pk")).values("associated_cart")
+        decimal_field = models.DecimalField(max_digits=10, decimal_places=2)
+
+        return {
+            "item_count": Coalesce(
+                Subquery(entries.annotate(total=Sum("product_count")).values("total")),
+                0
+            ),
+            "total_cost": Coalesce(
+                Subquery(entries.annotate(total=Sum("cost")).values("total"), output_field=decimal_field),
+                Value(0, output_field=decimal_field)
+            ),
+        }
+
     def __str__(self):
         """Returns the string representation of this cart"""
         return f"{self.user}'s cart. There are {self.item_count} items and total cost is {self.total_cost}"
@@ -127,22 +697,135 @@ class CartEntry(models.Model):
         product (Product): The product stored in this entry
         product_count (int): The number of product items
         cost (Decimal): Total cost of this cart entry
+        held_count (int): The number of product items held for the cart, and
+            counted in the product's reserved_count. Held items are sold at
+            checkout without checking the stock again
+        hold_expires_at (datetime): When the held items are released by
+            release_expired_holds, None if no item is held
     """
     id = models.AutoField(primary_key=True)
-    associated_cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+    # Indexed by cart_listing_idx below
+    associated_cart = models.ForeignKey(Cart, on_delete=models.CASCADE, db_index=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     product_count = models.PositiveIntegerField()
     cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    held_count = models.PositiveIntegerField(default=0)
+    hold_expires_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         # Do not allow duplicate items to be created within the same cart
         unique_together = (('associated_cart', 'product'),)
+        indexes = [
+            # Covers the entries of a cart in the order they were added, as
+            # listed by the cart view and checked out by checkout_cart, and the
+            # sums of recompute_totals, without reading the table. The columns
+            # are part of the key since included columns are PostgreSQL only.
+            models.Index(
+                fields=["associated_cart", "id", "product", "product_count", "cost", "held_count"],
+                name="cart_listing_idx"
+            ),
+            # Holds waiting to expire, in the order they are released
+            models.Index(fields=["hold_expires_at"], condition=Q(held_count__gt=0), name="cart_entry_hold_idx"),
+        ]
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, hold=False, **kwargs):
         """Override: Auto calculates the total cost before saving this entry
-        to database"""
+        to database. The entry and the cart totals updated by the pre_save
+        signal are saved in the same transaction.
+
+        If hold is True, the items of the entry are held for the cart until
+        MARKETPLACE_CART_HOLD_SECONDS from now. Otherwise the holds stored in
+        database are left as they are, so that a stale instance cannot bring
+        back a hold released meanwhile.
+
+        :raises ProductNotAvailableException: if the items cannot be held
+        """
         self.cost = self._calculate_cost()
-        return super().save(*args, **kwargs)
+        with transaction.atomic():
+            if hold:
+                self._hold_items()
+            elif not self._state.adding and kwargs.get("update_fields") is None:
+                kwargs["update_fields"] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in ("held_count", "hold_expires_at")
+                ]
+            return super().save(*args, **kwargs)
+
+    def _hold_items(self):
+        """Holds the items of this entry which are not held yet, or releases
+        the ones held beyond the product count. The hold stored in database is
+        read under lock, it may have expired and been released meanwhile.
+
+        :raises ProductNotAvailableException
+        """
+        if self.product.shard_count:
+            # The items of sharded products are taken from the shards at checkout
+            return
+
+        held_count = 0
+        if not self._state.adding:
+            held_count = CartEntry.objects.select_for_update().filter(pk=self.pk).values_list(
+                "held_count", flat=True
+            ).first() or 0
+
+        missing = self.product_count - held_count
+        if missing > 0 and not Product.reserve(self.product_id, missing):
+            raise ProductNotAvailableException("There are not enough items in inventory.")
+        if missing < 0:
+            Product.release(self.product_id, -missing)
+
+        self.held_count = self.product_count
+        self.hold_expires_at = self.hold_expiry()
+
+    @staticmethod
+    def hold_expiry():
+        """Returns when the items held from now on are released"""
+        return timezone.now() + timedelta(seconds=settings.MARKETPLACE_CART_HOLD_SECONDS)
+
+    @classmethod
+    def release_expired_holds(cls, batch_size=500):
+        """Releases the items held by entries whose hold expired, so that
+        other buyers can add them to their cart. The holds are released in
+        batches, each with a fixed number of statements. Entries locked by a
+        checkout in progress are skipped, where the database supports it.
+
+        Returns the number of entries whose hold was released
+        """
+        released = 0
+
+        while True:
+            with transaction.atomic():
+                expired = list(cls.objects.select_for_update(skip_locked=True).filter(
+                    held_count__gt=0,
+                    hold_expires_at__lte=timezone.now()
+                ).order_by("hold_expires_at").values_list("id", "product_id", "held_count")[:batch_size])
+                if not expired:
+                    break
+
+                held_counts = {}
+                for _, product_id, held_count in expired:
+                    held_counts[product_id] = held_counts.get(product_id, 0) + held_count
+
+                cls.objects.filter(id__in=[entry_id for entry_id, _, _ in expired]).update(
+                    held_count=0,
+                    hold_expires_at=None
+                )
+                Product.objects.filter(id__in=held_counts).update(
+                    reserved_count=Case(
+                        *[
+                            When(id=product_id, then=F("reserved_count") - held_count)
+                            for product_id, held_count in held_counts.items()
+                        ],
+                        default=F("reserved_count")
+                    )
+                )
+                invalidate_products(held_counts)
+
+            released += len(expired)
+            if len(expired) < batch_size:
+                break
+
+        return released
 
     def _calculate_cost(self):
         """Calculates the total cost of this cart entry"""
@@ -150,6 +833,7 @@ class CartEntry(models.Model):
         return cost
 
     @classmethod
+    @instrumented("checkout_entry")
     @transaction.atomic
     def checkout_entry(cls, pk):
         """Performs a checkout for this cart entry only. Update related product
@@ -162,14 +846,15 @@ class CartEntry(models.Model):
         """
         cart_entry = cls.objects.select_for_update().get(pk=pk)
 
-        if cart_entry.product.inventory_count < cart_entry.product_count:
-            raise ProductNotAvailableException("There are not enough items in inventory.")
-        cart_entry.product.inventory_count -= cart_entry.product_count
-
-        # It would make more sense for cart entry to be removed before the
-        # inventory information is updated.
+        # Deleting the entry first releases its held items, which are then
+        # bought back at once. Both are rolled back if the product is not
+        # available.
         cart_entry.delete()
-        cart_entry.product.save()
+
+        # The inventory is decremented by a conditional update (or from the
+        # product's shards), so the product row does not need to be locked
+        # and cannot be overwritten with a stale count.
+        Product.checkout_product(cart_entry.product_id, quantity=cart_entry.product_count)
 
     def get_url_update_cart_entry(self):
         """Returns the URL to update this cart entry"""
@@ -184,75 +869,289 @@ class CartEntry(models.Model):
         return f"Entry: {self.associated_cart.user}'s cart. Product: {self.product.title}, amount: {self.product_count}"
 
 
+class CheckoutJob(models.Model):
+    """This class represents a queued checkout of a whole cart. Jobs are
+    stored in the database, which acts as the queue drained by the workers of
+    the process_checkouts command, so that no message broker is needed.
+
+    Workers claim a job with a conditional UPDATE on its status, so a job is
+    handed to a single worker even when several of them poll at once. A
+    worker holds a job for a limited lease: a job still running when its lease
+    expires, e.g. because its worker died, is queued again. The job is marked
+    as done in the transaction of the checkout itself, and only by the worker
+    holding it, so a checkout is never applied twice.
+
+    Attributes:
+        id (int): Job's unique identifier
+        cart (Cart): The cart to check out
+        status (str): queued, running, done or failed
+        created_at (datetime): When the job was queued
+        claimed_at (datetime): When the job was last claimed by a worker
+        finished_at (datetime): When the job was done or failed
+        attempts (int): Number of times the job was claimed
+        worker (str): Name of the worker which last claimed the job
+        checked_out (list): Entries checked out, with their product title,
+            count and cost
+        items_left (list): Entries left in the cart for lack of stock
+        error (str): Error of the last attempt
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    id = models.AutoField(primary_key=True)
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=100, default="", blank=True)
+    checked_out = models.JSONField(default=list, blank=True)
+    items_left = models.JSONField(default=list, blank=True)
+    error = models.TextField(default="", blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers poll the oldest queued jobs, and the running jobs whose
+            # lease expired
+            models.Index(fields=["status", "id"], name="checkout_job_queue_idx"),
+        ]
+
+    @classmethod
+    def enqueue(cls, cart_id):
+        """Queues the checkout of a cart. A cart has at most one queued job: if
+        the cart already has one, e.g. because the request was sent twice,
+        that job is returned instead of queuing another one.
+
+        Returns the job
+        """
+        job = cls.objects.filter(cart_id=cart_id, status=cls.QUEUED).order_by("id").first()
+        if job is None:
+            job = cls.objects.create(cart_id=cart_id)
+        return job
+
+    @classmethod
+    def claim(cls, worker, window=10):
+        """Claims one of the oldest queued jobs for a worker. The worker picks
+        at random among the window oldest jobs, so that concurrent workers
+        rarely race for the same job.
+
+        Returns the claimed job, or None if no job is queued
+        """
+        candidates = list(cls.objects.filter(status=cls.QUEUED).order_by("id").values_list("id", flat=True)[:window])
+        random.shuffle(candidates)
+
+        for job_id in candidates:
+            claimed = cls.objects.filter(pk=job_id, status=cls.QUEUED).update(
+                status=cls.RUNNING,
+                worker=worker,
+                claimed_at=timezone.now(),
+                attempts=F("attempts") + 1
+            )
+            if claimed:
+                return cls.objects.get(pk=job_id)
+        return None
+
+    @classmethod
+    def requeue_expired(cls, lease_seconds, max_attempts):
+        """Queues again the running jobs whose lease expired, or fails them if
+        they were already attempted max_attempts times.
+
+        Returns the number of jobs queued again
+        """
+        expired = cls.objects.filter(
+            status=cls.RUNNING,
+            claimed_at__lt=timezone.now() - timedelta(seconds=lease_seconds)
+        )
+        expired.filter(attempts__gte=max_attempts).update(
+            status=cls.FAILED,
+            finished_at=timezone.now(),
+            error="The worker running the job stopped responding."
+        )
+        return expired.update(status=cls.QUEUED, worker="")
+
+    def process(self):
+        """Checks out the cart of a job claimed by this worker, and records
+        which entries were checked out and which were left in the cart.
+
+        :raises ItemLeftInCartWarning
+        :raises CheckoutJob.DoesNotExist: if the job is no longer held by this
+            worker, in which case the checkout is rolled back
+        """
+        with transaction.atomic():
+            # Locking the cart first keeps its entries unchanged until the
+            # checkout is over
+            Cart.objects.select_for_update().get(pk=self.cart_id)
+            entries = list(CartEntry.objects.filter(associated_cart_id=self.cart_id).order_by("id").values(
+                "id", "product_id", "product__title", "product_count", "cost"
+            ))
+            fulfilled_entries = set(Cart.checkout_cart(self.cart_id))
+
+            self.checked_out = [_job_entry(entry) for entry in entries if entry["id"] in fulfilled_entries]
+            self.items_left = [_job_entry(entry) for entry in entries if entry["id"] not in fulfilled_entries]
+            self.status = self.DONE
+            self.finished_at = timezone.now()
+            self.error = ""
+
+            finished = CheckoutJob.objects.filter(pk=self.pk, status=self.RUNNING, worker=self.worker).update(
+                status=self.status,
+                finished_at=self.finished_at,
+                checked_out=self.checked_out,
+                items_left=self.items_left,
+                error=self.error
+            )
+            if not finished:
+                raise CheckoutJob.DoesNotExist("The job is no longer held by this worker.")
+
+    def record_failure(self, error, max_attempts):
+        """Queues a job which failed again, or fails it for good once it was
+        attempted max_attempts times. Nothing is recorded if the job is no
+        longer held by this worker."""
+        if self.attempts >= max_attempts:
+            self.status = self.FAILED
+            self.finished_at = timezone.now()
+        else:
+            self.status = self.QUEUED
+        self.error = str(error)
+
+        CheckoutJob.objects.filter(pk=self.pk, status=self.RUNNING, worker=self.worker).update(
+            status=self.status,
+            finished_at=self.finished_at,
+            error=self.error
+        )
+
+
+def _job_entry(entry):
+    """Describes an entry of a cart checked out by a job"""
+    return {
+        "product_id": entry["product_id"],
+        "product__title": entry["product__title"],
+        "product_count": entry["product_count"],
+        "cost": str(entry["cost"]),
+    }
+
+
 @receiver(post_save, sender=MarketplaceUser)
-def create_default_cart_for_new_user(sender, instance, **kwargs):
+def create_default_cart_for_new_user(sender, instance, created=False, raw=False, **kwargs):
     """Whenever a new account is registered on our website. A cart will be auto
-     created for that user"""
-    if instance:
-        try:
-            new_cart = Cart(user=instance)
-            new_cart.save()
-        except IntegrityError:
-            pass
+    created for that user. Later saves of the user, e.g. of its last login,
+    leave its cart alone, and users without a cart (loaded from fixtures or
+    provisioned without one) get it on their first visit of a cart view"""
+    if created and not raw:
+        Cart.objects.create(user=instance)
 
 
-@receiver(pre_save, sender=CartEntry)
-@transaction.atomic
-def update_cart_entry(sender, instance, **kwargs):
-    """If a cart entry information is updated, we should update the cart's info
-    as well.
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    """Whenever a product is saved, we refresh its entry in the search index,
+    unless none of the indexed fields were saved"""
+    if update_fields is None or set(update_fields).intersection(INDEXED_FIELDS):
+        get_search_backend().index_product(instance)
 
-    This method is decorated with transaction.atomic to prevent any
-    possible race condition"""
-    try:
-        current_cart_entry = CartEntry.objects.select_for_update().get(pk=instance.id)
 
-        prev_product_count = current_cart_entry.product_count
-        prev_cost = current_cart_entry.cost
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, instance, **kwargs):
+    """Whenever a product is removed, we remove it from the search index"""
+    get_search_backend().remove_product(instance.pk)
 
-        instance.associated_cart.item_count -= prev_product_count
-        instance.associated_cart.total_cost -= prev_cost
 
-        instance.associated_cart.save()
-    # This only happens when a cart entry is created for the first time
-    except CartEntry.DoesNotExist:
-        pass
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    """Whenever a product is saved or removed, its cached details are stale"""
+    invalidate_products([instance.pk])
 
 
-@receiver(post_save, sender=CartEntry)
-@transaction.atomic
-def add_entry_to_cart(sender, instance, **kwargs):
-    """Whenever a CartEntry instance is created, we update the information in
-    the associated cart, i.e total item count, and total cost.
+@receiver(post_save, sender=Product)
+def invalidate_carts_cache_of_product(sender, instance, created=False, update_fields=None, **kwargs):
+    """Cart snapshots include the title of their products, so the carts
+    holding a product are stale whenever its title may have changed"""
+    if not created and (update_fields is None or "title" in update_fields):
+        invalidate_carts(CartEntry.objects.filter(product=instance).values_list("associated_cart_id", flat=True))
 
-    :raises ProductNotAvailableException
-    """
 
-    # This is to avoid possible race condition. During the process of checking whether
-    # a product is available. The product's true amount might have been decreased without
-    # the controller process knowing.
-    cart = Cart.objects.select_for_update().get(id=instance.associated_cart.id)
+@receiver(post_save, sender=Cart)
+def invalidate_cart_cache(sender, instance, **kwargs):
+    """Whenever a cart is saved, its cached snapshot is stale"""
+    invalidate_carts([instance.pk])
+
+
+@receiver(post_delete, sender=Cart)
+def forget_deleted_cart(sender, instance, **kwargs):
+    """Whenever a cart is removed, its owner no longer has a cached cart"""
+    forget_user_cart(instance.user_id)
+
 
+@receiver(post_save, sender=MarketplaceUser)
+def invalidate_user_caches(sender, instance, created=False, update_fields=None, **kwargs):
+    """The cached details of a product include the seller's username, and the
+    cached snapshot of a cart its owner's username, so they are stale whenever
+    the username of the user may have changed"""
+    if not created and (update_fields is None or "username" in update_fields):
+        invalidate_products(Product.objects.filter(seller=instance).values_list("id", flat=True))
+        invalidate_carts(Cart.objects.filter(user=instance).values_list("id", flat=True))
+
+
+@receiver(pre_save, sender=CartEntry)
+@instrumented("update_cart_entry")
+def update_cart_entry(sender, instance, **kwargs):
+    """Whenever a cart entry is created or updated, we apply the difference to
+    the information in the associated cart, i.e total item count, and total
+    cost.
+
+    The previous values of the entry are read by a subquery of the same UPDATE
+    statement that applies the difference, so a change costs a single round
+    trip to the cart row. The UPDATE locks the cart row until the end of the
+    transaction opened by CartEntry.save, which is rolled back as a whole if
+    the entry cannot be saved.
+
+    :raises ProductNotAvailableException
+    """
     if instance.product.inventory_count < 0:
         raise ProductNotAvailableException("There are not enough items in inventory.")
-    else:
-        cart.total_cost += instance.cost
-        cart.item_count += instance.product_count
 
-        cart.save()
+    item_count_delta = Value(instance.product_count)
+    total_cost_delta = Value(instance.cost, output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
+    if not instance._state.adding:
+        previous_values = CartEntry.objects.filter(pk=instance.pk)
+        item_count_delta -= Coalesce(Subquery(previous_values.values("product_count")), 0)
+        total_cost_delta -= Coalesce(
+            Subquery(previous_values.values("cost")),
+            Value(0, output_field=models.DecimalField(max_digits=10, decimal_places=2))
+        )
+
+    Cart.objects.filter(pk=instance.associated_cart_id).update(
+        item_count=F("item_count") + item_count_delta,
+        total_cost=F("total_cost") + total_cost_delta
+    )
+    invalidate_carts([instance.associated_cart_id])
 
 
 @receiver(pre_delete, sender=CartEntry)
-@transaction.atomic
+@instrumented("remove_entry_from_cart")
 def remove_entry_from_cart(sender, instance, **kwargs):
-    """Whenever a CartEntry instance is removed, we update the information in
-    the associated cart, i.e total item count, and total cost.
-
-    This method is decorated with transaction.atomic to prevent any
-    possible race condition"""
-    cart = Cart.objects.select_for_update().get(id=instance.associated_cart.id)
+    """Whenever a CartEntry instance is removed, we subtract its values from
+    the information in the associated cart, i.e total item count, and total
+    cost. The values stored in database are used, rather than the ones of the
+    instance which may be outdated. The items held by the entry are released
+    the same way."""
+    stored_values = CartEntry.objects.filter(pk=instance.pk)
 
-    cart.total_cost -= instance.cost
-    cart.item_count -= instance.product_count
+    Cart.objects.filter(pk=instance.associated_cart_id).update(
+        item_count=F("item_count") - Coalesce(Subquery(stored_values.values("product_count")), 0),
+        total_cost=F("total_cost") - Coalesce(
+            Subquery(stored_values.values("cost")),
+            Value(0, output_field=models.DecimalField(max_digits=10, decimal_places=2))
+        )
+    )
+    invalidate_carts([instance.associated_cart_id])
 
-    cart.save()
+    released = Product.objects.filter(pk=instance.product_id, reserved_count__gt=0).update(
+        reserved_count=F("reserved_count") - Coalesce(Subquery(stored_values.values("held_count")), 0)
+    )
+    if released:
+        invalidate_products([instance.product_id])
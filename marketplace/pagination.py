@@ -0,0 +1,101 @@
+"""Keyset (cursor) pagination of the product listing.
+
+Pages of products sorted by title are fetched with a WHERE clause on the last
+(title, id) pair seen instead of an OFFSET, so every page costs the same no
+matter how deep into the catalog it is. Cursors are opaque to clients: they are
+URL-safe base64 encoded JSON documents.
+"""
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+
+
+def encode_cursor(position):
+    """Encodes a position in the listing as an opaque cursor"""
+    data = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor
+
+    :raises ValueError
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor.")
+
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor.")
+    return position
+
+
+def paginate_products(queryset, cursor=None, limit=100, ranked=False):
+    """Returns one page of a values() queryset of products, along with the
+    cursor of the next page (None on the last page).
+
+    The queryset must select the "title" and "id" fields. Unless ranked is
+    True, it is ordered by (title, id) and paginated by keyset. Results ordered
+    by relevance have no stable key to seek to, so they are paginated by
+    offset instead.
+
+    :raises ValueError
+    """
+    page, offset = _page_queryset(queryset, cursor, limit, ranked)
+    return _split_page(list(page), limit, offset)
+
+
+async def apaginate_products(queryset, cursor=None, limit=100, ranked=False):
+    """Asynchronous version of paginate_products
+
+    :raises ValueError
+    """
+    page, offset = _page_queryset(queryset, cursor, limit, ranked)
+    return _split_page([row async for row in page], limit, offset)
+
+
+def _page_queryset(queryset, cursor, limit, ranked):
+    """Returns the queryset of the page starting at a cursor, and the offset
+    of the page if ranked is True. One extra row is fetched to tell whether
+    there is a next page.
+
+    :raises ValueError
+    """
+    position = decode_cursor(cursor) if cursor else {}
+
+    if ranked:
+        try:
+            offset = int(position.get("offset", 0))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor.")
+        if offset < 0:
+            raise ValueError("Invalid cursor.")
+
+        return queryset[offset:offset + limit + 1], offset
+
+    queryset = queryset.order_by("title", "id")
+    if position:
+        try:
+            title, pk = str(position["title"]), int(position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Invalid cursor.")
+        queryset = queryset.filter(Q(title__gt=title) | Q(title=title, id__gt=pk))
+
+    return queryset[:limit + 1], None
+
+
+def _split_page(rows, limit, offset):
+    """Drops the extra row of a page and builds the cursor of the next page"""
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    if offset is not None:
+        next_position = {"offset": offset + limit}
+    else:
+        next_position = {"title": rows[-1]["title"], "id": rows[-1]["id"]}
+    return rows, encode_cursor(next_position)
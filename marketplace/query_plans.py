@@ -0,0 +1,152 @@
+"""Query plan audit of the marketplace endpoints.
+
+Every benchmark scenario of marketplace/benchmarks.py is sent once against a
+seeded catalog, the statements run while serving it are captured through a
+database execute wrapper, and each distinct statement (by fingerprint) is
+explained with the EXPLAIN flavour of the database, e.g. EXPLAIN QUERY PLAN on
+SQLite. The plans are rendered as plain text, so that a plan changing from an
+index search to a table scan shows up in the diff of the committed baseline,
+query_plans.txt, when the tables, the indexes or the queries of an endpoint
+change.
+
+Plan lines which usually mean a query does not scale with the catalog, i.e.
+full table scans and sorts in temporary structures, are flagged as warnings.
+"""
+import os
+import re
+
+from django.db import connection
+from django.test import Client
+
+from .benchmarks import _send, get_scenarios, seed_catalog
+from .middleware import fingerprint
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.txt")
+
+_EXPLAINABLE_STATEMENTS = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+# Identical WHEN clauses of the CASE expressions of bulk updates, one per row
+_REPEATED_WHEN_RE = re.compile(r"(WHEN .+? THEN .+? )\1*(?=ELSE )")
+
+# Plan lines of full table scans and sorts, on SQLite and PostgreSQL
+_WARNING_PATTERNS = [
+    (re.compile(r"^SCAN (\S+)$"), "full scan of {0}"),
+    (re.compile(r"USE TEMP B-TREE FOR (.+)$"), "temporary sort for {0}"),
+    (re.compile(r"Seq Scan on (\S+)"), "full scan of {0}"),
+    (re.compile(r"^\s*(?:->\s*)?Sort\b"), "sort"),
+]
+
+
+class StatementCapture:
+    """Database execute wrapper recording the statements it runs along with
+    their parameters"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and sql.lstrip()[:6].upper().startswith(_EXPLAINABLE_STATEMENTS):
+            self.statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+def explain(sql, params=None):
+    """Returns the plan of a statement as a list of lines"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+        rows = cursor.fetchall()
+
+    if connection.vendor == "sqlite":
+        return _format_sqlite_plan(rows)
+    return [" ".join(str(column) for column in row) for row in rows]
+
+
+def _format_sqlite_plan(rows):
+    """Indents the (id, parent, notused, detail) rows of EXPLAIN QUERY PLAN as
+    a tree"""
+    depths = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depths[node_id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[node_id] + detail)
+    return lines
+
+
+def plan_warnings(plan):
+    """Returns the warnings raised by the lines of a plan. Scans of the
+    subqueries materialized by the plan, e.g. the VALUES list of a set-based
+    UPDATE, read the rows the statement was given rather than a table"""
+    materialized = {line.split()[1] for line in plan if line.strip().startswith("MATERIALIZE ")}
+    warnings = []
+    for line in plan:
+        for pattern, message in _WARNING_PATTERNS:
+            match = pattern.search(line.strip())
+            if match and not (message.startswith("full scan") and match.group(1) in materialized):
+                warnings.append(message.format(*match.groups()))
+    return warnings
+
+
+def audit_scenario(client, scenario):
+    """Sends the request of a scenario and explains the statements it ran.
+
+    Returns the list of distinct statements, in order of execution, as dicts
+    holding their fingerprint, the number of times they ran, their plan and
+    its warnings
+    """
+    if "setup" in scenario:
+        scenario["setup"]()
+
+    capture = StatementCapture()
+    with connection.execute_wrapper(capture):
+        response = _send(client, scenario)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{scenario['url']} returned {response.status_code}")
+
+    statements = {}
+    for sql, params in capture.statements:
+        statement_fingerprint = _REPEATED_WHEN_RE.sub(r"\1... ", fingerprint(sql))
+        if statement_fingerprint in statements:
+            statements[statement_fingerprint]["count"] += 1
+            continue
+        plan = explain(sql, params)
+        statements[statement_fingerprint] = {
+            "fingerprint": statement_fingerprint,
+            "count": 1,
+            "plan": plan,
+            "warnings": plan_warnings(plan),
+        }
+
+    return list(statements.values())
+
+
+def audit_endpoints(product_count, cart_size, only=None, seed=0):
+    """Seeds the database at the given scale, then explains the statements of
+    every scenario. The database must be empty, e.g. a test database.
+
+    Returns a dict mapping scenario names to their statements, see
+    audit_scenario
+    """
+    user = seed_catalog(product_count, cart_size, seed=seed)
+
+    client = Client()
+    client.force_login(user)
+
+    return {
+        name: audit_scenario(client, scenario)
+        for name, scenario in get_scenarios(user).items()
+        if not only or name in only
+    }
+
+
+def render_audit(audit):
+    """Renders the result of audit_endpoints as plain text"""
+    lines = []
+    for name, statements in audit.items():
+        lines.append(f"== {name}")
+        for statement in statements:
+            repeated = f" (x{statement['count']})" if statement["count"] > 1 else ""
+            lines.append(f"-- {statement['fingerprint']}{repeated}")
+            lines += [f"   {line}" for line in statement["plan"]]
+            lines += [f"   !! {warning}" for warning in statement["warnings"]]
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,192 @@
+"""Routing of the catalog reads to read replicas.
+
+Every query goes to the primary database ("default") unless it runs in a view
+decorated with replica_reads, i.e. the catalog, the cart view and the admin
+lists. Reads of those views are spread over the aliases of the
+MARKETPLACE_READ_REPLICAS setting, while writes, reads inside a transaction
+(and thus the SELECT ... FOR UPDATE of the checkout paths) always go to the
+primary.
+
+Replicas lag behind the primary, so a client could fail to read its own
+writes, e.g. not find in its cart the product it just added. Once a request
+writes to the primary, the rest of the request reads from the primary as well,
+and ReplicaRoutingMiddleware sets a cookie on the response making the next
+requests of the client read from the primary for
+MARKETPLACE_REPLICA_STICKY_SECONDS seconds.
+
+Product details and cart snapshots are cached, and the reads filling the cache
+go to the primary (see primary_reads). On those views, the replicas only serve
+the session and the user of the request.
+"""
+from contextlib import contextmanager
+import contextvars
+import functools
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_COOKIE = "marketplace_primary_until"
+
+_routing = contextvars.ContextVar("marketplace_db_routing", default=None)
+
+
+class RoutingState:
+    """Routing state of a request. It is shared by the threads and tasks
+    serving the request, so that a write in any of them is seen by all"""
+    __slots__ = ("use_replicas", "sticky", "wrote")
+
+    def __init__(self, sticky=False):
+        self.use_replicas = False
+        self.sticky = sticky
+        self.wrote = False
+
+
+def _replicas():
+    return getattr(settings, "MARKETPLACE_READ_REPLICAS", [])
+
+
+class ReplicaRouter:
+    """Database router sending the reads of replica_reads views to the read
+    replicas, and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        replicas = _replicas()
+        if (
+            state is None
+            or not state.use_replicas
+            or state.sticky
+            or state.wrote
+            or not replicas
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary, an object read from a
+        # replica may be related to one of the primary
+        databases = {DEFAULT_DB_ALIAS, *_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas are copies of the primary, they are never migrated directly
+        return db not in _replicas()
+
+
+@contextmanager
+def use_replicas():
+    """Lets the reads of the block go to the read replicas, unless the
+    request has to read its own writes"""
+    state = _routing.get()
+    token = None
+    if state is None:
+        state = RoutingState()
+        token = _routing.set(state)
+
+    previous = state.use_replicas
+    state.use_replicas = True
+    try:
+        yield
+    finally:
+        state.use_replicas = previous
+        if token is not None:
+            _routing.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Sends the reads of the block to the primary, even in a replica_reads
+    view. Used by the loaders filling the cache, see marketplace/cache.py"""
+    state = _routing.get()
+    if state is None:
+        yield
+        return
+
+    previous = state.use_replicas
+    state.use_replicas = False
+    try:
+        yield
+    finally:
+        state.use_replicas = previous
+
+
+def replica_reads(view):
+    """Decorator letting the reads of a view, synchronous or asynchronous, go
+    to the read replicas"""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            with use_replicas():
+                return await view(*args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with use_replicas():
+                return view(*args, **kwargs)
+
+    return wrapper
+
+
+class ReplicaRoutingMiddleware:
+    """Middleware keeping the clients which just wrote to the primary on the
+    primary for a few seconds, so that they read their own writes"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        state, token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self._finish(state, response)
+
+    async def __acall__(self, request):
+        state, token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self._finish(state, response)
+
+    @staticmethod
+    def _start(request):
+        try:
+            sticky = float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        state = RoutingState(sticky=sticky)
+        return state, _routing.set(state)
+
+    @staticmethod
+    def _finish(state, response):
+        if state.wrote and _replicas():
+            sticky_seconds = getattr(settings, "MARKETPLACE_REPLICA_STICKY_SECONDS", 5)
+            response.set_cookie(
+                STICKY_COOKIE,
+                str(time.time() + sticky_seconds),
+                max_age=sticky_seconds,
+                httponly=True,
+                samesite="Lax"
+            )
+        return response
@@ -0,0 +1,305 @@
+"""Full-text search over the products of our marketplace.
+
+Products are indexed by title and category in an inverted index, which is kept
+in sync by the post_save/post_delete signal handlers of Product. On SQLite the
+index is an FTS5 virtual table created by a migration. On any other database,
+or when SQLite was built without FTS5, an in-process tokenized index is used
+instead. Every process changing the in-process index bumps its version in the
+shared cache, and the other processes load the index again from the database
+on their next search.
+
+Both backends match every word of a query as a prefix of a word in the indexed
+field, so "lap" finds "Laptop", and can rank results by relevance.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+import json
+import math
+import re
+import threading
+import unicodedata
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Value, When
+from django.db.models.expressions import RawSQL
+
+from .cache import bump_search_version, get_search_version
+from .routers import primary_reads
+
+FTS_TABLE = "marketplace_product_fts"
+INDEXED_FIELDS = ("title", "category")
+
+# Same token boundaries as the unicode61 tokenizer of FTS5: runs of letters and
+# digits, anything else (including underscores) is a separator
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Splits a text into lowercase words, stripped of their diacritics"""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _TOKEN_RE.findall(text)
+
+
+class FTS5SearchBackend:
+    """Search backend storing the index in an SQLite FTS5 virtual table. The
+    rowid of each row in the index is the ID of the indexed product."""
+
+    def index_product(self, product):
+        """Adds a product to the index, or refreshes its indexed values"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, category) VALUES (%s, %s, %s)",
+                [product.pk, product.title, product.category or ""]
+            )
+
+    def remove_product(self, pk):
+        """Removes a product from the index"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [pk])
+
+    def rebuild(self):
+        """Rebuilds the whole index from the products table"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, category) "
+                f"SELECT id, title, COALESCE(category, '') FROM marketplace_product"
+            )
+
+    def filter_products(self, queryset, title="", category="", rank=False):
+        """Narrows a Product queryset down to the products matching the given
+        title and category queries. Results are ordered by relevance if rank
+        is True"""
+        expression = self._match_expression(title, category)
+        if not expression:
+            return queryset
+
+        queryset = queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression])
+        )
+        if rank:
+            # FTS5 ranks with bm25(), lower values are better matches. The rank
+            # is only available to the query running the MATCH: a materialized
+            # CTE runs it once, instead of once per product in the subquery.
+            # MATERIALIZED requires SQLite 3.35.
+            queryset = queryset.annotate(
+                search_rank=RawSQL(
+                    f"WITH ranked AS MATERIALIZED ("
+                    f"SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+                    f") SELECT rank FROM ranked WHERE ranked.rowid = marketplace_product.id",
+                    [expression]
+                )
+            ).order_by("search_rank", "title")
+
+        return queryset
+
+    @staticmethod
+    def _match_expression(title, category):
+        """Builds an FTS5 query matching every word as a prefix, restricted
+        to the column it was searched in"""
+        terms = [
+            f'{field} : "{token}"*'
+            for field, text in zip(INDEXED_FIELDS, (title, category))
+            for token in tokenize(text)
+        ]
+        return " AND ".join(terms)
+
+
+class InMemorySearchBackend:
+    """Search backend keeping a tokenized inverted index in the memory of the
+    current process. The index is loaded from the database on the first
+    search, and then kept up to date by the Product signal handlers of this
+    process. It is loaded again whenever another process changed the indexed
+    products, which is told by the version of the index in the cache."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Version of the index loaded, None if the index must be loaded
+        self._version = None
+        self._documents = {}
+        # field -> token -> {product ID: term frequency}
+        self._postings = {field: defaultdict(dict) for field in INDEXED_FIELDS}
+        # field -> sorted list of tokens, rebuilt lazily for prefix lookups
+        self._vocabulary = {field: None for field in INDEXED_FIELDS}
+
+    def index_product(self, product):
+        """Adds a product to the index, or refreshes its indexed values, once
+        the current transaction is committed"""
+        values = {field: getattr(product, field) for field in INDEXED_FIELDS}
+        transaction.on_commit(lambda: (self._add(product.pk, values), self._publish()))
+
+    def remove_product(self, pk):
+        """Removes a product from the index once the current transaction is
+        committed"""
+        transaction.on_commit(lambda: (self._remove(pk), self._publish()))
+
+    def rebuild(self):
+        """Rebuilds the whole index from the products table, and has the
+        other processes load it again once the current transaction is
+        committed"""
+        self._load()
+        transaction.on_commit(self._publish)
+
+    def _load(self):
+        """Loads the whole index from the products table of the primary
+        database, a lagging replica would leave out the latest changes"""
+        Product = apps.get_model("marketplace", "Product")
+
+        with self._lock:
+            # Read beforehand, a change made during the load is loaded again
+            version = get_search_version()
+            self._documents.clear()
+            for field in INDEXED_FIELDS:
+                self._postings[field].clear()
+                self._vocabulary[field] = None
+            with primary_reads():
+                for values in Product.objects.values("id", *INDEXED_FIELDS).iterator(chunk_size=2000):
+                    self._add(values.pop("id"), values)
+            self._version = version
+
+    def _publish(self):
+        """Bumps the version of the index after a change made by this process.
+        The index is kept if no other process changed it meanwhile, and loaded
+        again on the next search otherwise"""
+        version = bump_search_version()
+        with self._lock:
+            if version is None or self._version is None or version != self._version + 1:
+                self._version = None
+            else:
+                self._version = version
+
+    def filter_products(self, queryset, title="", category="", rank=False):
+        """Narrows a Product queryset down to the products matching the given
+        title and category queries. Results are ordered by relevance if rank
+        is True, and are then at most the MARKETPLACE_SEARCH_MAX_RESULTS most
+        relevant products"""
+        if not tokenize(title) and not tokenize(category):
+            return queryset
+
+        scores = self.search(title, category)
+        if not rank:
+            return queryset.filter(id__in=_id_list(list(scores)))
+
+        # Every ranked match takes a When clause: only the best ones are kept
+        ranking = heapq.nlargest(settings.MARKETPLACE_SEARCH_MAX_RESULTS, scores, key=scores.__getitem__)
+        queryset = queryset.filter(id__in=ranking)
+        if ranking:
+            queryset = queryset.annotate(
+                search_rank=Case(
+                    *[When(id=pk, then=Value(position)) for position, pk in enumerate(ranking)],
+                    output_field=IntegerField()
+                )
+            ).order_by("search_rank", "title")
+
+        return queryset
+
+    def search(self, title="", category=""):
+        """Returns a dict mapping the ID of every matching product to its
+        relevance score, using a TF-IDF weighting of the matched words
+        normalized by the length of the field, so that shorter fields rank
+        first like they do with bm25()"""
+        version = get_search_version()
+        with self._lock:
+            if self._version != version:
+                self._load()
+
+            scores = None
+            document_count = max(len(self._documents), 1)
+
+            for field, text in zip(INDEXED_FIELDS, (title, category)):
+                for query_token in tokenize(text):
+                    token_scores = defaultdict(float)
+                    for token in self._prefixed_tokens(field, query_token):
+                        postings = self._postings[field][token]
+                        idf = math.log(1 + document_count / len(postings))
+                        for pk, frequency in postings.items():
+                            length = len(self._documents[pk][field])
+                            token_scores[pk] += frequency * idf / math.sqrt(length)
+
+                    # Every word of the query must be matched
+                    if scores is None:
+                        scores = dict(token_scores)
+                    else:
+                        scores = {pk: score + token_scores[pk] for pk, score in scores.items() if pk in token_scores}
+                    if not scores:
+                        return {}
+
+            return scores or {}
+
+    def _prefixed_tokens(self, field, prefix):
+        """Yields every indexed token of a field starting with prefix"""
+        vocabulary = self._vocabulary[field]
+        if vocabulary is None:
+            vocabulary = self._vocabulary[field] = sorted(self._postings[field])
+
+        for token in vocabulary[bisect_left(vocabulary, prefix):]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _add(self, pk, values):
+        with self._lock:
+            self._remove(pk)
+            self._documents[pk] = {field: tokenize(values[field]) for field in INDEXED_FIELDS}
+            for field, tokens in self._documents[pk].items():
+                for token in tokens:
+                    postings = self._postings[field][token]
+                    if not postings:
+                        self._vocabulary[field] = None
+                    postings[pk] = postings.get(pk, 0) + 1
+
+    def _remove(self, pk):
+        with self._lock:
+            document = self._documents.pop(pk, None)
+            if document is None:
+                return
+            for field, tokens in document.items():
+                for token in set(tokens):
+                    postings = self._postings[field][token]
+                    postings.pop(pk, None)
+                    if not postings:
+                        del self._postings[field][token]
+                        self._vocabulary[field] = None
+
+
+def _id_list(ids):
+    """Returns a subquery of a list of IDs, sent as a single query parameter
+    on SQLite and PostgreSQL whatever the number of IDs. A parameter per ID
+    would exceed the limit of query parameters of SQLite for broad searches"""
+    if connection.vendor == "sqlite":
+        return RawSQL("SELECT value FROM json_each(%s)", [json.dumps(ids)])
+    if connection.vendor == "postgresql":
+        return RawSQL("SELECT unnest(%s::integer[])", [ids])
+    return ids
+
+
+def fts5_available():
+    """Checks whether the FTS5 index table exists in the database"""
+    return connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names()
+
+
+def get_search_backend():
+    """Returns the search backend of this process, chosen according to the
+    MARKETPLACE_SEARCH_BACKEND setting ("auto", "fts5" or "memory")"""
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                choice = getattr(settings, "MARKETPLACE_SEARCH_BACKEND", "auto")
+                if choice == "fts5" or (choice == "auto" and fts5_available()):
+                    _backend = FTS5SearchBackend()
+                else:
+                    _backend = InMemorySearchBackend()
+
+    return _backend
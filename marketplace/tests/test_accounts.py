@@ -0,0 +1,59 @@
+from io import StringIO
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from ..accounts import provision_users
+from ..models import *
+
+
+# The default password hasher takes about a second per password
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ProvisionUsersTestCase(TestCase):
+    """Tester class for the bulk provisioning of user accounts"""
+    def setUp(self):
+        MarketplaceUser.objects.create_user(username="taken", email="taken@mymarketplace.com")
+
+    def test_provision_users(self):
+        """Check that users are created with their cart and password, and that
+        invalid or taken accounts are rejected"""
+        rows = [
+            {"username": "alice", "email": "alice@legacy.com", "password": "alice-secret", "first_name": "Alice"},
+            {"username": "bob", "email": "bob@LEGACY.com"},
+            {"username": "bad name!", "email": "bad@legacy.com"},
+            {"username": "carol", "email": "not an email"},
+            {"username": "alice", "email": "alice2@legacy.com"},
+            {"username": "taken", "email": "other@legacy.com"},
+            {"email": "nobody@legacy.com"},
+        ]
+        stats = provision_users(rows, batch_size=3, workers=0)
+
+        self.assertEqual((stats["rows"], stats["created"], stats["rejected"]), (7, 2, 5))
+        self.assertEqual([username for username, _ in stats["errors"]], ["bad name!", "carol", "alice", "taken", None])
+        alice = MarketplaceUser.objects.get(username="alice")
+        self.assertTrue(alice.check_password("alice-secret"))
+        self.assertEqual(alice.first_name, "Alice")
+        bob = MarketplaceUser.objects.get(username="bob")
+        self.assertEqual(bob.email, "bob@legacy.com")
+        self.assertFalse(bob.has_usable_password())
+        self.assertEqual(Cart.objects.filter(user__in=[alice, bob]).count(), 2)
+
+    def test_passwords_hashed_by_processes(self):
+        """Check that passwords hashed by the process pool are usable"""
+        rows = [{"username": f"user{i}", "email": f"user{i}@legacy.com", "password": f"secret{i}"} for i in range(5)]
+        stats = provision_users(rows, workers=2)
+
+        self.assertEqual(stats["created"], 5)
+        self.assertTrue(MarketplaceUser.objects.get(username="user3").check_password("secret3"))
+
+    def test_provision_users_command(self):
+        """Check that the command reads accounts from a CSV file"""
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as accounts:
+            accounts.write("username,email,password\ndave,dave@legacy.com,dave-secret\ntaken,x@legacy.com,\n")
+            accounts.flush()
+            out = StringIO()
+            call_command("provision_users", accounts.name, "--workers", "0", "--quiet", stdout=out, stderr=StringIO())
+
+        self.assertIn("Created 1 users from 2 rows (1 rejected)", out.getvalue())
+        self.assertTrue(Cart.objects.filter(user__username="dave").exists())
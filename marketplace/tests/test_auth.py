@@ -0,0 +1,117 @@
+from importlib import import_module
+from io import StringIO
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, authenticate
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from ..auth import check_password, shutdown_pool
+from ..benchmarks import measure_logins
+from ..models import *
+
+
+# The default password hasher takes about a second per password. PBKDF2 hashes
+# stand for the old hashes, computed with few iterations
+@override_settings(
+    PASSWORD_HASHERS=[
+        "django.contrib.auth.hashers.MD5PasswordHasher",
+        "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+    ],
+    MARKETPLACE_PASSWORD_WORKERS=0,
+)
+class PooledModelBackendTestCase(TestCase):
+    """Tester class for the authentication backend checking passwords in a
+    pool of processes"""
+    def setUp(self):
+        self.user = MarketplaceUser.objects.create_user(
+            username="test01", email="test01@mymarketplace.com", password="fastHashing01"
+        )
+
+    def tearDown(self):
+        shutdown_pool()
+
+    def test_login(self):
+        """Check that users log in with their password only"""
+        response = self.client.post(reverse("login"), {"username": "test01", "password": "fastHashing01"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(int(self.client.session["_auth_user_id"]), self.user.id)
+
+        self.assertIsNone(authenticate(username="test01", password="wrongPassword"))
+        self.assertIsNone(authenticate(username="nobody", password="fastHashing01"))
+
+        self.user.set_unusable_password()
+        self.user.save()
+        self.assertIsNone(authenticate(username="test01", password="fastHashing01"))
+
+    def test_old_hash_is_updated_on_login(self):
+        """Check that a password hashed by another hasher than the preferred
+        one is hashed again when its user logs in"""
+        hasher = PBKDF2PasswordHasher()
+        self.user.password = hasher.encode("oldPassword01", hasher.salt(), iterations=1000)
+        self.user.save()
+
+        self.assertIsNone(authenticate(username="test01", password="wrongPassword"))
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$"))
+
+        self.assertEqual(authenticate(username="test01", password="oldPassword01"), self.user)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("md5$"))
+        self.assertTrue(self.user.check_password("oldPassword01"))
+
+    @override_settings(MARKETPLACE_PASSWORD_WORKERS=1)
+    def test_login_with_pool(self):
+        """Check that passwords checked and hashed again by the pool of
+        processes are the same as in the thread logging in"""
+        hasher = PBKDF2PasswordHasher()
+        self.user.password = hasher.encode("oldPassword01", hasher.salt(), iterations=1000)
+        self.user.save()
+
+        self.assertEqual(check_password("wrongPassword", self.user.password), (False, None))
+        self.assertEqual(authenticate(username="test01", password="oldPassword01"), self.user)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("md5$"))
+        self.assertEqual(check_password("oldPassword01", self.user.password), (True, None))
+
+    def test_sessions_of_model_backend_stay_logged_in(self):
+        """Check that the sessions logged in by the backend replaced by the
+        pool are kept by the data migration"""
+        migration = import_module("marketplace.migrations.0013_session_backends")
+        session = SessionStore()
+        session.update({
+            SESSION_KEY: str(self.user.id),
+            BACKEND_SESSION_KEY: migration.MODEL_BACKEND,
+            HASH_SESSION_KEY: self.user.get_session_auth_hash(),
+        })
+        session.create()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.assertFalse(self.client.get(reverse("marketplace:index")).wsgi_request.user.is_authenticated)
+
+        migration.use_pooled_backend(apps, None)
+        self.assertEqual(self.client.get(reverse("marketplace:index")).wsgi_request.user, self.user)
+        self.assertEqual(SessionStore(session.session_key)[BACKEND_SESSION_KEY], migration.POOLED_MODEL_BACKEND)
+
+    def test_benchmark_logins_command_arguments(self):
+        """Check that the command rejects unknown hashers"""
+        with self.assertRaises(CommandError):
+            call_command("benchmark_logins", "--hashers", "md4", stdout=StringIO())
+
+
+class LoginBenchmarkTestCase(TransactionTestCase):
+    """Tester class for the login throughput benchmark, whose clients log in
+    from several threads"""
+    def test_measure_logins(self):
+        """Check that logins are measured with and without a pool, with the
+        hasher given"""
+        for workers in (0, 1):
+            result = measure_logins("scrypt", workers, logins=2, clients=2)
+            self.assertGreaterEqual(result["cores"], 1)
+            self.assertGreater(result["logins_per_second_per_core"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+        self.assertTrue(MarketplaceUser.objects.get(username="benchmark-scrypt").password.startswith("scrypt$"))
@@ -0,0 +1,34 @@
+from django.test import TransactionTestCase
+from django.urls import resolve
+
+from .. import urls
+from ..benchmarks import check_budgets, get_scenarios, load_budgets, run_benchmarks, seed_catalog
+
+
+class EndpointBudgetTestCase(TransactionTestCase):
+    """Tester class enforcing the query budgets of every endpoint, with a small
+    catalog and carts of several sizes. Wall time and memory budgets depend on
+    the machine, they are enforced by the benchmark_endpoints command."""
+    def assertWithinBudgets(self, product_count, cart_size):
+        results = run_benchmarks(product_count, cart_size, repeat=2)
+        self.assertEqual(check_budgets(results, load_budgets(), check_timing=False), [])
+
+    def test_budgets_single_entry_cart(self):
+        self.assertWithinBudgets(50, 1)
+
+    def test_budgets_large_cart(self):
+        self.assertWithinBudgets(50, 30)
+
+    def test_every_endpoint_is_benchmarked(self):
+        """Check that every URL of the marketplace has a benchmark scenario,
+        and thus a budget"""
+        scenarios = get_scenarios(seed_catalog(10, 2))
+        benchmarked = set()
+        for scenario in scenarios.values():
+            if "setup" in scenario:
+                scenario["setup"]()
+            url = scenario["url"]() if callable(scenario["url"]) else scenario["url"]
+            benchmarked.add(resolve(url).url_name)
+
+        self.assertEqual({pattern.name for pattern in urls.urlpatterns} - benchmarked, set())
+        self.assertEqual(set(scenarios) - set(load_budgets()), set())
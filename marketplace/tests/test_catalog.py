@@ -0,0 +1,140 @@
+from decimal import Decimal
+from io import StringIO
+import tempfile
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from ..catalog import CatalogImportError, SellerCache, import_catalog
+from ..models import *
+from ..search import get_search_backend
+
+
+class CatalogImportTestCase(TestCase):
+    """Tester class for the bulk import of supplier catalogs"""
+    def setUp(self):
+        self.seller = MarketplaceUser.objects.create_user(username="supplier", email="supplier@mymarketplace.com")
+        Product.objects.create(title="Laptop", price=1000, inventory_count=20, description="Fast laptop")
+
+    def test_import_csv(self):
+        """Check that new products are inserted and existing ones updated by
+        title, leaving the fields missing from the catalog untouched"""
+        catalog = StringIO(
+            "title,price,inventory_count,category,seller\n"
+            "Laptop,900.50,25,,supplier\n"
+            "Book,20,100,books,\n"
+            "Candy,0.10,10,,\n"
+        )
+        stats = import_catalog(catalog, chunk_size=2)
+
+        self.assertEqual((stats["rows"], stats["upserted"], stats["rejected"]), (3, 3, 0))
+        laptop = Product.objects.get(title="Laptop")
+        self.assertEqual(laptop.price, Decimal("900.50"))
+        self.assertEqual(laptop.inventory_count, 25)
+        self.assertEqual(laptop.seller, self.seller)
+        self.assertEqual(laptop.description, "Fast laptop")
+        self.assertEqual(Product.objects.get(title="Book").category, "books")
+        self.assertEqual(Product.objects.get(title="Candy").category, "miscellaneous")
+        # The search index is rebuilt once the products are imported
+        self.assertEqual(
+            list(get_search_backend().filter_products(Product.objects.all(), title="boo").values_list("title", flat=True)),
+            ["Book"]
+        )
+
+    def test_import_ndjson(self):
+        """Check that NDJSON catalogs are imported, the last row of a title
+        winning within a chunk"""
+        catalog = StringIO(
+            '{"title": "Mug", "price": 12, "inventory_count": 5}\n'
+            '\n'
+            '{"title": "Mug", "price": 15, "inventory_count": 4}\n'
+        )
+        stats = import_catalog(catalog, format="ndjson")
+
+        self.assertEqual((stats["rows"], stats["upserted"]), (2, 1))
+        mug = Product.objects.get(title="Mug")
+        self.assertEqual((mug.price, mug.inventory_count), (15, 4))
+
+    def test_rejected_rows(self):
+        """Check that invalid rows are reported with their line number while
+        the other rows are imported"""
+        catalog = StringIO(
+            "title,price,inventory_count,seller\n"
+            "Book,20,100,\n"
+            "Pen,cheap,1,\n"
+            "Lamp,10,-1,\n"
+            "Mug,10,1,nobody\n"
+        )
+        stats = import_catalog(catalog)
+
+        self.assertEqual((stats["upserted"], stats["rejected"]), (1, 3))
+        self.assertEqual([line_num for line_num, _ in stats["errors"]], [3, 4, 5])
+        self.assertEqual(stats["errors"][2][1], "Unknown seller 'nobody'.")
+        self.assertFalse(Product.objects.filter(title__in=["Pen", "Lamp", "Mug"]).exists())
+
+    def test_rejected_inventory_counts(self):
+        """Check that imported counts cannot fall below the items held for
+        carts, nor overwrite the stock of sharded products"""
+        held = Product.objects.create(title="Book", price=20, inventory_count=10, reserved_count=5)
+        sharded = Product.objects.create(title="Pen", price=2, inventory_count=30)
+        Product.enable_sharding(sharded.id, 3)
+        catalog = StringIO(
+            "title,price,inventory_count\n"
+            "Book,25,2\n"
+            "Pen,3,100\n"
+            "Laptop,950,5\n"
+        )
+        stats = import_catalog(catalog)
+
+        self.assertEqual((stats["upserted"], stats["rejected"]), (1, 2))
+        self.assertEqual([line_num for line_num, _ in stats["errors"]], [2, 3])
+        held.refresh_from_db()
+        self.assertEqual((held.price, held.inventory_count, held.reserved_count), (20, 10, 5))
+        sharded.refresh_from_db()
+        self.assertEqual((sharded.price, sharded.inventory_count), (2, 30))
+        self.assertEqual(Product.objects.get(title="Laptop").inventory_count, 5)
+
+        # Counts which keep the held items in stock are imported
+        import_catalog(StringIO("title,inventory_count\nBook,5\n"))
+        held.refresh_from_db()
+        self.assertEqual(held.inventory_count, 5)
+
+    def test_unknown_column(self):
+        """Check that catalogs with columns which are not product fields are
+        refused"""
+        with self.assertRaises(CatalogImportError):
+            import_catalog(StringIO("title,reserved_count\nBook,3\n"))
+
+    def test_seller_lookups_are_batched(self):
+        """Check that sellers are looked up once per chunk for the usernames
+        not seen yet"""
+        sellers = SellerCache()
+        with self.assertNumQueries(1):
+            self.assertEqual(sellers.resolve({"supplier", "nobody"}), {"supplier": self.seller.id, "nobody": None})
+        with self.assertNumQueries(0):
+            sellers.resolve({"supplier", "nobody"})
+
+    def test_import_catalog_command(self):
+        """Check that the command guesses the format of the catalog from its
+        extension and reports the imported rows"""
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson") as catalog:
+            catalog.write('{"title": "Book", "price": 20}\n')
+            catalog.flush()
+            out = StringIO()
+            call_command("import_catalog", catalog.name, "--quiet", stdout=out)
+
+        self.assertIn("Imported 1 products from 1 rows (0 rejected)", out.getvalue())
+        self.assertEqual(Product.objects.get(title="Book").price, 20)
+
+
+class DeferredIndexesTestCase(TransactionTestCase):
+    """Tester class for the imports dropping the product indexes meanwhile,
+    which cannot run inside the transaction of a TestCase on SQLite"""
+    def test_indexes_are_created_again(self):
+        stats = import_catalog(StringIO("title,inventory_count\nBook,3\n"), defer_indexes=True)
+
+        self.assertEqual(stats["upserted"], 1)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Product._meta.db_table)
+        self.assertIn("product_in_stock_title_idx", constraints)
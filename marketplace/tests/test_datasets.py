@@ -0,0 +1,65 @@
+from io import StringIO
+import random
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from ..datasets import CATEGORIES, ZipfSampler, generate_dataset
+from ..models import *
+from ..search import get_search_backend
+
+
+# The default password hasher takes about a second to hash the password of
+# every generated dataset
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class DatasetGeneratorTestCase(TestCase):
+    """Tester class for the synthetic dataset generator"""
+    def test_generate_dataset(self):
+        """Check that the users get their cart, and that the cart totals
+        account for the entries inserted in bulk"""
+        report = generate_dataset(users=20, products=200, cart_entries=100, batch_size=30)
+
+        self.assertEqual((report["users"], report["products"], report["cart_entries"]), (20, 200, 100))
+        self.assertEqual(Cart.objects.filter(user__username__startswith="user").count(), 20)
+        self.assertEqual(Cart.count_drifted_totals(), 0)
+        self.assertTrue(all(entry.cost == entry.product.price * entry.product_count
+                            for entry in CartEntry.objects.select_related("product")))
+        self.assertTrue(set(Product.objects.values_list("category", flat=True)) <= set(CATEGORIES))
+        self.assertTrue(MarketplaceUser.objects.get(username="user0000001").check_password("marketplace"))
+
+        title = Product.objects.order_by("id").values_list("title", flat=True).first()
+        self.assertIn(
+            title,
+            get_search_backend().filter_products(Product.objects.all(), title=title).values_list("title", flat=True)
+        )
+
+    def test_generate_dataset_is_deterministic(self):
+        """Check that the same seed generates the same dataset"""
+        generate_dataset(users=5, products=50, cart_entries=20, seed=3, prefix="first")
+        first = list(CartEntry.objects.order_by("id").values_list("product__title", "product_count", "cost"))
+        Product.objects.all().delete()
+        MarketplaceUser.objects.all().delete()
+
+        generate_dataset(users=5, products=50, cart_entries=20, seed=3, prefix="second")
+        second = list(CartEntry.objects.order_by("id").values_list("product__title", "product_count", "cost"))
+        self.assertEqual(first, second)
+
+    def test_popularity_is_skewed(self):
+        """Check that a few products are drawn much more often than the
+        others"""
+        sampler = ZipfSampler(1000, 1.1, random.Random(0))
+        draws = [sampler.sample() for _ in range(10000)]
+
+        self.assertTrue(all(0 <= index < 1000 for index in draws))
+        most_drawn = max(set(draws), key=draws.count)
+        self.assertGreater(draws.count(most_drawn), 1000)
+
+    def test_generate_dataset_command(self):
+        """Check that the command reports the rows generated, and refuses to
+        clash with existing users"""
+        out = StringIO()
+        call_command("generate_dataset", "--users", "3", "--products", "10", "--cart-entries", "5", stdout=out)
+        self.assertIn("Generated 3 users, 10 products and 5 cart entries", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("generate_dataset", "--users", "3", "--products", "0", stdout=StringIO())
@@ -0,0 +1,47 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from ..loadtest import run_load
+from ..models import Product
+
+
+class ConcurrentCheckoutTestCase(TransactionTestCase):
+    """Tester class running the checkout paths concurrently. Products are
+    scarce so that workers compete for the last items in stock."""
+    def assertNoOversell(self, report):
+        self.assertEqual(report["oversold"], 0)
+        self.assertEqual(report["mismatched_products"], [])
+        self.assertEqual(report["drifted_carts"], 0)
+        self.assertEqual(report["drifted_reservations"], 0)
+        self.assertEqual(report["error_rate"], 0)
+
+    def test_concurrent_checkouts(self):
+        report = run_load(workers=6, operations=60, product_count=3, stock=30)
+
+        self.assertEqual(report["operations"], 360)
+        self.assertGreater(report["throughput"], 0)
+        self.assertNoOversell(report)
+        # The fixtures are removed after the run
+        self.assertFalse(Product.objects.exists())
+
+    def test_concurrent_checkouts_sharded_product(self):
+        report = run_load(workers=6, operations=60, product_count=1, stock=30, seed=1, shards=4)
+
+        self.assertNoOversell(report)
+
+
+@skipUnless(connection.vendor == "sqlite", "The SQLite profile is only used with SQLite")
+class SQLiteProfileTestCase(TestCase):
+    """Tester class for the tuning of SQLite connections"""
+    def test_connection_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            # 1 is NORMAL
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_transactions_take_the_write_lock(self):
+        self.assertEqual(connection.transaction_mode, "IMMEDIATE")
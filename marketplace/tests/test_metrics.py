@@ -0,0 +1,99 @@
+from django.test import TestCase, Client, override_settings
+import json
+import os
+import tempfile
+
+from .. import metrics
+from ..models import *
+
+
+class MetricsTestCase(TestCase):
+    """Tester class for the metrics of the checkout paths and their /metrics
+    endpoint"""
+    def setUp(self):
+        self.user = MarketplaceUser.objects.create_user(username="test01", email="test01@mymarketplace.com")
+        self.laptop = Product.objects.create(title="Laptop", price=1000, inventory_count=1)
+        self.book = Product.objects.create(title="Book", price=20, inventory_count=10)
+
+    def test_checkout_outcomes(self):
+        seconds = metrics.OPERATION_SECONDS
+        successes = seconds.count(operation="checkout_product", outcome="success")
+        failures = seconds.count(operation="checkout_product", outcome="not_available")
+        rows = metrics.ROWS_WRITTEN.value(operation="checkout_product")
+
+        Product.checkout_product(self.laptop.id)
+        with self.assertRaises(ProductNotAvailableException):
+            Product.checkout_product(self.laptop.id)
+
+        self.assertEqual(seconds.count(operation="checkout_product", outcome="success"), successes + 1)
+        self.assertEqual(seconds.count(operation="checkout_product", outcome="not_available"), failures + 1)
+        self.assertEqual(metrics.ROWS_WRITTEN.value(operation="checkout_product"), rows + 1)
+
+    @override_settings(MARKETPLACE_METRICS=False)
+    def test_checkout_not_recorded_when_metrics_are_off(self):
+        successes = metrics.OPERATION_SECONDS.count(operation="checkout_product", outcome="success")
+
+        with self.assertNumQueries(1):
+            Product.checkout_product(self.book.id)
+        # The operation does not run under a database execute wrapper
+        self.assertEqual(metrics.OPERATION_SECONDS.count(operation="checkout_product", outcome="success"), successes)
+
+    def test_checkout_cart_item_left(self):
+        Cart.add_products(self.user.cart.id, {self.laptop.id: 1, self.book.id: 2})
+        Product.objects.filter(id=self.laptop.id).update(inventory_count=0)
+        item_left = metrics.OPERATION_SECONDS.count(operation="checkout_cart", outcome="item_left")
+        lock_waits = metrics.LOCK_WAIT_SECONDS.count(operation="checkout_cart")
+
+        with self.assertWarns(ItemLeftInCartWarning):
+            Cart.checkout_cart(self.user.cart.id)
+
+        self.assertEqual(metrics.OPERATION_SECONDS.count(operation="checkout_cart", outcome="item_left"), item_left + 1)
+        self.assertEqual(metrics.LOCK_WAIT_SECONDS.count(operation="checkout_cart"), lock_waits + 1)
+
+    def test_render(self):
+        histogram = metrics.Histogram("test_render_seconds", "Test histogram", ["path"], buckets=[0.1, 1])
+        counter = metrics.Counter("test_render_total", "Test counter", ["path"])
+        histogram.observe(0.05, path='/a"b')
+        histogram.observe(0.5, path='/a"b')
+        counter.inc(3, path="/c")
+
+        text = metrics.render({
+            "test_render_seconds": histogram.snapshot(),
+            "test_render_total": counter.snapshot(),
+        })
+
+        self.assertIn("# TYPE test_render_seconds histogram", text)
+        self.assertIn('test_render_seconds_bucket{path="/a\\"b",le="0.1"} 1', text)
+        self.assertIn('test_render_seconds_bucket{path="/a\\"b",le="1"} 2', text)
+        self.assertIn('test_render_seconds_bucket{path="/a\\"b",le="+Inf"} 2', text)
+        self.assertIn('test_render_seconds_count{path="/a\\"b"} 2', text)
+        self.assertIn('test_render_total{path="/c"} 3', text)
+
+    def test_multiprocess_collect(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(MARKETPLACE_METRICS_DIR=directory):
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            own_hits = metrics.CACHE_LOOKUPS.value(result="hit")
+
+            # Values written by another worker process
+            with open(os.path.join(directory, "1.json"), "w") as snapshot_file:
+                json.dump({"marketplace_product_cache_lookups_total": metrics.CACHE_LOOKUPS.snapshot()}, snapshot_file)
+
+            collected = metrics.collect()["marketplace_product_cache_lookups_total"]
+
+        self.assertIn([["hit"], own_hits * 2], collected["values"])
+
+    def test_metrics_endpoint(self):
+        client = Client()
+        client.get(reverse("marketplace:api_view_products"))
+
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            'marketplace_http_request_seconds_count{view="marketplace:api_view_products",method="GET",status="200"}',
+            response.content.decode()
+        )
+
+        with override_settings(MARKETPLACE_METRICS_TOKEN="secret"):
+            self.assertEqual(client.get("/metrics").status_code, 403)
+            self.assertEqual(client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
@@ -0,0 +1,90 @@
+from django.db import connection
+from django.test import TransactionTestCase, Client, override_settings
+
+from ..middleware import QueryProfile, clear_profiler_report, fingerprint
+from ..models import *
+
+
+class QueryProfilerTestCase(TransactionTestCase):
+    """Tester class for the SQL profiling middleware"""
+    def setUp(self):
+        clear_profiler_report()
+
+        self.user = MarketplaceUser.objects.create_user(username="test01", email="test01@mymarketplace.com")
+        self.staff = MarketplaceUser.objects.create_user(
+            username="staff",
+            email="staff@mymarketplace.com",
+            is_staff=True,
+            is_superuser=True
+        )
+        products = Product.objects.bulk_create([
+            Product(title=f"Product {i}", price=10, inventory_count=100) for i in range(5)
+        ])
+        Cart.add_products(self.user.cart.id, {product.id: 1 for product in products})
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT *  FROM t WHERE id IN (%s, %s, %s) AND title = 'x' LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND title = ? LIMIT ?"
+        )
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id = %s"), fingerprint("SELECT * FROM t WHERE id = 42"))
+
+    def test_n_plus_one_candidates(self):
+        profile = QueryProfile()
+        with connection.execute_wrapper(profile):
+            entries = list(CartEntry.objects.all())
+            titles = [entry.product.title for entry in entries]
+
+        self.assertEqual(len(titles), 5)
+        candidates = profile.n_plus_one_candidates(3)
+        self.assertEqual(len(candidates), 1)
+        self.assertEqual(candidates[0]["count"], 5)
+        self.assertIn("marketplace/tests/test_middleware.py", candidates[0]["call_sites"][0])
+
+        # Loading the products up front removes the N+1 queries
+        profile = QueryProfile()
+        with connection.execute_wrapper(profile):
+            titles = [entry.product.title for entry in CartEntry.objects.select_related("product")]
+
+        self.assertEqual(profile.n_plus_one_candidates(3), [])
+
+    def test_disabled_by_default(self):
+        response = Client().get(reverse("marketplace:api_view_products"))
+
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(MARKETPLACE_QUERY_PROFILER=True)
+    def test_server_timing(self):
+        response = Client().get(reverse("marketplace:api_view_products"))
+
+        self.assertIn('db;dur=', response["Server-Timing"])
+        self.assertIn('desc="1 queries"', response["Server-Timing"])
+
+    @override_settings(MARKETPLACE_QUERY_PROFILER=True)
+    def test_report_staff_only(self):
+        client = Client()
+        client.force_login(self.user)
+        client.get(reverse("marketplace:api_view_cart"))
+
+        response = client.get(reverse("marketplace:api_query_profile"))
+        self.assertEqual(response.status_code, 302)
+
+        client.force_login(self.staff)
+        response = client.get(reverse("marketplace:api_query_profile"))
+        self.assertEqual(response.status_code, 200)
+
+        report = response.json()
+        self.assertTrue(report["enabled"])
+        self.assertIn("/marketplace/api/cart/view", [request["path"] for request in report["requests"]])
+
+    @override_settings(MARKETPLACE_QUERY_PROFILER=True)
+    def test_admin_changelist_without_n_plus_one(self):
+        client = Client()
+        client.force_login(self.staff)
+
+        for model in ("cart", "cartentry"):
+            response = client.get(reverse(f"admin:marketplace_{model}_changelist"))
+            self.assertEqual(response.status_code, 200)
+
+        report = client.get(reverse("marketplace:api_query_profile")).json()
+        self.assertEqual(report["n_plus_one"], [])
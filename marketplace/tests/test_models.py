@@ -1,5 +1,10 @@
+from django.core.management import call_command
+from django.db import IntegrityError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
 
 from ..models import *
 
@@ -106,6 +111,17 @@ class MarketplaceModelsTestCase(TestCase):
         new_user = MarketplaceUser.objects.get(pk=1)
         self.assertTrue(Cart.objects.filter(user=new_user).exists())
 
+    def test_cart_not_created_when_user_saved_again(self):
+        """Check that saving an existing user does not try to create its cart
+        again"""
+        user = MarketplaceUser.objects.get(username="test01")
+        with self.assertNumQueries(1):
+            user.save(update_fields=["last_login"])
+
+        Cart.objects.filter(user=user).delete()
+        user.save()
+        self.assertFalse(Cart.objects.filter(user=user).exists())
+
     def test_cart_info_updated_when_new_entry_updated(self):
         """Check that any cart is updated whenever a cart entry is changed"""
         # Retrieve carts from database
@@ -140,6 +156,48 @@ class MarketplaceModelsTestCase(TestCase):
 
         self.assertEqual(test_02_associated_cart.item_count, 13)
 
+    def test_cart_entry_change_is_one_cart_update(self):
+        """Check that a cart entry change applies its difference to the cart
+        with a single statement"""
+        test_01_associated_cart = Cart.objects.get(user__username="test01")
+        candy_in_cart_01 = CartEntry.objects.select_related("product").get(
+            associated_cart=test_01_associated_cart,
+            product__title="Candy"
+        )
+        candy_in_cart_01.product_count = 7
+
+        with CaptureQueriesContext(connection) as queries:
+            candy_in_cart_01.save()
+        cart_queries = [query for query in queries if '"marketplace_cart"' in query["sql"]]
+        self.assertEqual(len(cart_queries), 1)
+        self.assertTrue(cart_queries[0]["sql"].startswith("UPDATE"))
+
+        test_01_associated_cart.refresh_from_db()
+        self.assertEqual(test_01_associated_cart.item_count, 8)
+        self.assertEqual(test_01_associated_cart.total_cost, Decimal("1001.12"))
+
+        # A failed insert leaves the cart untouched
+        with self.assertRaises(IntegrityError):
+            CartEntry.objects.create(
+                associated_cart=test_01_associated_cart,
+                product=candy_in_cart_01.product,
+                product_count=1
+            )
+        test_01_associated_cart.refresh_from_db()
+        self.assertEqual(test_01_associated_cart.item_count, 8)
+
+    def test_recompute_cart_totals(self):
+        """Check that drifted cart totals are detected and repaired"""
+        Cart.objects.filter(user__username="test01").update(item_count=100, total_cost=0)
+        self.assertEqual(Cart.count_drifted_totals(), 1)
+
+        call_command("recompute_cart_totals", stdout=StringIO())
+
+        self.assertEqual(Cart.count_drifted_totals(), 0)
+        test_01_associated_cart = Cart.objects.get(user__username="test01")
+        self.assertEqual(test_01_associated_cart.item_count, 6)
+        self.assertEqual(test_01_associated_cart.total_cost, Decimal("1000.92"))
+
     def test_checkout_product(self):
         """Check that product checkout works as expected"""
         candy_product = Product.objects.get(title="Candy")
@@ -160,6 +218,98 @@ class MarketplaceModelsTestCase(TestCase):
             candy_product.id
         )
 
+    def test_checkout_product_quantity(self):
+        """Check that several items of a product can be checked out at once,
+        and that nothing is checked out when the stock is insufficient"""
+        candy_product = Product.objects.get(title="Candy")
+
+        Product.checkout_product(candy_product.id, quantity=4)
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.inventory_count, 6)
+
+        self.assertRaises(
+            ProductNotAvailableException,
+            Product.checkout_product,
+            candy_product.id,
+            quantity=7
+        )
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.inventory_count, 6)
+
+        self.assertRaises(ValueError, Product.checkout_product, candy_product.id, quantity=0)
+        self.assertRaises(Product.DoesNotExist, Product.checkout_product, 12345)
+
+    def test_sharded_product_checkout(self):
+        """Check that a sharded product is checked out from its shards, and
+        that the shards are folded back into the inventory count"""
+        candy_product = Product.objects.get(title="Candy")
+
+        Product.enable_sharding(candy_product.id, 4)
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.shard_count, 4)
+        self.assertEqual(
+            list(InventoryShard.objects.filter(product=candy_product).order_by("index").values_list(
+                "inventory_count", flat=True
+            )),
+            [3, 3, 2, 2]
+        )
+
+        # Checkouts fall back to other shards, and may span several shards
+        Product.checkout_product(candy_product.id, quantity=3)
+        Product.checkout_product(candy_product.id, quantity=6)
+        self.assertRaises(ProductNotAvailableException, Product.checkout_product, candy_product.id, quantity=2)
+
+        # The inventory count is only refreshed by reconciliation
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.inventory_count, 10)
+        self.assertEqual(Product.reconcile_inventory(), 1)
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.inventory_count, 1)
+
+        Product.disable_sharding(candy_product.id)
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.shard_count, 0)
+        self.assertEqual(candy_product.inventory_count, 1)
+        self.assertFalse(InventoryShard.objects.filter(product=candy_product).exists())
+
+    def test_sharded_product_checkout_goes_to_shards(self):
+        """Check that once a product is known to be sharded, its checkouts go
+        straight to its shards, and that folding the shards back in another
+        process is noticed"""
+        candy_product = Product.objects.get(title="Candy")
+        Product.enable_sharding(candy_product.id, 2)
+        Product.checkout_product(candy_product.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            Product.checkout_product(candy_product.id)
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]["sql"].startswith('UPDATE "marketplace_inventoryshard"'))
+
+        # Folded back without going through disable_sharding
+        InventoryShard.objects.filter(product=candy_product).delete()
+        Product.objects.filter(pk=candy_product.id).update(shard_count=0, inventory_count=8)
+        Product.checkout_product(candy_product.id, quantity=3)
+        candy_product.refresh_from_db()
+        self.assertEqual(candy_product.inventory_count, 5)
+
+    def test_checkout_cart_with_sharded_product(self):
+        """Check that carts holding sharded products are checked out from the
+        product's shards"""
+        test_02_associated_cart = Cart.objects.get(user__username="test02")
+        book = Product.objects.get(title="Book")
+
+        candy = Product.objects.get(title="Candy")
+
+        Product.enable_sharding(book.id, 3)
+        Cart.checkout_cart(pk=test_02_associated_cart.id)
+
+        Product.reconcile_inventory()
+        book.refresh_from_db()
+        candy.refresh_from_db()
+        self.assertEqual(book.inventory_count, 9997)
+        self.assertEqual(candy.inventory_count, 0)
+        self.assertFalse(CartEntry.objects.filter(associated_cart=test_02_associated_cart).exists())
+
     def test_checkout_cart_entry(self):
         """Check that relevant information is updated for each cart entry checkout"""
         test_01_associated_cart = Cart.objects.get(user__username="test01")
@@ -199,7 +349,8 @@ class MarketplaceModelsTestCase(TestCase):
 
         Cart.checkout_cart(pk=test_01_associated_cart.id)
         # Since there is not enough candies in inventory, that item won't be checked out
-        self.assertWarns(ItemLeftInCartWarning, Cart.checkout_cart(pk=test_02_associated_cart.id))
+        with self.assertWarns(ItemLeftInCartWarning):
+            Cart.checkout_cart(pk=test_02_associated_cart.id)
 
         laptop.refresh_from_db()
         book.refresh_from_db()
@@ -216,6 +367,38 @@ class MarketplaceModelsTestCase(TestCase):
         self.assertEqual(book.inventory_count, 9997)
         self.assertEqual(fountain_pen.inventory_count, 198)
 
+        # Verify the cart totals only account for the items left in cart
+        test_01_associated_cart.refresh_from_db()
+        test_02_associated_cart.refresh_from_db()
+        self.assertEqual(test_01_associated_cart.item_count, 0)
+        self.assertEqual(test_01_associated_cart.total_cost, Decimal("0.00"))
+        self.assertEqual(test_02_associated_cart.item_count, 10)
+        self.assertEqual(test_02_associated_cart.total_cost, Decimal("1.00"))
+
+    def test_checkout_cart_query_count_is_constant(self):
+        """Check that checking out a cart costs the same number of queries
+        regardless of the number of entries in the cart"""
+        small_cart = Cart.objects.get(user__username="test01")
+        CartEntry.objects.filter(associated_cart=small_cart, product__title="Candy").delete()
+
+        large_user = MarketplaceUser.objects.create_user(
+            username="test03",
+            email="test03@mymarketplace.com",
+        )
+        large_cart = Cart.objects.get(user=large_user)
+        for i in range(20):
+            product = Product.objects.create(title=f"Sticker {i}", price=1, inventory_count=5)
+            CartEntry.objects.create(associated_cart=large_cart, product=product, product_count=1)
+
+        with CaptureQueriesContext(connection) as small_cart_queries:
+            Cart.checkout_cart(pk=small_cart.id)
+        with CaptureQueriesContext(connection) as large_cart_queries:
+            Cart.checkout_cart(pk=large_cart.id)
+
+        self.assertEqual(len(small_cart_queries), len(large_cart_queries))
+        self.assertFalse(CartEntry.objects.filter(associated_cart=large_cart).exists())
+        self.assertEqual(Product.objects.get(title="Sticker 0").inventory_count, 4)
+
     def test_get_url_view_single_product(self):
         """Check that the URL to view a single product is correct"""
         product = Product.objects.get(id=1)
@@ -271,3 +454,159 @@ class MarketplaceModelsTestCase(TestCase):
         cart_entry = CartEntry.objects.get(id=1)
         expected_cart_entry_string = "Entry: test01's cart. Product: Laptop, amount: 1"
         self.assertEqual(str(cart_entry), expected_cart_entry_string)
+
+
+class CartHoldTestCase(TestCase):
+    """Tester class for the items held for carts between the time they are
+    added to a cart and the checkout"""
+    def setUp(self):
+        self.carts = [
+            Cart.objects.get(user=MarketplaceUser.objects.create_user(
+                username=f"test0{i}", email=f"test0{i}@mymarketplace.com"
+            ))
+            for i in range(1, 3)
+        ]
+        self.candy = Product.objects.create(title="Candy", price=0.10, inventory_count=10)
+        self.book = Product.objects.create(title="Book", price=20, inventory_count=100)
+
+    def assertHeld(self, product, reserved_count):
+        product.refresh_from_db()
+        self.assertEqual(product.reserved_count, reserved_count)
+        self.assertEqual(Product.count_drifted_reservations(), 0)
+
+    def test_added_items_are_held(self):
+        """Check that held items cannot be added to other carts nor bought"""
+        results = Cart.add_products(self.carts[0].id, {self.candy.id: 8}, hold=True)
+        self.assertEqual(results, {self.candy.id: None})
+        self.assertHeld(self.candy, 8)
+        self.assertEqual(self.candy.available_count, 2)
+
+        entry = CartEntry.objects.get(associated_cart=self.carts[0])
+        self.assertEqual(entry.held_count, 8)
+        self.assertGreater(entry.hold_expires_at, timezone.now())
+
+        self.assertEqual(
+            Cart.add_products(self.carts[1].id, {self.candy.id: 3}, hold=True)[self.candy.id],
+            "Cannot add more than the current number of available items."
+        )
+        self.assertRaises(ProductNotAvailableException, Product.checkout_product, self.candy.id, quantity=3)
+        Product.checkout_product(self.candy.id, quantity=2)
+        self.candy.refresh_from_db()
+        self.assertEqual(self.candy.inventory_count, 8)
+
+        # Removing the entry releases its items
+        entry.delete()
+        self.assertHeld(self.candy, 0)
+
+    def test_checkout_sells_held_items(self):
+        """Check that held items are sold without locking their product"""
+        Cart.add_products(self.carts[0].id, {self.candy.id: 10, self.book.id: 1}, hold=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            Cart.checkout_cart(pk=self.carts[0].id)
+        self.assertFalse([query for query in queries if query["sql"].startswith('SELECT "marketplace_product"')])
+
+        self.assertHeld(self.candy, 0)
+        self.assertEqual(self.candy.inventory_count, 0)
+        self.assertHeld(self.book, 0)
+        self.assertEqual(self.book.inventory_count, 99)
+        self.assertFalse(CartEntry.objects.filter(associated_cart=self.carts[0]).exists())
+
+    def test_checkout_keeps_held_entry_without_stock(self):
+        """Check that held items are not sold once the stock fell below them,
+        and that their entry is left in the cart"""
+        Cart.add_products(self.carts[0].id, {self.candy.id: 5, self.book.id: 1}, hold=True)
+        Product.objects.filter(pk=self.candy.id).update(inventory_count=2)
+        book_entry = CartEntry.objects.get(associated_cart=self.carts[0], product=self.book)
+
+        with self.assertWarns(ItemLeftInCartWarning):
+            self.assertEqual(Cart.checkout_cart(pk=self.carts[0].id), [book_entry.id])
+
+        self.candy.refresh_from_db()
+        self.assertEqual(self.candy.inventory_count, 2)
+        self.assertEqual(self.candy.reserved_count, 5)
+        self.assertEqual(
+            list(CartEntry.objects.filter(associated_cart=self.carts[0]).values_list("product", flat=True)),
+            [self.candy.id]
+        )
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.inventory_count, 99)
+
+    def test_checkout_entry_sells_held_items(self):
+        """Check that the held items of a single entry are sold, even if no
+        other item is available"""
+        Cart.add_products(self.carts[0].id, {self.candy.id: 10}, hold=True)
+
+        CartEntry.checkout_entry(CartEntry.objects.get(associated_cart=self.carts[0]).id)
+
+        self.assertHeld(self.candy, 0)
+        self.assertEqual(self.candy.inventory_count, 0)
+
+    def test_entry_changes_update_hold(self):
+        """Check that a saved entry holds its new count, and that a stale
+        entry does not bring back a released hold"""
+        entry = CartEntry(associated_cart=self.carts[0], product=self.candy, product_count=4)
+        entry.save(hold=True)
+        self.assertHeld(self.candy, 4)
+
+        entry.product_count = 10
+        entry.save(hold=True)
+        self.assertHeld(self.candy, 10)
+
+        entry.product_count = 11
+        with self.assertRaises(ProductNotAvailableException):
+            entry.save(hold=True)
+        self.assertHeld(self.candy, 10)
+        self.assertEqual(CartEntry.objects.get(pk=entry.pk).product_count, 10)
+
+        entry.product_count = 6
+        entry.save(hold=True)
+        self.assertHeld(self.candy, 6)
+
+        CartEntry.objects.filter(pk=entry.pk).update(hold_expires_at=timezone.now() - timedelta(seconds=1))
+        CartEntry.release_expired_holds()
+        entry.product_count = 5
+        entry.save()
+        self.assertHeld(self.candy, 0)
+        self.assertEqual(CartEntry.objects.get(pk=entry.pk).held_count, 0)
+
+    def test_release_expired_holds(self):
+        """Check that the expired holds are released in batches, and that the
+        entries are checked out against the stock afterwards"""
+        Cart.add_products(self.carts[0].id, {self.candy.id: 6, self.book.id: 1}, hold=True)
+        Cart.add_products(self.carts[1].id, {self.candy.id: 4}, hold=True)
+        CartEntry.objects.exclude(associated_cart=self.carts[0], product=self.book).update(
+            hold_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        out = StringIO()
+        call_command("release_expired_holds", "--batch-size", "1", stdout=out)
+        self.assertIn("Released the expired holds of 2 cart entries", out.getvalue())
+        self.assertHeld(self.candy, 0)
+        self.assertHeld(self.book, 1)
+
+        # Someone else buys candies in the meantime
+        Product.checkout_product(self.candy.id, quantity=5)
+        with self.assertWarns(ItemLeftInCartWarning):
+            Cart.checkout_cart(pk=self.carts[0].id)
+        Cart.checkout_cart(pk=self.carts[1].id)
+
+        self.candy.refresh_from_db()
+        self.assertEqual(self.candy.inventory_count, 1)
+        self.assertHeld(self.book, 0)
+        self.assertEqual(self.book.inventory_count, 99)
+
+    def test_sharded_products_are_not_held(self):
+        """Check that sharding a product releases its holds"""
+        Cart.add_products(self.carts[0].id, {self.candy.id: 6}, hold=True)
+
+        Product.enable_sharding(self.candy.id, 2)
+        self.assertHeld(self.candy, 0)
+        shards = InventoryShard.objects.filter(product=self.candy)
+        self.assertEqual(shards.aggregate(total=Sum("inventory_count"))["total"], 10)
+
+        Cart.add_products(self.carts[1].id, {self.candy.id: 4}, hold=True)
+        self.assertEqual(CartEntry.objects.get(associated_cart=self.carts[1]).held_count, 0)
+        Cart.checkout_cart(pk=self.carts[0].id)
+        Cart.checkout_cart(pk=self.carts[1].id)
+        self.assertFalse(CartEntry.objects.exists())
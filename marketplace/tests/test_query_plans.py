@@ -0,0 +1,63 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+
+from ..query_plans import audit_endpoints, plan_warnings
+
+
+class PlanWarningsTestCase(SimpleTestCase):
+    """Tester class for the detection of full scans and sorts in plans"""
+    def test_sqlite_plans(self):
+        self.assertEqual(plan_warnings(["SCAN marketplace_product"]), ["full scan of marketplace_product"])
+        self.assertEqual(plan_warnings(["SCAN marketplace_product USING INDEX product_in_stock_title_idx"]), [])
+        self.assertEqual(plan_warnings(["  USE TEMP B-TREE FOR ORDER BY"]), ["temporary sort for ORDER BY"])
+        self.assertEqual(
+            plan_warnings([
+                "MATERIALIZE updates",
+                "  SCAN 300 CONSTANT ROWS",
+                "SCAN updates",
+                "SEARCH marketplace_product USING INTEGER PRIMARY KEY (rowid=?)",
+            ]),
+            []
+        )
+
+    def test_postgresql_plans(self):
+        self.assertEqual(
+            plan_warnings([
+                "Limit  (cost=0.42..8.44 rows=1 width=4)",
+                "  ->  Sort  (cost=8.43..8.44 rows=1 width=4)",
+                "        ->  Seq Scan on marketplace_product  (cost=0.00..8.42 rows=1 width=4)",
+            ]),
+            ["sort", "full scan of marketplace_product"]
+        )
+
+
+@skipUnless(connection.vendor == "sqlite", "The plans checked are those of SQLite")
+class EndpointQueryPlanTestCase(TransactionTestCase):
+    """Tester class checking that the endpoints use the indexes meant for
+    them"""
+    def setUp(self):
+        self.audit = audit_endpoints(50, 10)
+
+    def plan(self, scenario):
+        return [line.strip() for statement in self.audit[scenario] for line in statement["plan"]]
+
+    def test_no_full_scans(self):
+        for scenario, statements in self.audit.items():
+            for statement in statements:
+                with self.subTest(scenario=scenario, statement=statement["fingerprint"]):
+                    self.assertFalse([warning for warning in statement["warnings"] if warning.startswith("full scan")])
+
+    def test_available_products_use_partial_index(self):
+        self.assertIn("SCAN marketplace_product USING INDEX product_in_stock_title_idx", self.plan("products_available"))
+
+    def test_cart_reads_are_covered(self):
+        for scenario in ["cart_view_uncached", "checkout_cart"]:
+            with self.subTest(scenario=scenario):
+                # Whole carts are read from the covering index, single entries
+                # are looked up by the unique index of (cart, product)
+                cart_entry_lines = [line for line in self.plan(scenario) if "(associated_cart_id=?)" in line]
+                self.assertTrue(cart_entry_lines)
+                for line in cart_entry_lines:
+                    self.assertIn("USING COVERING INDEX cart_listing_idx", line)
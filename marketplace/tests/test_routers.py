@@ -0,0 +1,140 @@
+import time
+from unittest import skipUnless
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ..cache import get_cache, get_cart_snapshot, get_product_payload
+from ..models import *
+from ..routers import STICKY_COOKIE, ReplicaRoutingMiddleware, replica_reads, use_replicas
+
+
+@override_settings(MARKETPLACE_READ_REPLICAS=["replica0"])
+class ReplicaRouterTestCase(SimpleTestCase):
+    """Tester class for the routing of reads to the read replicas. The aliases
+    are only computed, no query is sent to the replica"""
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def serve(self, view, cookies=None):
+        """Runs a view through ReplicaRoutingMiddleware, returns the response
+        and the database picked for the reads of the view"""
+        picked = []
+
+        def get_response(request):
+            return view(request, picked)
+
+        request = self.factory.get("/")
+        request.COOKIES.update(cookies or {})
+        response = ReplicaRoutingMiddleware(get_response)(request)
+        return response, picked
+
+    def test_reads_go_to_primary_by_default(self):
+        self.assertEqual(Product.objects.all().db, "default")
+        self.assertEqual(router.db_for_write(Product), "default")
+
+    def test_replica_reads(self):
+        with use_replicas():
+            self.assertEqual(Product.objects.all().db, "replica0")
+            self.assertEqual(router.db_for_write(Product), "default")
+        self.assertEqual(Product.objects.all().db, "default")
+
+    def test_read_own_writes_within_request(self):
+        @replica_reads
+        def view(request, picked):
+            picked.append(Product.objects.all().db)
+            router.db_for_write(Product)
+            picked.append(Product.objects.all().db)
+            return HttpResponse()
+
+        response, picked = self.serve(view)
+
+        self.assertEqual(picked, ["replica0", "default"])
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+    def test_sticky_primary_after_write(self):
+        @replica_reads
+        def view(request, picked):
+            picked.append(Product.objects.all().db)
+            return HttpResponse()
+
+        response, picked = self.serve(view, {STICKY_COOKIE: str(time.time() + 5)})
+        self.assertEqual(picked, ["default"])
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        response, picked = self.serve(view, {STICKY_COOKIE: str(time.time() - 1)})
+        self.assertEqual(picked, ["replica0"])
+
+    def test_cache_filled_from_primary(self):
+        """Check that the loaders filling the cache read from the primary, so
+        that a lagging replica never leaves stale rows in the cache"""
+        self.addCleanup(get_cache().clear)
+        picked = []
+
+        def load_product(pk):
+            picked.append(Product.objects.all().db)
+            return {"id": pk}
+
+        def load_cart(user_id):
+            picked.append(Product.objects.all().db)
+            return 1, {"items": 0}
+
+        with use_replicas():
+            get_product_payload(0, load_product)
+            get_cart_snapshot(0, load_cart)
+            get_cart_snapshot(0, load_cart)
+            picked.append(Product.objects.all().db)
+
+        self.assertEqual(picked, ["default"] * 3 + ["replica0"])
+
+
+
+@override_settings(MARKETPLACE_READ_REPLICAS=["replica0"])
+class ReplicaRouterTransactionTestCase(TestCase):
+    """Tester class for the routing of reads made in transactions"""
+    def test_transactions_read_from_primary(self):
+        with use_replicas():
+            with transaction.atomic():
+                self.assertEqual(Product.objects.select_for_update().db, "default")
+
+
+@skipUnless(settings.MARKETPLACE_READ_REPLICAS, "Set MARKETPLACE_DB_REPLICAS to run the tests against replicas")
+class ReplicaEndToEndTestCase(TransactionTestCase):
+    """Tester class serving requests with a read replica, which is a mirror of
+    the test database"""
+    databases = "__all__"
+
+    def setUp(self):
+        self.replica = settings.MARKETPLACE_READ_REPLICAS[0]
+        self.user = MarketplaceUser.objects.create_user(username="test01", email="test01@mymarketplace.com")
+        self.product = Product.objects.create(title="Product", price=10, inventory_count=100)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    @override_settings(MARKETPLACE_READ_REPLICAS=[])
+    def test_catalog_served_by_primary_without_replicas(self):
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            self.client.get(reverse("marketplace:api_view_products"))
+        self.assertEqual(len(replica_queries), 0)
+
+    def test_catalog_served_by_replica(self):
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            response = self.client.get(reverse("marketplace:api_view_products"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["products"]), 1)
+        self.assertGreater(len(replica_queries), 0)
+
+    def test_cart_read_from_primary_after_write(self):
+        response = self.client.post(
+            reverse("marketplace:api_add_to_cart", args=[self.product.id]), {"product_count": 1}
+        )
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            response = self.client.get(reverse("marketplace:api_view_cart"))
+        self.assertEqual(response.json()["items"], 1)
+        self.assertEqual(len(replica_queries), 0)
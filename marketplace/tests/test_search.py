@@ -0,0 +1,138 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from .. import search
+from ..models import *
+from ..search import FTS5SearchBackend, InMemorySearchBackend, fts5_available, get_search_backend, tokenize
+
+
+class ProductSearchTestCase(TestCase):
+    """Tester class for the product search index and its backends"""
+    def setUp(self):
+        products = [
+            {"title": "Laptop", "category": "Electronics", "inventory_count": 3},
+            {"title": "Laptop sleeve", "category": "Accessories", "inventory_count": 0},
+            {"title": "Lamp", "category": "Home", "inventory_count": 5},
+            {"title": "Café table", "category": "Home furniture", "inventory_count": 1},
+        ]
+
+        for product in products:
+            Product.objects.create(**product)
+
+    def test_tokenize(self):
+        """Check that texts are split into lowercase words without accents"""
+        self.assertEqual(tokenize("Café_Table, 2 seats!"), ["cafe", "table", "2", "seats"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_fts5_backend_chosen_on_sqlite(self):
+        """Check that the FTS5 index is used whenever it exists"""
+        if fts5_available():
+            self.assertIsInstance(get_search_backend(), FTS5SearchBackend)
+
+    def test_search_backends(self):
+        """Check that both backends match prefixes of words and rank results"""
+        backends = [InMemorySearchBackend()]
+        if fts5_available():
+            backends.append(FTS5SearchBackend())
+
+        for backend in backends:
+            backend.rebuild()
+            products = Product.objects.order_by("title")
+
+            titles = products.values_list("title", flat=True)
+            self.assertEqual(list(backend.filter_products(titles, title="lap")), ["Laptop", "Laptop sleeve"])
+            self.assertEqual(list(backend.filter_products(titles, title="lapt sle")), ["Laptop sleeve"])
+            self.assertEqual(list(backend.filter_products(titles, title="cafe")), ["Café table"])
+            self.assertEqual(list(backend.filter_products(titles, category="home")), ["Café table", "Lamp"])
+            self.assertEqual(list(backend.filter_products(titles, title="lamp", category="elec")), [])
+            self.assertEqual(list(backend.filter_products(titles, title="   ")), list(titles))
+
+            # The closest match comes first
+            ranked = backend.filter_products(products.order_by("-title"), title="laptop", rank=True)
+            self.assertEqual(list(ranked.values_list("title", flat=True)), ["Laptop", "Laptop sleeve"])
+            ranked = backend.filter_products(products.order_by("title"), category="home", rank=True)
+            self.assertEqual(list(ranked.values_list("title", flat=True)), ["Lamp", "Café table"])
+
+    @override_settings(MARKETPLACE_SEARCH_MAX_RESULTS=1)
+    def test_in_memory_backend_keeps_best_matches(self):
+        """Check that searches ranked through the in-memory index only send
+        the most relevant matches to the database, while filters keep every
+        match"""
+        backend = InMemorySearchBackend()
+        titles = Product.objects.order_by("title").values_list("title", flat=True)
+
+        self.assertEqual(list(backend.filter_products(titles, title="lap")), ["Laptop", "Laptop sleeve"])
+        self.assertEqual(list(backend.filter_products(titles, title="lap", rank=True)), ["Laptop"])
+
+    def test_in_memory_backend_broad_filter(self):
+        """Check that filters matching more products than the database takes
+        query parameters are sent as a single parameter"""
+        Product.objects.bulk_create(Product(title=f"Lamp {i}") for i in range(40000))
+        backend = InMemorySearchBackend()
+
+        self.assertEqual(backend.filter_products(Product.objects.all(), title="lamp").count(), 40001)
+
+    def test_in_memory_index_follows_other_processes(self):
+        """Check that the changes made through the in-memory index of a
+        process reach the indexes of the other processes, which share the
+        cache"""
+        backend, other_backend = InMemorySearchBackend(), InMemorySearchBackend()
+        titles = Product.objects.order_by("title").values_list("title", flat=True)
+        self.assertEqual(list(other_backend.filter_products(titles, title="desk")), [])
+
+        lamp = Product.objects.get(title="Lamp")
+        lamp.title = "Desk light"
+        with self.captureOnCommitCallbacks(execute=True):
+            lamp.save()
+            backend.index_product(lamp)
+        self.assertEqual(list(backend.filter_products(titles, title="desk")), ["Desk light"])
+        self.assertEqual(list(other_backend.filter_products(titles, title="desk")), ["Desk light"])
+
+        # The changes of a process do not load its own index again
+        with mock.patch.object(backend, "_load") as load:
+            with self.captureOnCommitCallbacks(execute=True):
+                backend.remove_product(lamp.pk)
+            self.assertEqual(list(backend.filter_products(titles, title="desk")), [])
+        load.assert_not_called()
+
+        # Products imported without signals, the index being rebuilt instead
+        Product.objects.bulk_create([Product(title="Desk chair")])
+        with self.captureOnCommitCallbacks(execute=True):
+            backend.rebuild()
+        self.assertEqual(list(other_backend.filter_products(titles, title="desk")), ["Desk chair", "Desk light"])
+
+    def test_index_follows_product_changes(self):
+        """Check that the index is kept in sync with saved and deleted products"""
+        backend = get_search_backend()
+
+        lamp = Product.objects.get(title="Lamp")
+        lamp.title = "Desk light"
+        lamp.save()
+        titles = Product.objects.values_list("title", flat=True)
+        self.assertEqual(list(backend.filter_products(titles, title="desk")), ["Desk light"])
+        self.assertEqual(list(backend.filter_products(titles, title="lamp")), [])
+
+        lamp.delete()
+        self.assertEqual(list(backend.filter_products(titles, title="desk")), [])
+
+    def test_api_retrieve_products_search(self):
+        """Check that the product listing goes through the search index"""
+        url = reverse("marketplace:api_view_products")
+
+        response = self.client.get(url, {"product": "lap"})
+        self.assertEqual([p["title"] for p in response.json()["products"]], ["Laptop", "Laptop sleeve"])
+
+        response = self.client.get(url, {"product": "lap", "availability": "true"})
+        self.assertEqual([p["title"] for p in response.json()["products"]], ["Laptop"])
+
+        response = self.client.get(url, {"category": "home", "sort": "relevance"})
+        self.assertEqual(len(response.json()["products"]), 2)
+
+    def test_api_retrieve_products_first_search(self):
+        """Check that the first search of a process picks its backend outside
+        of the event loop"""
+        with mock.patch.object(search, "_backend", None):
+            response = self.client.get(reverse("marketplace:api_view_products"), {"product": "lap"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p["title"] for p in response.json()["products"]], ["Laptop", "Laptop sleeve"])
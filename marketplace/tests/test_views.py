@@ -1,6 +1,16 @@
-from django.test import TransactionTestCase, Client
+from django.db import connection
+from django.http import Http404, HttpResponse
+from django.test import AsyncRequestFactory, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
 from django.contrib import auth
+from decimal import Decimal
+import asyncio
+import gzip
+import json
 
+from .. import views
+from ..benchmarks import asgi_views
 from ..models import *
 
 
@@ -233,6 +243,53 @@ class MarketplaceViewTestCase(TransactionTestCase):
         self._check_http_not_allowed(url, forbidden_http_methods)
         self._check_http_allowed(url, allowed_http_methods)
 
+    def test_api_retrieve_products_pagination(self):
+        """Tests that the product listing is paginated with cursors"""
+        url = reverse("marketplace:api_view_products")
+
+        titles = []
+        cursor = None
+        while True:
+            params = {"limit": 3}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get(url, params).json()
+            self.assertLessEqual(len(response["products"]), 3)
+            titles += [product["title"] for product in response["products"]]
+            cursor = response["next"]
+            if cursor is None:
+                break
+
+        self.assertEqual(titles, ["Book", "Candy", "Fountain pen", "Laptop"])
+
+        # Only the requested fields are returned
+        response = self.client.get(url, {"fields": "title,price", "limit": 1}).json()
+        self.assertEqual(list(response["products"][0]), ["title", "price"])
+        self.assertIsNotNone(response["next"])
+
+        for params in [{"limit": 0}, {"limit": "all"}, {"cursor": "garbage"}, {"fields": "password"}]:
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_api_retrieve_products_ndjson_export(self):
+        """Tests that the product listing can be streamed as NDJSON"""
+        url = reverse("marketplace:api_view_products")
+
+        response = self.client.get(url, {"format": "ndjson", "fields": "title", "limit": 1})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{"title": "Book"}, {"title": "Candy"}, {"title": "Fountain pen"}, {"title": "Laptop"}]
+        )
+
+        response = self.client.get(
+            url, {"format": "ndjson", "availability": "true"}, HTTP_ACCEPT_ENCODING="gzip, deflate"
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        lines = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)["title"] for line in lines], ["Book", "Candy"])
+
     def test_view_api_retrieve_single_product(self):
         """Tests for api_retrieve_single_product view"""
         url = reverse("marketplace:api_view_single_product", args=["1"])
@@ -242,6 +299,39 @@ class MarketplaceViewTestCase(TransactionTestCase):
         self._check_http_not_allowed(url, forbidden_http_methods)
         self._check_http_allowed(url, allowed_http_methods)
 
+    def test_api_retrieve_single_product_cache(self):
+        """Tests that product details are cached, revalidated with ETags and
+        invalidated whenever the product changes"""
+        candy = Product.objects.get(title="Candy")
+        url = reverse("marketplace:api_view_single_product", args=[str(candy.id)])
+
+        response = self.client.get(url)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json()["availability"], 10)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["X-Cache"], "HIT")
+
+        # Checkouts and edits make the cached details stale
+        Product.checkout_product(candy.id, quantity=2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["availability"], 8)
+
+        candy.seller = MarketplaceUser.objects.get(username="test02")
+        candy.save()
+        self.assertEqual(self.client.get(url).json()["seller"], "test02")
+
+        candy.seller.username = "candyshop"
+        candy.seller.save()
+        self.assertEqual(self.client.get(url).json()["seller"], "candyshop")
+
+        self.assertEqual(self.client.get(reverse("marketplace:api_view_single_product", args=["12345"])).status_code, 404)
+
     def test_view_api_retrieve_cart(self):
         """Tests for api_retrieve_cart view"""
         url = reverse("marketplace:api_view_cart")
@@ -251,6 +341,50 @@ class MarketplaceViewTestCase(TransactionTestCase):
         self._check_http_not_allowed(url, forbidden_http_methods)
         self._check_http_allowed(url, allowed_http_methods)
 
+    def test_api_retrieve_cart_snapshot(self):
+        """Tests that the cart is served from a snapshot, refreshed whenever
+        the cart changes"""
+        url = reverse("marketplace:api_view_cart")
+        test_01_associated_cart = Cart.objects.get(user__username="test01")
+
+        # Loading the session and the user costs two queries, the cart itself
+        # costs one query on a cache miss and none on a cache hit
+        with self.assertNumQueries(3):
+            response = self.client.get(url).json()
+        self.assertEqual(response["overview"], str(test_01_associated_cart))
+        self.assertEqual(response["owner"], "test01")
+        self.assertEqual(response["items"], 6)
+        self.assertEqual([item["product__title"] for item in response["items list"]], ["Laptop", "Candy"])
+
+        # The first visit only remembers which cart belongs to the user, the
+        # snapshot is cached from the second one
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(url).json(), response)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(url).json(), response)
+
+        candy_entry = CartEntry.objects.get(associated_cart=test_01_associated_cart, product__title="Candy")
+        candy_entry.product_count = 2
+        candy_entry.save()
+        self.assertEqual(self.client.get(url).json()["items"], 3)
+
+        CartEntry.checkout_entry(candy_entry.id)
+        response = self.client.get(url).json()
+        self.assertEqual(response["items"], 1)
+        self.assertEqual(len(response["items list"]), 1)
+
+        Product.objects.filter(title="Laptop").update(inventory_count=5)
+        Cart.checkout_cart(test_01_associated_cart.id)
+        response = self.client.get(url).json()
+        self.assertEqual(response["items"], 0)
+        self.assertEqual(response["items list"], [])
+
+        # The snapshot includes the username of the owner
+        user = test_01_associated_cart.user
+        user.username = "renamed01"
+        user.save()
+        self.assertEqual(self.client.get(url).json()["owner"], "renamed01")
+
     def test_view_api_add_to_cart(self):
         """Tests for api_add_to_cart view"""
         url = reverse("marketplace:api_add_to_cart", args=["1"])
@@ -260,6 +394,145 @@ class MarketplaceViewTestCase(TransactionTestCase):
         self._check_http_not_allowed(url, forbidden_http_methods)
         self._check_http_allowed(url, allowed_http_methods)
 
+    def test_api_bulk_add_to_cart(self):
+        """Tests that many products can be added to cart in one request, with
+        one outcome per product"""
+        url = reverse("marketplace:api_bulk_add_to_cart")
+        test_01_associated_cart = Cart.objects.get(user__username="test01")
+        book = Product.objects.get(title="Book")
+        candy = Product.objects.get(title="Candy")
+        fountain_pen = Product.objects.get(title="Fountain pen")
+
+        items = [
+            {"product_id": book.id, "count": 2},
+            {"product_id": candy.id, "count": 1},
+            {"product_id": fountain_pen.id, "count": 1},
+            {"product_id": 12345, "count": 1},
+            {"product_id": book.id, "count": 1},
+            {"product_id": book.id, "count": 0},
+            {"count": 1},
+        ]
+        response = self.client.post(url, json.dumps(items), content_type="application/json").json()
+
+        self.assertFalse(response["success"])
+        self.assertEqual(
+            [result["success"] for result in response["results"]],
+            [True, False, False, False, False, False, False]
+        )
+        self.assertEqual(response["results"][1]["message"], "Cart entry already exists!")
+
+        test_01_associated_cart.refresh_from_db()
+        self.assertEqual(test_01_associated_cart.item_count, 8)
+        self.assertEqual(test_01_associated_cart.total_cost, Decimal("1040.92"))
+        self.assertEqual(CartEntry.objects.get(associated_cart=test_01_associated_cart, product=book).cost, 40)
+
+        # The number of queries does not depend on the number of products
+        products = [Product.objects.create(title=f"Sticker {i}", price=1, inventory_count=5) for i in range(10)]
+        with CaptureQueriesContext(connection) as few_products_queries:
+            self.client.post(
+                url,
+                json.dumps([{"product_id": product.id, "count": 1} for product in products[:2]]),
+                content_type="application/json"
+            )
+        with CaptureQueriesContext(connection) as many_products_queries:
+            self.client.post(
+                url,
+                json.dumps([{"product_id": product.id, "count": 1} for product in products[2:]]),
+                content_type="application/json"
+            )
+        self.assertEqual(len(few_products_queries), len(many_products_queries))
+        test_01_associated_cart.refresh_from_db()
+        self.assertEqual(test_01_associated_cart.item_count, 18)
+
+        self.assertEqual(self.client.post(url, "{", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.post(url, "{}", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+    def test_api_add_to_cart_holds_items(self):
+        """Tests that the items added to a cart are held for it, and are not
+        available to other users until released"""
+        stamp = Product.objects.create(title="Stamp", price=1, inventory_count=3)
+        url = reverse("marketplace:api_add_to_cart", args=[str(stamp.id)])
+        other_client = MarketplaceClient()
+        other_client.force_login(MarketplaceUser.objects.get(username="test02"))
+
+        self.assertTrue(self.client.post(url, {"product_count": 3}).json()["success"])
+
+        details = self.client.get(reverse("marketplace:api_view_single_product", args=[str(stamp.id)])).json()
+        self.assertEqual(details["availability"], 0)
+        products = self.client.get(reverse("marketplace:api_view_products"), {"availability": "true"}).json()
+        self.assertNotIn("Stamp", [product["title"] for product in products["products"]])
+
+        response = other_client.post(url, {"product_count": 1}).json()
+        self.assertFalse(response["success"])
+        self.assertEqual(response["message"], "Cannot add more than the current number of available items.")
+
+        # Fewer items are held once the entry is updated
+        entry = CartEntry.objects.get(product=stamp)
+        update_url = reverse("marketplace:api_update_cart_entry", args=[str(entry.id)])
+        self.assertEqual(self.client.get(update_url).context["available"], 3)
+        self.assertTrue(self.client.post(update_url, {"product_count": 1}).json()["success"])
+        self.assertEqual(CartEntry.objects.get(pk=entry.id).held_count, 1)
+
+        self.assertTrue(other_client.post(url, {"product_count": 2}).json()["success"])
+        self.assertEqual(Product.objects.get(pk=stamp.id).reserved_count, 3)
+
+    def test_api_update_inventory(self):
+        """Tests that staff members can update the inventory of many products
+        in one request, with one outcome per row"""
+        url = reverse("marketplace:api_update_inventory")
+        book = Product.objects.get(title="Book")
+        candy = Product.objects.get(title="Candy")
+        laptop = Product.objects.get(title="Laptop")
+        stamp = Product.objects.create(title="Stamp", price=1, inventory_count=5)
+        self.client.post(reverse("marketplace:api_add_to_cart", args=[str(stamp.id)]), {"product_count": 3})
+
+        # Only staff members can update the inventory
+        self.assertEqual(self.client.post(url, "[]", content_type="application/json").status_code, 302)
+        staff = MarketplaceUser.objects.create_user(username="staff", email="staff@mymarketplace.com", is_staff=True)
+        self.client.force_login(staff)
+
+        rows = [
+            {"product_id": book.id, "delta": -100},
+            {"title": "Candy", "count": 42, "expected": 10},
+            {"title": "Laptop", "count": 7, "expected": 3},
+            {"product_id": stamp.id, "delta": -3},
+            {"product_id": stamp.id, "count": 1},
+            {"title": "Unknown", "delta": 1},
+            {"product_id": book.id, "delta": 1},
+            {"product_id": candy.id, "delta": 1, "count": 1},
+        ]
+        response = self.client.post(url, json.dumps(rows), content_type="application/json").json()
+
+        self.assertFalse(response["success"])
+        self.assertEqual(response["updated"], 2)
+        self.assertEqual(
+            [result["success"] for result in response["results"]],
+            [True, True, False, False, False, False, False, False]
+        )
+        self.assertEqual(response["results"][0]["inventory_count"], 9900)
+        self.assertEqual(response["results"][2]["message"], "The inventory count changed meanwhile.")
+        self.assertEqual(response["results"][2]["inventory_count"], 0)
+        self.assertEqual(
+            response["results"][3]["message"], "Cannot leave fewer items in stock than the 3 held for carts."
+        )
+        self.assertEqual(response["results"][4]["message"], "Product is listed more than once.")
+        self.assertEqual(response["results"][5]["message"], "Product does not exist.")
+        self.assertEqual(response["results"][7]["message"], "Invalid row data!")
+        self.assertEqual(Product.objects.get(pk=candy.id).inventory_count, 42)
+        self.assertEqual(Product.objects.get(pk=laptop.id).inventory_count, 0)
+        self.assertEqual(Product.objects.get(pk=stamp.id).inventory_count, 5)
+
+        # Rows can be streamed as NDJSON
+        body = "\n".join([json.dumps({"product_id": candy.id, "delta": -2}), "{", ""])
+        response = self.client.post(url, body, content_type="application/x-ndjson").json()
+        self.assertEqual([result["success"] for result in response["results"]], [True, False])
+        self.assertEqual(Product.objects.get(pk=candy.id).inventory_count, 40)
+
+        self.assertEqual(self.client.post(url, "{", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.post(url, "{}", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 405)
+
     def test_view_api_update_cart_entry(self):
         """Tests for api_update_cart_entry view"""
         url = reverse("marketplace:api_update_cart_entry", args=["1"])
@@ -278,6 +551,26 @@ class MarketplaceViewTestCase(TransactionTestCase):
         self._check_http_not_allowed(url, forbidden_http_methods)
         self._check_http_allowed(url, allowed_http_methods)
 
+    def test_api_checkout_product_quantity(self):
+        """Tests that api_checkout_product honours the quantity parameter"""
+        candy = Product.objects.get(title="Candy")
+        url = reverse("marketplace:api_checkout_product", args=[str(candy.id)])
+
+        response = self.client.post(url, {"quantity": 3})
+        self.assertTrue(response.json()["success"])
+        candy.refresh_from_db()
+        self.assertEqual(candy.inventory_count, 7)
+
+        response = self.client.post(url, {"quantity": 8})
+        self.assertFalse(response.json()["success"])
+        response = self.client.post(url, {"quantity": "many"})
+        self.assertFalse(response.json()["success"])
+        candy.refresh_from_db()
+        self.assertEqual(candy.inventory_count, 7)
+
+        response = self.client.post(reverse("marketplace:api_checkout_product", args=["12345"]))
+        self.assertEqual(response.status_code, 404)
+
     def test_view_api_checkout_cart_entry(self):
         """Tests for api_checkout_cart_entry view"""
         url = reverse("marketplace:api_checkout_cart_entry", args=["1"])
@@ -313,3 +606,101 @@ class MarketplaceViewTestCase(TransactionTestCase):
             response = http_request_function(target_url)
             if response.status_code != 404:
                 self.assertNotEqual(response.status_code, 405)
+
+
+class AsyncViewTestCase(TransactionTestCase):
+    """Tester class for the views served through ASGI, i.e. the asynchronous
+    catalog views and the blocking checkout views. The views of this process
+    were decorated for WSGI, the asynchronous variants are called directly"""
+    def setUp(self):
+        self.user = MarketplaceUser.objects.create_user(username="test01", email="test01@mymarketplace.com")
+        self.book = Product.objects.create(title="Book", price=20, inventory_count=100)
+        self.candy = Product.objects.create(title="Candy", price=0.10, inventory_count=1)
+        Cart.add_products(self.user.cart.id, {self.book.id: 2})
+        self.factory = AsyncRequestFactory()
+
+    def authenticated_request(self, url, user):
+        request = self.factory.get(url)
+        request.user = user
+
+        async def auser():
+            return user
+        request.auser = auser
+        return request
+
+    async def test_async_catalog_views(self):
+        url = reverse("marketplace:api_view_products")
+        response = await views.aapi_retrieve_products(self.factory.get(url, {"product": "bo"}))
+        self.assertEqual([product["title"] for product in json.loads(response.content)["products"]], ["Book"])
+
+        url = reverse("marketplace:api_view_single_product", args=[self.book.id])
+        response = await views.aapi_retrieve_single_product(self.factory.get(url), pk=self.book.id)
+        self.assertEqual(json.loads(response.content)["product name"], "Book")
+        response = await views.aapi_retrieve_single_product(
+            self.factory.get(url, headers={"If-None-Match": response["ETag"]}), pk=self.book.id
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["X-Cache"], "HIT")
+
+        with self.assertRaises(Http404):
+            await views.aapi_retrieve_single_product(self.factory.get(url), pk=0)
+
+    async def test_async_cart_view(self):
+        url = reverse("marketplace:api_view_cart")
+
+        response = await views.aapi_retrieve_cart(self.authenticated_request(url, auth.models.AnonymousUser()))
+        self.assertEqual(response.status_code, 302)
+
+        response = await views.aapi_retrieve_cart(self.authenticated_request(url, self.user))
+        self.assertEqual(json.loads(response.content)["items"], 2)
+        self.assertEqual(json.loads(response.content)["items list"][0]["product__title"], "Book")
+
+    def test_views_are_sync_under_wsgi(self):
+        """Check that the catalog and blocking views are left as sync views
+        unless the site is served through ASGI"""
+        for view in (views.api_retrieve_products, views.api_retrieve_single_product,
+                     views.api_retrieve_cart, views.api_checkout_cart):
+            self.assertFalse(asyncio.iscoroutinefunction(view))
+
+        def view(request):
+            return HttpResponse()
+        self.assertIs(views.blocking_view(view), view)
+        self.assertIs(views.asgi_variant(views.aapi_retrieve_products)(view), view)
+        self.assertIs(views.api_retrieve_products.asgi_view, views.aapi_retrieve_products)
+        with override_settings(MARKETPLACE_ASGI=True):
+            self.assertIs(views.asgi_variant(views.aapi_retrieve_products)(view), views.aapi_retrieve_products)
+
+    def test_asgi_views_are_routed_by_benchmarks(self):
+        """Check that the benchmarks of the ASGI handler route the URLs to the
+        asynchronous views"""
+        url = reverse("marketplace:api_view_cart")
+        with asgi_views():
+            self.assertIs(resolve(url).func, views.aapi_retrieve_cart)
+        self.assertIs(resolve(url).func, views.api_retrieve_cart)
+
+    async def test_async_ndjson_export(self):
+        request = self.factory.get(reverse("marketplace:api_view_products"), {"format": "ndjson"})
+        response = await views.aapi_retrieve_products(request)
+
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)["title"] for line in content.splitlines()], ["Book", "Candy"])
+
+    @override_settings(MARKETPLACE_BLOCKING_VIEWS_CONCURRENCY=1)
+    async def test_concurrent_checkouts(self):
+        url = reverse("marketplace:api_checkout_product", args=[self.candy.id])
+
+        responses = await asyncio.gather(*[self.async_client.post(url) for _ in range(5)])
+        self.assertEqual(sorted(response.json()["success"] for response in responses), [False] * 4 + [True])
+
+        # The views of this process were decorated for WSGI, the checkout
+        # view is wrapped again as it is under ASGI
+        with override_settings(MARKETPLACE_ASGI=True):
+            asgi_view = views.blocking_view(views.api_checkout_product.__wrapped__)
+        self.assertTrue(asyncio.iscoroutinefunction(asgi_view))
+        await Product.objects.filter(id=self.candy.id).aupdate(inventory_count=1)
+
+        factory = AsyncRequestFactory()
+        responses = await asyncio.gather(*[asgi_view(factory.post(url), pk=self.candy.id) for _ in range(5)])
+        self.assertEqual(sorted(json.loads(response.content)["success"] for response in responses), [False] * 4 + [True])
+        self.assertEqual((await Product.objects.aget(id=self.candy.id)).inventory_count, 0)
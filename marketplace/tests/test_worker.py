@@ -0,0 +1,127 @@
+import logging
+
+from django.test import Client, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from ..models import *
+from ..worker import run_pool
+
+
+class CheckoutJobTestCase(TransactionTestCase):
+    """Tester class for the queued checkouts and their workers"""
+    def setUp(self):
+        self.user = MarketplaceUser.objects.create_user(username="test01", email="test01@mymarketplace.com")
+        self.cart = Cart.objects.get(user=self.user)
+        self.products = Product.objects.bulk_create([
+            Product(title="Product 1", price=10, inventory_count=100),
+            Product(title="Product 2", price=20, inventory_count=1),
+        ])
+        Cart.add_products(self.cart.id, {self.products[0].id: 2, self.products[1].id: 1})
+        # Someone else buys the last item of the second product meanwhile
+        Product.checkout_product(self.products[1].id)
+
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def run_workers(self, **kwargs):
+        """Runs thread workers until the queue is drained. The workers share
+        the in-memory test database, whose table locks make them fail and
+        retry now and then: their log is captured, and may only report lock
+        errors"""
+        with self.assertLogs("marketplace.worker", level="INFO") as logs:
+            run_pool(mode="thread", drain=True, **kwargs)
+
+        stopped = [record for record in logs.records if record.levelno == logging.INFO]
+        self.assertEqual(len(stopped), kwargs["workers"])
+        for record in logs.records:
+            if record.exc_info:
+                self.assertIn("locked", str(record.exc_info[1]), record.getMessage())
+
+    def test_queued_checkout(self):
+        response = self.client.post(reverse("marketplace:api_checkout_cart"), HTTP_PREFER="respond-async")
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job"]
+        self.assertEqual(response["Location"], reverse("marketplace:api_checkout_job", args=[job_id]))
+
+        response = self.client.get(response["Location"])
+        self.assertEqual(response.json()["status"], "queued")
+        # Nothing was checked out yet
+        self.assertEqual(Product.objects.get(pk=self.products[0].id).inventory_count, 100)
+
+        self.run_workers(workers=2, lease_seconds=2)
+
+        response = self.client.get(reverse("marketplace:api_checkout_job", args=[job_id])).json()
+        self.assertEqual(response["status"], "done")
+        self.assertFalse(response["success"])
+        self.assertEqual([item["product__title"] for item in response["checked out"]], ["Product 1"])
+        self.assertEqual([item["product__title"] for item in response["items left"]], ["Product 2"])
+        self.assertEqual(Product.objects.get(pk=self.products[0].id).inventory_count, 98)
+        self.assertEqual(CartEntry.objects.filter(associated_cart=self.cart).count(), 1)
+
+    @override_settings(MARKETPLACE_QUEUED_CHECKOUT=True)
+    def test_checkout_queued_once(self):
+        first = self.client.post(reverse("marketplace:api_checkout_cart")).json()["job"]
+        second = self.client.post(reverse("marketplace:api_checkout_cart")).json()["job"]
+
+        self.assertEqual(first, second)
+        self.assertEqual(CheckoutJob.objects.count(), 1)
+
+    def test_job_of_another_user(self):
+        job = CheckoutJob.enqueue(self.cart.id)
+        MarketplaceUser.objects.create_user(username="test02", email="test02@mymarketplace.com")
+        client = Client()
+        client.force_login(MarketplaceUser.objects.get(username="test02"))
+
+        response = client.get(reverse("marketplace:api_checkout_job", args=[job.id]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_claim_is_exclusive(self):
+        job = CheckoutJob.enqueue(self.cart.id)
+
+        claimed = CheckoutJob.claim("worker-1")
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(CheckoutJob.claim("worker-2"))
+
+    def test_expired_lease_is_not_checked_out_twice(self):
+        CheckoutJob.enqueue(self.cart.id)
+        stalled = CheckoutJob.claim("worker-1")
+
+        self.assertEqual(CheckoutJob.requeue_expired(lease_seconds=0, max_attempts=3), 1)
+        taken_over = CheckoutJob.claim("worker-2")
+        with self.assertWarns(ItemLeftInCartWarning):
+            taken_over.process()
+
+        # The stalled worker wakes up, its checkout is rolled back
+        Cart.add_products(self.cart.id, {self.products[0].id: 2})
+        with self.assertRaises(CheckoutJob.DoesNotExist), self.assertWarns(ItemLeftInCartWarning):
+            stalled.process()
+        self.assertEqual(Product.objects.get(pk=self.products[0].id).inventory_count, 98)
+        self.assertEqual(CheckoutJob.objects.get().worker, "worker-2")
+
+    def test_failed_after_max_attempts(self):
+        CheckoutJob.enqueue(self.cart.id)
+
+        CheckoutJob.claim("worker-1").record_failure(Exception("database is locked"), max_attempts=2)
+        self.assertEqual(CheckoutJob.objects.get().status, "queued")
+
+        CheckoutJob.claim("worker-1").record_failure(Exception("database is locked"), max_attempts=2)
+        job = CheckoutJob.objects.get()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "database is locked")
+
+    def test_concurrent_workers(self):
+        carts = []
+        for i in range(6):
+            user = MarketplaceUser.objects.create_user(username=f"buyer{i}", email=f"buyer{i}@mymarketplace.com")
+            carts.append(Cart.objects.get(user=user))
+            Cart.add_products(carts[-1].id, {self.products[0].id: 5})
+            CheckoutJob.enqueue(carts[-1].id)
+
+        # Lock errors of the shared in-memory test database are retried, and
+        # jobs whose failure could not be recorded are soon queued again
+        self.run_workers(workers=3, lease_seconds=2, max_attempts=10)
+
+        self.assertEqual(CheckoutJob.objects.filter(status="done").count(), 6)
+        self.assertEqual(Product.objects.get(pk=self.products[0].id).inventory_count, 70)
+        self.assertFalse(CartEntry.objects.filter(associated_cart__in=carts).exists())
@@ -8,8 +8,12 @@ urlpatterns = [
     path("api/products/<int:pk>/view", views.api_retrieve_single_product, name="api_view_single_product"),
     path("api/products/<int:pk>/add-to-cart", views.api_add_to_cart, name="api_add_to_cart"),
     path("api/products/<int:pk>/checkout", views.api_checkout_product, name="api_checkout_product"),
+    path("api/products/inventory", views.update_inventory, name="api_update_inventory"),
     path("api/cart/view", views.api_retrieve_cart, name="api_view_cart"),
+    path("api/cart/bulk-add", views.api_bulk_add_to_cart, name="api_bulk_add_to_cart"),
     path("api/cart/<int:pk>/update", views.api_update_cart_entry, name="api_update_cart_entry"),
     path("api/cart/<int:pk>/checkout", views.api_checkout_cart_entry, name="api_checkout_cart_entry"),
     path("api/cart/checkout", views.api_checkout_cart, name="api_checkout_cart"),
+    path("api/cart/checkout/<int:pk>", views.api_checkout_job, name="api_checkout_job"),
+    path("api/debug/queries", views.api_query_profile, name="api_query_profile"),
 ]
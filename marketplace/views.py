@@ -1,16 +1,80 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import (
-    HttpResponse, HttpResponseNotAllowed, HttpResponseForbidden, JsonResponse
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseForbidden,
+    HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 )
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.db import IntegrityError
+from django.db.models import F
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
+import asyncio
+import functools
+import itertools
+import json
+import weakref
+import zlib
 
 from .models import *
 from .forms import *
+from .cache import aget_cart_snapshot, aget_product_payload, etag_matches, get_cart_snapshot, get_product_payload
+from .metrics import render as render_metrics
+from .middleware import profiler_report
+from .pagination import apaginate_products, paginate_products
+from .routers import replica_reads
+from .search import get_search_backend
+
+# Product fields which can be returned by the product listing
+PRODUCT_LISTING_FIELDS = [
+    "id",
+    "title",
+    "price",
+    "inventory_count",
+    "category",
+    "description",
+    "seller__username"
+]
+
+# Semaphores bounding the blocking views running at once, per event loop
+_blocking_view_semaphores = weakref.WeakKeyDictionary()
 
 # Create your views here.
 
 
+def blocking_view(view):
+    """Decorator running a blocking view, e.g. one holding database locks in a
+    transaction, in a thread of its own so that the whole view (and its
+    transaction) uses a single database connection.
+
+    Under ASGI, at most MARKETPLACE_BLOCKING_VIEWS_CONCURRENCY of these views
+    run at once per event loop, the other requests wait as coroutines rather
+    than each tying up a thread and a database connection. Under WSGI, i.e.
+    unless MARKETPLACE_ASGI is set, the view is returned unchanged and runs in
+    the worker thread: a coroutine would cost an event loop per request.
+    """
+    if not settings.MARKETPLACE_ASGI:
+        return view
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = _blocking_view_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _blocking_view_semaphores[loop] = asyncio.Semaphore(
+                settings.MARKETPLACE_BLOCKING_VIEWS_CONCURRENCY
+            )
+
+        async with semaphore:
+            return await sync_to_async(view, thread_sensitive=True)(request, *args, **kwargs)
+
+    return wrapper
+
+
 def index(request):
     """Returns the index page with sitemap"""
     return render(request, "marketplace/index.html")
@@ -40,8 +104,123 @@ def register(request):
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
 
 
+def asgi_variant(async_view):
+    """Decorator replacing a view by its asynchronous variant when the site is
+    served through ASGI, i.e. when MARKETPLACE_ASGI is set. The asynchronous
+    variants use the async ORM interface and do not tie up a thread per
+    request. Under WSGI the sync view is kept: a coroutine would cost an event
+    loop per request, and the asynchronous variant is kept as its asgi_view
+    attribute.
+    """
+    def decorator(view):
+        if settings.MARKETPLACE_ASGI:
+            return async_view
+        view.asgi_view = async_view
+        return view
+
+    return decorator
+
+
+def _product_listing(request):
+    """Builds the queryset of the products listed by api_retrieve_products
+    from the GET parameters of a request, going through the search index.
+    Returns the queryset along with the fields returned, the number of
+    products per page and whether the products are ranked by relevance.
+
+    The search backend may query the database: on the first search of the
+    process, it looks the FTS5 table up, and the in-memory index may have to
+    be loaded.
+
+    :raises ValueError: with the error returned to the client
+    """
+    product_name = request.GET.get("product", "")
+    category = request.GET.get("category", "")
+    show_available = request.GET.get("availability", "false").lower()
+    rank = request.GET.get("sort", "title").lower() == "relevance"
+
+    try:
+        limit = int(request.GET.get("limit", settings.MARKETPLACE_PRODUCTS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit.")
+    if limit <= 0:
+        raise ValueError("Invalid limit.")
+    limit = min(limit, settings.MARKETPLACE_PRODUCTS_PAGE_MAX)
+
+    fields = PRODUCT_LISTING_FIELDS
+    if request.GET.get("fields"):
+        fields = [field.strip() for field in request.GET["fields"].split(",") if field.strip()]
+        if not fields or not set(fields).issubset(PRODUCT_LISTING_FIELDS):
+            raise ValueError("Invalid fields.")
+
+    # if availability == true is GET request, show products in stock
+    if show_available == "true":
+        lower_bound = 0
+    else:
+        lower_bound = -1
+
+    products_list = Product.objects.filter(inventory_count__gt=lower_bound).order_by("title")
+    if show_available == "true":
+        # Items held for carts are not available. The bound on
+        # inventory_count is kept, it matches the partial index of the
+        # products in stock
+        products_list = products_list.filter(inventory_count__gt=F("reserved_count"))
+    if product_name or category:
+        # Words of the product and category queries are matched as prefixes
+        # through the search index, instead of scanning the whole table
+        products_list = get_search_backend().filter_products(
+            products_list,
+            title=product_name,
+            category=category,
+            rank=rank
+        )
+
+    return products_list, fields, limit, rank
+
+
+@replica_reads
+async def aapi_retrieve_products(request):
+    """Asynchronous version of api_retrieve_products"""
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
+
+    if request.method not in ["GET", "HEAD"]:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+    else:
+        ctx = {}
+
+        try:
+            products_list, fields, limit, rank = await sync_to_async(_product_listing)(request)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+
+        if request.GET.get("format", "json").lower() == "ndjson":
+            return _stream_products(request, products_list.values(*fields), fields)
+
+        # The title and ID are needed to build the cursor of the next page
+        products_list = products_list.values(*dict.fromkeys([*fields, "title", "id"]))
+
+        try:
+            products, next_cursor = await apaginate_products(
+                products_list,
+                cursor=request.GET.get("cursor"),
+                limit=limit,
+                ranked=rank
+            )
+        except ValueError:
+            return HttpResponseBadRequest("Invalid cursor.")
+
+        ctx["products"] = [{field: product[field] for field in fields} for product in products]
+        ctx["next"] = next_cursor
+
+        return JsonResponse(ctx)
+
+
+@asgi_variant(aapi_retrieve_products)
+@replica_reads
 def api_retrieve_products(request):
-    """Let users view and search for products from our marketplace.
+    """Let users view and search for products from our marketplace. Results
+    are returned one page at a time, the "next" value of the response is the
+    cursor of the following page (null on the last page). Under ASGI, the
+    asynchronous version of this view is served instead.
 
     Supported HTTP methods: GET
 
@@ -49,6 +228,13 @@ def api_retrieve_products(request):
         product: Search based on products' title
         category: Search based on products' category
         availability (true/false): Search based on products' availability
+        sort (title/relevance): Order of the results, defaults to title
+        limit (int): Number of products per page, capped by the server
+        cursor: Cursor of the page to fetch, as returned in "next"
+        fields: Comma separated list of product fields to return
+        format (json/ndjson): With ndjson, every matching product is streamed
+            as one JSON document per line instead of being paginated. The
+            stream is gzip compressed if the client accepts it
     """
     HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
 
@@ -57,37 +243,124 @@ def api_retrieve_products(request):
     else:
         ctx = {}
 
-        product_name = request.GET.get("product", "")
-        category = request.GET.get("category", "")
-        show_available = request.GET.get("availability", "false").lower()
+        try:
+            products_list, fields, limit, rank = _product_listing(request)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
 
-        # if availability == true is GET request, show products in stock
-        if show_available == "true":
-            lower_bound = 0
-        else:
-            lower_bound = -1
-
-        products_list = Product.objects.values(
-            "id",
-            "title",
-            "price",
-            "inventory_count",
-            "category",
-            "description",
-            "seller__username"
-        ).filter(
-            inventory_count__gt=lower_bound,
-            title__icontains=product_name,
-            category__icontains=category
-        ).order_by("title")
-
-        ctx["products"] = list(products_list)
+        if request.GET.get("format", "json").lower() == "ndjson":
+            return _stream_products(request, products_list.values(*fields), fields)
+
+        # The title and ID are needed to build the cursor of the next page
+        products_list = products_list.values(*dict.fromkeys([*fields, "title", "id"]))
+
+        try:
+            products, next_cursor = paginate_products(
+                products_list,
+                cursor=request.GET.get("cursor"),
+                limit=limit,
+                ranked=rank
+            )
+        except ValueError:
+            return HttpResponseBadRequest("Invalid cursor.")
+
+        ctx["products"] = [{field: product[field] for field in fields} for product in products]
+        ctx["next"] = next_cursor
 
         return JsonResponse(ctx)
 
 
+def _stream_products(request, products_list, fields):
+    """Streams a values() queryset of products as newline delimited JSON. Rows
+    are fetched from a server-side cursor in chunks and encoded as they go, so
+    memory usage does not depend on the number of products exported."""
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    compress = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+    # The stream is consumed after the view returned, bind it to the database
+    # picked for the reads of the view
+    products_list = products_list.using(products_list.db)
+
+    def generate_lines():
+        buffer = []
+        buffered = 0
+        for product in products_list.iterator(chunk_size=settings.MARKETPLACE_EXPORT_CHUNK_SIZE):
+            line = encoder.encode({field: product[field] for field in fields}) + "\n"
+            buffer.append(line)
+            buffered += len(line)
+            # Send the lines in blocks rather than one at a time
+            if buffered >= 64 * 1024:
+                yield "".join(buffer).encode()
+                buffer = []
+                buffered = 0
+        yield "".join(buffer).encode()
+
+    def generate_gzip():
+        # wbits=31 produces a gzip container instead of a raw zlib stream
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for block in generate_lines():
+            compressed = compressor.compress(block)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    content = generate_gzip() if compress else generate_lines()
+    if isinstance(request, ASGIRequest):
+        # ASGI servers consume responses asynchronously, and would otherwise
+        # read the whole export in memory first
+        content = _iterate_in_thread(content)
+
+    response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+    response["Vary"] = "Accept-Encoding"
+    if compress:
+        response["Content-Encoding"] = "gzip"
+    return response
+
+
+async def _iterate_in_thread(iterator, batch_size=16):
+    """Turns a blocking iterator, e.g. one reading rows from the database,
+    into an asynchronous one. Items are fetched in batches from the thread
+    running the blocking code of the current request."""
+    next_batch = sync_to_async(lambda: list(itertools.islice(iterator, batch_size)), thread_sensitive=True)
+
+    while True:
+        batch = await next_batch()
+        if not batch:
+            return
+        for item in batch:
+            yield item
+
+
+def _single_product_response(request, body, etag, cached):
+    """Builds the response of api_retrieve_single_product from the cached
+    details of the product"""
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    response["X-Cache"] = "HIT" if cached else "MISS"
+
+    return response
+
+
+@replica_reads
+async def aapi_retrieve_single_product(request, pk):
+    """Asynchronous version of api_retrieve_single_product"""
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
+
+    if request.method not in ["GET", "HEAD"]:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+    else:
+        return _single_product_response(request, *await aget_product_payload(pk, _aload_single_product))
+
+
+@asgi_variant(aapi_retrieve_single_product)
+@replica_reads
 def api_retrieve_single_product(request, pk):
-    """Returns product detailed information based on product ID
+    """Returns product detailed information based on product ID. Responses are
+    cached and carry an ETag, a request with a matching If-None-Match header
+    gets an empty 304 response. Under ASGI, the asynchronous version of this
+    view is served instead.
 
     Supported HTTP methods: GET
     """
@@ -96,26 +369,66 @@ def api_retrieve_single_product(request, pk):
     if request.method not in ["GET", "HEAD"]:
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
     else:
-        ctx = {}
+        return _single_product_response(request, *get_product_payload(pk, _load_single_product))
 
-        current_product = get_object_or_404(Product, pk=pk)
 
-        ctx["product name"] = current_product.title
-        ctx["price"] = current_product.price
-        ctx["availability"] = current_product.inventory_count
-        ctx["category"] = current_product.category
-        ctx["description"] = current_product.description
-        if current_product.seller:
-            ctx["seller"] = current_product.seller.username
-        else:
-            ctx["seller"] = None
+def _single_product_details(product):
+    """Returns the details of a product returned by
+    api_retrieve_single_product"""
+    ctx = {}
+
+    ctx["product name"] = product.title
+    ctx["price"] = product.price
+    ctx["availability"] = product.available_count
+    ctx["category"] = product.category
+    ctx["description"] = product.description
+    if product.seller:
+        ctx["seller"] = product.seller.username
+    else:
+        ctx["seller"] = None
+
+    return ctx
+
+
+def _load_single_product(pk):
+    """Builds the details of a product returned by api_retrieve_single_product
+
+    :raises Http404
+    """
+    return _single_product_details(get_object_or_404(Product.objects.select_related("seller"), pk=pk))
+
+
+async def _aload_single_product(pk):
+    """Asynchronous version of _load_single_product
+
+    :raises Http404
+    """
+    return _single_product_details(await aget_object_or_404(Product.objects.select_related("seller"), pk=pk))
+
+
+@replica_reads
+@login_required()
+async def aapi_retrieve_cart(request):
+    """Asynchronous version of api_retrieve_cart"""
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
+
+    if request.method not in ["GET", "HEAD"]:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+    else:
+        user = await request.auser()
+        ctx = await aget_cart_snapshot(user.id, lambda user_id: _aload_cart_snapshot(user))
 
         return JsonResponse(ctx)
 
 
+@asgi_variant(aapi_retrieve_cart)
+@replica_reads
 @login_required()
 def api_retrieve_cart(request):
-    """Returns user's cart information including items list, total cost
+    """Returns user's cart information including items list, total cost. The
+    cart is served from a cached snapshot, which is rebuilt with a single
+    query whenever the cart changes. Under ASGI, the asynchronous version of
+    this view is served instead.
 
     Supported HTTP methods: GET
     """
@@ -124,26 +437,75 @@ def api_retrieve_cart(request):
     if request.method not in ["GET", "HEAD"]:
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
     else:
-        ctx = {}
+        ctx = get_cart_snapshot(request.user.id, lambda user_id: _load_cart_snapshot(request.user))
 
-        current_cart, created = Cart.objects.get_or_create(user=request.user)
+        return JsonResponse(ctx)
 
-        cart_entries = CartEntry.objects.values(
-            "id",
-            "product__title",
-            "product_count",
-            "cost"
-        ).filter(
-            associated_cart=current_cart
-        )
 
-        ctx["overview"] = current_cart.__str__()
-        ctx["owner"] = current_cart.user.username
-        ctx["items"] = current_cart.item_count
-        ctx["total"] = current_cart.total_cost
-        ctx["items list"] = list(cart_entries)
+def _cart_rows(user):
+    """Returns the query of the cart information returned by
+    api_retrieve_cart. The cart and all of its entries are fetched at once by
+    joining the entries to the cart, an empty cart yields a single row without
+    entry."""
+    return Cart.objects.filter(user=user).order_by("cartentry__id").values(
+        "id",
+        "item_count",
+        "total_cost",
+        "cartentry__id",
+        "cartentry__product__title",
+        "cartentry__product_count",
+        "cartentry__cost"
+    )
+
+
+def _cart_snapshot(user, rows):
+    """Builds the cart information returned by api_retrieve_cart from the rows
+    of _cart_rows, and returns it along with the ID of the cart"""
+    ctx = {}
+
+    item_count = rows[0]["item_count"]
+    total_cost = rows[0]["total_cost"]
 
-        return JsonResponse(ctx)
+    ctx["overview"] = f"{user.username}'s cart. There are {item_count} items and total cost is {total_cost}"
+    ctx["owner"] = user.username
+    ctx["items"] = item_count
+    ctx["total"] = total_cost
+    ctx["items list"] = [
+        {
+            "id": row["cartentry__id"],
+            "product__title": row["cartentry__product__title"],
+            "product_count": row["cartentry__product_count"],
+            "cost": row["cartentry__cost"]
+        }
+        for row in rows if row["cartentry__id"] is not None
+    ]
+
+    return rows[0]["id"], ctx
+
+
+def _load_cart_snapshot(user):
+    """Builds the cart information returned by api_retrieve_cart, and returns
+    it along with the ID of the cart"""
+    rows = list(_cart_rows(user))
+
+    if not rows:
+        # Users without a cart get one on their first visit
+        Cart.objects.get_or_create(user=user)
+        return _load_cart_snapshot(user)
+
+    return _cart_snapshot(user, rows)
+
+
+async def _aload_cart_snapshot(user):
+    """Asynchronous version of _load_cart_snapshot"""
+    rows = [row async for row in _cart_rows(user)]
+
+    if not rows:
+        # Users without a cart get one on their first visit
+        await Cart.objects.aget_or_create(user=user)
+        return await _aload_cart_snapshot(user)
+
+    return _cart_snapshot(user, rows)
 
 
 @login_required()
@@ -167,7 +529,7 @@ def api_add_to_cart(request, pk):
 
         ctx["form"] = form
         ctx["product"] = current_product.title
-        ctx["available"] = current_product.inventory_count
+        ctx["available"] = current_product.available_count
         ctx["price"] = current_product.price
 
         return render(request, "marketplace/add-to-cart.html", ctx)
@@ -179,7 +541,7 @@ def api_add_to_cart(request, pk):
         try:
             if form.is_valid():
                 # Process data in form.cleaned_data as required
-                if current_product.inventory_count < form.cleaned_data["product_count"]:
+                if current_product.available_count < form.cleaned_data["product_count"]:
                     ctx["success"] = False
                     ctx["message"] = "Cannot add more than the current number of available items."
                 else:
@@ -188,13 +550,18 @@ def api_add_to_cart(request, pk):
                     # Adding necessary information before adding to database
                     new_cart_entry.associated_cart = current_cart
                     new_cart_entry.product = current_product
-                    new_cart_entry.save()
+                    # The items are held for the cart until checkout
+                    new_cart_entry.save(hold=True)
 
                     ctx["success"] = True
             else:
                 ctx["success"] = False
                 ctx["message"] = "Invalid form data!"
-        except (ValidationError, IntegrityError, ProductNotAvailableException):
+        except ProductNotAvailableException:
+            # Other buyers held the last items meanwhile
+            ctx["success"] = False
+            ctx["message"] = "Cannot add more than the current number of available items."
+        except (ValidationError, IntegrityError):
             ctx["success"] = False
             ctx["message"] = "Invalid data or cart entry already exists!"
 
@@ -203,6 +570,76 @@ def api_add_to_cart(request, pk):
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
 
 
+@login_required()
+def api_bulk_add_to_cart(request):
+    """API view to add many products to cart in one request. The request body
+    is a JSON list of {"product_id": ..., "count": ...} objects, and the
+    response holds the outcome of every item of the list, in the same order.
+
+    Supported HTTP methods: POST
+
+    :param request: Current request
+    """
+    HTTP_METHODS_SUPPORTED = ["POST"]
+
+    if request.method == "POST":
+        try:
+            items = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid JSON data.")
+        if not isinstance(items, list) or len(items) > settings.MARKETPLACE_BULK_ADD_MAX_ITEMS:
+            return HttpResponseBadRequest(
+                f"Expected a list of at most {settings.MARKETPLACE_BULK_ADD_MAX_ITEMS} items."
+            )
+
+        ctx = {}
+        results = []
+        product_counts = {}
+
+        for item in items:
+            result = {}
+            results.append(result)
+            try:
+                result["product_id"] = int(item["product_id"])
+                result["count"] = int(item.get("count", 1))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                result["success"] = False
+                result["message"] = "Invalid item data!"
+                continue
+
+            if result["count"] <= 0:
+                result["success"] = False
+                result["message"] = "Must add a valid amount to cart."
+            elif result["product_id"] in product_counts:
+                result["success"] = False
+                result["message"] = "Product is listed more than once."
+            else:
+                product_counts[result["product_id"]] = result["count"]
+
+        current_cart, created = Cart.objects.get_or_create(user=request.user)
+
+        try:
+            outcomes = Cart.add_products(current_cart.id, product_counts, hold=True)
+        except IntegrityError:
+            outcomes = {product_id: "Invalid data or cart entry already exists!" for product_id in product_counts}
+
+        # Items rejected above already have an outcome, and the first listing
+        # of a duplicated product gets the outcome of that product
+        for result in results:
+            if "success" not in result:
+                message = outcomes[result["product_id"]]
+                result["success"] = message is None
+                if message is not None:
+                    result["message"] = message
+
+        ctx["success"] = all(result["success"] for result in results)
+        ctx["results"] = results
+
+        return JsonResponse(ctx)
+    else:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+
+
 @login_required()
 def api_update_cart_entry(request, pk):
     """API view to update a cart entry
@@ -214,12 +651,12 @@ def api_update_cart_entry(request, pk):
     """
     HTTP_METHODS_SUPPORTED = ["HEAD", "GET", "POST"]
 
-    current_cart_entry = get_object_or_404(CartEntry, pk=pk)
+    current_cart_entry = get_object_or_404(CartEntry.objects.select_related("product", "associated_cart"), pk=pk)
     current_product = current_cart_entry.product
 
     ctx = {}
 
-    if request.user != current_cart_entry.associated_cart.user:
+    if request.user.id != current_cart_entry.associated_cart.user_id:
         # An outsider should not manipulate other people's carts
         return HttpResponseForbidden(request)
     if request.method in ["GET", "HEAD"]:
@@ -229,7 +666,8 @@ def api_update_cart_entry(request, pk):
         ctx["form"] = form
         ctx["cart_entry_id"] = current_cart_entry.id
         ctx["product"] = current_product.title
-        ctx["available"] = current_product.inventory_count
+        # The items already held for the entry remain available to it
+        ctx["available"] = current_product.available_count + current_cart_entry.held_count
         ctx["price"] = current_product.price
 
         return render(request, "marketplace/update-cart.html", ctx)
@@ -244,16 +682,21 @@ def api_update_cart_entry(request, pk):
         try:
             if form.is_valid():
                 # Process data in form.cleaned_data as required
-                if current_product.inventory_count < form.cleaned_data["product_count"]:
+                available_count = current_product.available_count + current_cart_entry.held_count
+                if available_count < form.cleaned_data["product_count"]:
                     ctx["success"] = False
                     ctx["message"] = "Cannot add more than the current number of available items."
                 else:
-                    form.save()
+                    # Holds the added items and renews the hold of the others
+                    form.save(commit=False).save(hold=True)
                     ctx["success"] = True
             else:
                 ctx["success"] = False
                 ctx["message"] = "Invalid form data!"
-        except (ValidationError, ProductNotAvailableException):
+        except ProductNotAvailableException:
+            ctx["success"] = False
+            ctx["message"] = "Cannot add more than the current number of available items."
+        except ValidationError:
             ctx["success"] = False
             ctx["message"] = "Invalid form data!"
 
@@ -263,25 +706,39 @@ def api_update_cart_entry(request, pk):
 
 
 @csrf_exempt
+@blocking_view
 def api_checkout_product(request, pk):
     """API view to checkout one product, does not require users to be logged in
     for simplicity. But any constraint can be added later.
 
     Supported HTTP methods: POST
 
+    Supported POST parameters:
+        quantity (int): Number of items to checkout, defaults to 1
+
     :param request: Current request
     :param pk: Product's unique ID
     """
     HTTP_METHODS_SUPPORTED = ["POST"]
 
     if request.method == "POST":
-        current_product = get_object_or_404(Product, pk=pk)
-
         ctx = {}
 
         try:
-            Product.checkout_product(pk=current_product.id)
+            quantity = int(request.POST.get("quantity", 1))
+        except ValueError:
+            quantity = 0
+
+        if quantity <= 0:
+            ctx["success"] = False
+            ctx["message"] = "Must checkout a valid amount of items."
+            return JsonResponse(ctx)
+
+        try:
+            Product.checkout_product(pk=pk, quantity=quantity)
             ctx["success"] = True
+        except Product.DoesNotExist:
+            raise Http404("No Product matches the given query.")
         except ProductNotAvailableException:
             ctx["success"] = False
             ctx["message"] = "Current product is not available!"
@@ -291,6 +748,7 @@ def api_checkout_product(request, pk):
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
 
 
+@blocking_view
 @login_required()
 def api_checkout_cart_entry(request, pk):
     """API view to checkout a cart entry
@@ -303,9 +761,9 @@ def api_checkout_cart_entry(request, pk):
     HTTP_METHODS_SUPPORTED = ["POST"]
 
     if request.method == "POST":
-        current_cart_entry = get_object_or_404(CartEntry, pk=pk)
+        current_cart_entry = get_object_or_404(CartEntry.objects.select_related("associated_cart"), pk=pk)
 
-        if request.user != current_cart_entry.associated_cart.user:
+        if request.user.id != current_cart_entry.associated_cart.user_id:
             return HttpResponseForbidden(request)
         else:
             ctx = {}
@@ -321,9 +779,13 @@ def api_checkout_cart_entry(request, pk):
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
 
 
+@blocking_view
 @login_required()
 def api_checkout_cart(request):
-    """API view to checkout cart
+    """API view to checkout cart. If MARKETPLACE_QUEUED_CHECKOUT is True, or
+    the request has a "Prefer: respond-async" header, the checkout is queued
+    for the process_checkouts workers instead: the response is a 202 with the
+    ID of the checkout job, whose result is reported by api_checkout_job.
 
     Supported HTTP methods: POST
 
@@ -336,6 +798,16 @@ def api_checkout_cart(request):
 
         ctx = {}
 
+        if settings.MARKETPLACE_QUEUED_CHECKOUT or "respond-async" in request.headers.get("Prefer", ""):
+            job = CheckoutJob.enqueue(current_cart.id)
+            ctx["job"] = job.id
+            ctx["status"] = job.status
+            ctx["status url"] = reverse("marketplace:api_checkout_job", args=[job.id])
+
+            response = JsonResponse(ctx, status=202)
+            response["Location"] = ctx["status url"]
+            return response
+
         try:
             Cart.checkout_cart(pk=current_cart.id)
             ctx["success"] = True
@@ -348,14 +820,193 @@ def api_checkout_cart(request):
 
 
 @login_required()
-def update_inventory(request):
-    """API view to update inventory"""
-    HTTP_METHODS_SUPPORTED = ["HEAD", "GET", "POST"]
+def api_checkout_job(request, pk):
+    """Reports the status of a queued checkout of the user's cart. Once the
+    job is done, the response lists the items checked out and the items left
+    in the cart for lack of stock.
+
+    Supported HTTP methods: GET
+
+    :param request: Current request
+    :param pk: Checkout job's ID
+    """
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
+
+    if request.method not in ["GET", "HEAD"]:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+
+    job = get_object_or_404(CheckoutJob.objects.select_related("cart"), pk=pk)
+    if request.user.id != job.cart.user_id:
+        return HttpResponseForbidden("You cannot view the checkout of another user.")
+
+    ctx = {
+        "job": job.id,
+        "status": job.status,
+        "created": job.created_at,
+        "finished": job.finished_at,
+    }
+    if job.status == CheckoutJob.DONE:
+        ctx["success"] = not job.items_left
+        ctx["checked out"] = job.checked_out
+        ctx["items left"] = job.items_left
+    elif job.status == CheckoutJob.FAILED:
+        ctx["success"] = False
+        ctx["error"] = job.error
+
+    return JsonResponse(ctx)
+
+
+@staff_member_required
+def api_query_profile(request):
+    """API view reporting the SQL queries of the latest requests, as profiled
+    by QueryProfilerMiddleware, and the N+1 query candidates found in them.
+    Only available to staff members
+
+    Supported HTTP methods: GET
+    """
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
 
     if request.method in ["GET", "HEAD"]:
-        # TODO: render a template with form to modify inventory
+        ctx = profiler_report()
+        ctx["enabled"] = settings.MARKETPLACE_QUERY_PROFILER
+
+        return JsonResponse(ctx)
+    else:
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
-    elif request.method == "POST":
-        return HttpResponse(request, status=204)
+
+
+def metrics(request):
+    """View exposing the metrics of the marketplace in the Prometheus text
+    format. If the MARKETPLACE_METRICS_TOKEN setting is set, the scraper must
+    send it as a bearer token
+
+    Supported HTTP methods: GET
+    """
+    HTTP_METHODS_SUPPORTED = ["HEAD", "GET"]
+
+    token = settings.MARKETPLACE_METRICS_TOKEN
+    if token and request.META.get("HTTP_AUTHORIZATION") != f"Bearer {token}":
+        return HttpResponseForbidden(request)
+
+    if request.method in ["GET", "HEAD"]:
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+    else:
+        return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+
+
+@staff_member_required
+def update_inventory(request):
+    """API view to update the inventory of many products in one request, e.g.
+    from a warehouse sync. Only available to staff members.
+
+    The request body is a JSON list of rows, or with the
+    application/x-ndjson content type one JSON row per line, streamed rather
+    than read at once. Each row names a product by "product_id" or "title",
+    and either gives a "delta" to add to its stock or an absolute "count",
+    with an optional "expected" count which the stock must still be at. The
+    rows are applied in chunks of MARKETPLACE_INVENTORY_UPDATE_CHUNK_SIZE, each
+    in its own short transaction, see Product.update_inventory. The response
+    holds the outcome of every row, in the same order.
+
+    Supported HTTP methods: POST
+
+    :param request: Current request
+    """
+    HTTP_METHODS_SUPPORTED = ["POST"]
+
+    if request.method == "POST":
+        if request.content_type == "application/x-ndjson":
+            rows = _read_ndjson_rows(request)
+        else:
+            try:
+                rows = json.loads(request.body)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid JSON data.")
+            if not isinstance(rows, list):
+                return HttpResponseBadRequest("Expected a list of rows.")
+
+        ctx = {}
+        results = []
+        seen_products = set()
+        rows = iter(rows)
+
+        while chunk := list(itertools.islice(rows, settings.MARKETPLACE_INVENTORY_UPDATE_CHUNK_SIZE)):
+            parsed_rows = [_parse_inventory_row(row) for row in chunk]
+            results.extend(result for result, _ in parsed_rows)
+
+            # Products named by title are looked up once per chunk
+            titles = {result["title"] for result, update in parsed_rows if update and "title" in result}
+            product_ids = dict(Product.objects.filter(title__in=titles).values_list("title", "id")) if titles else {}
+
+            updates = {}
+            pending = []
+            for result, update in parsed_rows:
+                if update is None:
+                    continue
+                product_id = result.get("product_id", product_ids.get(result.get("title")))
+                if product_id is None:
+                    result["success"] = False
+                    result["message"] = "Product does not exist."
+                elif product_id in seen_products:
+                    result["success"] = False
+                    result["message"] = "Product is listed more than once."
+                else:
+                    seen_products.add(product_id)
+                    updates[product_id] = update
+                    pending.append((product_id, result))
+
+            if updates:
+                outcomes = Product.update_inventory(updates)
+                for product_id, result in pending:
+                    result["inventory_count"], message = outcomes[product_id]
+                    result["success"] = message is None
+                    if message is not None:
+                        result["message"] = message
+
+        ctx["success"] = all(result["success"] for result in results)
+        ctx["updated"] = sum(result["success"] for result in results)
+        ctx["results"] = results
+
+        return JsonResponse(ctx)
     else:
         return HttpResponseNotAllowed(HTTP_METHODS_SUPPORTED)
+
+
+def _read_ndjson_rows(request):
+    """Yields the rows of a streamed NDJSON request body, None for the lines
+    which are not valid JSON"""
+    for line in request:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def _parse_inventory_row(row):
+    """Checks a row of an inventory update.
+
+    :return: The result of the row, holding the product it names, and the
+        (delta, count, expected) update of the row, or None if the row is
+        invalid, in which case the result already holds its outcome
+    """
+    result = {}
+    try:
+        if "product_id" in row:
+            result["product_id"] = int(row["product_id"])
+        else:
+            result["title"] = str(row["title"])
+
+        if "delta" in row and "count" not in row and "expected" not in row:
+            return result, (int(row["delta"]), None, None)
+        if "count" in row and "delta" not in row:
+            count = int(row["count"])
+            expected = int(row["expected"]) if row.get("expected") is not None else None
+            if count >= 0:
+                return result, (None, count, expected)
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    result["success"] = False
+    result["message"] = "Invalid row data!"
+    return result, None
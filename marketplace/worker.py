@@ -0,0 +1,130 @@
+"""Workers draining the queue of checkout jobs.
+
+Each worker polls the CheckoutJob table, claims one queued job at a time and
+checks out its cart with Cart.checkout_cart, see CheckoutJob. Workers run as
+processes by default, each with its own database connection, so the number
+of checkouts processed at once grows with the number of workers instead of
+being bound to the HTTP worker threads. Thread workers are meant for tests
+and in-memory databases.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import warnings
+
+from django.apps import apps
+from django.db import DatabaseError, connection, connections
+
+from .exceptions import ItemLeftInCartWarning
+from .models import CheckoutJob
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(name, poll_interval=0.5, lease_seconds=60, max_attempts=3, drain=False, stop=None):
+    """Processes checkout jobs until stop is set, or if drain is True until
+    no job is queued or running.
+
+    Returns the number of jobs attempted by the worker, whether they were
+    done, failed or queued again
+    """
+    processed = 0
+    last_requeue = float("-inf")
+
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                # Expired leases are only looked for a few times per lease
+                if time.monotonic() - last_requeue >= lease_seconds / 4:
+                    CheckoutJob.requeue_expired(lease_seconds, max_attempts)
+                    last_requeue = time.monotonic()
+                job = CheckoutJob.claim(name)
+            except DatabaseError:
+                # e.g. "database is locked", the queue is polled again later
+                logger.warning("Worker %s could not poll the checkout queue", name, exc_info=True)
+                time.sleep(poll_interval)
+                continue
+
+            if job is None:
+                # Jobs running in other workers may still be queued again
+                if drain and not CheckoutJob.objects.filter(status=CheckoutJob.RUNNING).exists():
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            try:
+                job.process()
+            except CheckoutJob.DoesNotExist:
+                logger.warning("Checkout job %s was taken over by another worker", job.pk)
+            except Exception as error:
+                logger.exception("Checkout job %s failed", job.pk)
+                try:
+                    job.record_failure(error, max_attempts)
+                except DatabaseError:
+                    # The job is queued again once its lease expires
+                    logger.warning("Failure of checkout job %s could not be recorded", job.pk, exc_info=True)
+            processed += 1
+    finally:
+        # Every worker thread opens its own connection
+        connection.close()
+
+    logger.info("Worker %s stopped after %d jobs", name, processed)
+    return processed
+
+
+def _run_process_worker(kwargs):
+    """Entry point of process workers, which may not have set Django up when
+    started with the spawn method"""
+    if not apps.ready:
+        import django
+        django.setup()
+    connections.close_all()
+    warnings.simplefilter("ignore", ItemLeftInCartWarning)
+
+    return run_worker(**kwargs)
+
+
+def run_pool(workers=4, mode="process", poll_interval=0.5, lease_seconds=60, max_attempts=3, drain=False):
+    """Runs a pool of workers until they are interrupted, or if drain is True
+    until no job is queued or running. Process workers need a database shared
+    between processes, i.e. not an in-memory SQLite database.
+
+    Returns the number of jobs attempted by the pool
+    """
+    manager = multiprocessing.Manager() if mode == "process" else None
+    stop = manager.Event() if manager else threading.Event()
+    tasks = [
+        {
+            "name": f"{socket.gethostname()}:{os.getpid()}:{i}",
+            "poll_interval": poll_interval,
+            "lease_seconds": lease_seconds,
+            "max_attempts": max_attempts,
+            "drain": drain,
+            "stop": stop,
+        }
+        for i in range(workers)
+    ]
+
+    try:
+        if mode == "process":
+            # Children must not share the connection of the parent
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_run_process_worker, task) for task in tasks]
+                return sum(future.result() for future in futures)
+        with warnings.catch_warnings(), ThreadPoolExecutor(max_workers=workers) as executor:
+            warnings.simplefilter("ignore", ItemLeftInCartWarning)
+            futures = [executor.submit(lambda task: run_worker(**task), task) for task in tasks]
+            return sum(future.result() for future in futures)
+    except KeyboardInterrupt:
+        # A job interrupted half-way is rolled back, and queued again once
+        # its lease expires
+        stop.set()
+        raise
+    finally:
+        if manager:
+            manager.shutdown()
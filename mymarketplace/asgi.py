@@ -0,0 +1,19 @@
+"""
+ASGI config for mymarketplace project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with any ASGI server, e.g. ``uvicorn mymarketplace.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mymarketplace.settings')
+# The catalog and checkout views are only coroutines under ASGI
+os.environ.setdefault('MARKETPLACE_ASGI', '1')
+
+application = get_asgi_application()
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -41,6 +43,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Disabled unless MARKETPLACE_QUERY_PROFILER is set, see below
+    'marketplace.middleware.QueryProfilerMiddleware',
+    'marketplace.middleware.MetricsMiddleware',
+    'marketplace.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,18 +77,93 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'mymarketplace.wsgi.application'
+ASGI_APPLICATION = 'mymarketplace.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# The database is picked by the MARKETPLACE_DB_PROFILE environment variable,
+# among the profiles below. Add a profile to support another database.
+DATABASE_PROFILES = {
+    # SQLite file tuned for concurrent requests. In WAL mode readers and the
+    # writer do not block each other, and writes are only synced at
+    # checkpoints. Transactions take the write lock as soon as they begin,
+    # waiting up to busy_timeout for it, instead of failing with "database is
+    # locked" when upgrading a read lock held by a concurrent writer. The
+    # pragmas are applied on every new connection, and connections are reused
+    # across requests.
+    'sqlite': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ.get('MARKETPLACE_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+        'CONN_MAX_AGE': int(os.environ.get('MARKETPLACE_DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA busy_timeout=5000;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA mmap_size=268435456;'
+            ),
+        },
+    },
+    # PostgreSQL server, requires psycopg (3) with its pool extra. Connections
+    # are taken from a pool of each process. Set MARKETPLACE_DB_POOL=0 to keep
+    # persistent connections instead, e.g. behind PgBouncer. The connection
+    # parameters not set below are read by libpq from its own environment
+    # variables (PGSSLMODE, PGPASSFILE...)
+    'postgresql': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('MARKETPLACE_DB_NAME', 'mymarketplace'),
+        'USER': os.environ.get('MARKETPLACE_DB_USER', 'mymarketplace'),
+        'PASSWORD': os.environ.get('MARKETPLACE_DB_PASSWORD', ''),
+        'HOST': os.environ.get('MARKETPLACE_DB_HOST', 'localhost'),
+        'PORT': os.environ.get('MARKETPLACE_DB_PORT', '5432'),
+        'CONN_HEALTH_CHECKS': True,
+    },
+}
+
+if os.environ.get('MARKETPLACE_DB_POOL', '1') == '1':
+    # Pooled connections are returned to the pool at the end of every request
+    DATABASE_PROFILES['postgresql']['CONN_MAX_AGE'] = 0
+    DATABASE_PROFILES['postgresql']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.environ.get('MARKETPLACE_DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ.get('MARKETPLACE_DB_POOL_MAX_SIZE', 20)),
+            'timeout': 10,
+        },
     }
+else:
+    DATABASE_PROFILES['postgresql']['CONN_MAX_AGE'] = int(os.environ.get('MARKETPLACE_DB_CONN_MAX_AGE', 600))
+
+MARKETPLACE_DB_PROFILE = os.environ.get('MARKETPLACE_DB_PROFILE', 'sqlite')
+if MARKETPLACE_DB_PROFILE not in DATABASE_PROFILES:
+    raise ImproperlyConfigured(
+        f"Unknown MARKETPLACE_DB_PROFILE {MARKETPLACE_DB_PROFILE!r}, use one of {', '.join(DATABASE_PROFILES)}."
+    )
+
+DATABASES = {
+    'default': DATABASE_PROFILES[MARKETPLACE_DB_PROFILE],
 }
 
+# Read replicas of the default database, used by the catalog reads, see
+# marketplace/routers.py. MARKETPLACE_DB_REPLICAS is a comma-separated list of
+# database files with the sqlite profile (kept up to date by the sync_replica
+# command), or of replica hosts with the postgresql profile. Tests read the
+# replicas from the test database.
+MARKETPLACE_READ_REPLICAS = []
+for index, replica in enumerate(filter(None, os.environ.get('MARKETPLACE_DB_REPLICAS', '').split(','))):
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        ('NAME' if MARKETPLACE_DB_PROFILE == 'sqlite' else 'HOST'): replica.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    MARKETPLACE_READ_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['marketplace.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -104,10 +185,48 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Hashers of passwords, by name. MARKETPLACE_PASSWORD_HASHER picks the one
+# hashing new passwords: "pbkdf2", or the memory-hard "scrypt" or "argon2"
+# (which needs the argon2-cffi package). Passwords hashed by another hasher
+# are still accepted, and hashed again with the chosen one when their user
+# logs in
+PASSWORD_HASHER_PROFILES = {
+    'pbkdf2': 'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'scrypt': 'django.contrib.auth.hashers.ScryptPasswordHasher',
+    'argon2': 'django.contrib.auth.hashers.Argon2PasswordHasher',
+}
+
+MARKETPLACE_PASSWORD_HASHER = os.environ.get('MARKETPLACE_PASSWORD_HASHER', 'pbkdf2')
+if MARKETPLACE_PASSWORD_HASHER not in PASSWORD_HASHER_PROFILES:
+    raise ImproperlyConfigured(
+        f"Unknown MARKETPLACE_PASSWORD_HASHER {MARKETPLACE_PASSWORD_HASHER!r}, "
+        f"use one of {', '.join(PASSWORD_HASHER_PROFILES)}."
+    )
+
+PASSWORD_HASHERS = [PASSWORD_HASHER_PROFILES[MARKETPLACE_PASSWORD_HASHER]] + [
+    hasher for name, hasher in PASSWORD_HASHER_PROFILES.items() if name != MARKETPLACE_PASSWORD_HASHER
+] + [
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+# Passwords are checked by a pool of processes, see marketplace/auth.py. The
+# sessions logged in by ModelBackend before are moved to it by a migration
 AUTHENTICATION_BACKENDS = [
-    'django.contrib.auth.backends.ModelBackend',
+    'marketplace.auth.PooledModelBackend',
 ]
 
+# Number of processes of the pool checking passwords, in each process serving
+# the site. Hashing is slow on purpose, the pool bounds the cores it takes
+# during a storm of logins and leaves the others to the rest of the site. Set
+# it to 0 to check passwords in the thread serving the request. Every web
+# worker starts its own pool, so half the cores are shared by the number of
+# web workers given by WEB_CONCURRENCY (as read by gunicorn)
+MARKETPLACE_PASSWORD_WORKERS = int(os.environ.get(
+    'MARKETPLACE_PASSWORD_WORKERS',
+    max(1, (os.cpu_count() or 1) // 2 // max(1, int(os.environ.get('WEB_CONCURRENCY', 1))))
+))
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'marketplace:index'
 LOGOUT_REDIRECT_URL = 'marketplace:index'
@@ -131,4 +250,95 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
-TEST_RUNNER = "django_nose.NoseTestSuiteRunner"
+TEST_RUNNER = "django.test.runner.DiscoverRunner"
+
+
+# Marketplace
+
+# Backend of the product search index: "fts5" (SQLite FTS5 table), "memory"
+# (in-process index) or "auto" to use FTS5 whenever it is available
+MARKETPLACE_SEARCH_BACKEND = os.environ.get("MARKETPLACE_SEARCH_BACKEND", "auto")
+
+# Maximum number of products matched by a search sorted by relevance through
+# the in-memory index, the most relevant ones being kept. Each of them takes a
+# clause of the ORDER BY sent to the database
+MARKETPLACE_SEARCH_MAX_RESULTS = 500
+
+# Default and maximum number of products per page of the product listing
+MARKETPLACE_PRODUCTS_PAGE_SIZE = 100
+MARKETPLACE_PRODUCTS_PAGE_MAX = 1000
+
+# Number of rows fetched at a time when streaming the product listing
+MARKETPLACE_EXPORT_CHUNK_SIZE = 2000
+
+# Cache of API responses. Any Django cache backend can be plugged in, e.g.
+# Redis or Memcached in production
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'marketplace',
+    }
+}
+
+MARKETPLACE_CACHE_ALIAS = 'default'
+
+# Number of seconds the details of a product are cached for
+MARKETPLACE_PRODUCT_CACHE_TIMEOUT = 300
+
+# Number of seconds the snapshot of a cart is cached for
+MARKETPLACE_CART_CACHE_TIMEOUT = 300
+
+# Maximum number of products added to cart by a single bulk request
+MARKETPLACE_BULK_ADD_MAX_ITEMS = 500
+
+# Number of rows of an inventory update applied by each transaction. Every
+# row takes 3 query parameters, SQLite allows 999 per query by default
+MARKETPLACE_INVENTORY_UPDATE_CHUNK_SIZE = 300
+
+# Number of seconds the items added to a cart are held for it. Expired holds
+# are released by the release_expired_holds command
+MARKETPLACE_CART_HOLD_SECONDS = 900
+
+# Queue every checkout of a whole cart for the process_checkouts workers,
+# instead of only those of requests with a "Prefer: respond-async" header
+MARKETPLACE_QUEUED_CHECKOUT = os.environ.get("MARKETPLACE_QUEUED_CHECKOUT", "") == "1"
+
+# Profile the SQL queries of every request, see marketplace/middleware.py. The
+# totals are sent in Server-Timing headers and the latest requests are
+# reported to staff members at /marketplace/api/debug/queries
+MARKETPLACE_QUERY_PROFILER = os.environ.get("MARKETPLACE_QUERY_PROFILER", "") == "1"
+
+# Number of times a query must be repeated in a request to be reported as an
+# N+1 query candidate
+MARKETPLACE_QUERY_PROFILER_THRESHOLD = 3
+
+# Number of requests kept in the report of the query profiler
+MARKETPLACE_QUERY_PROFILER_HISTORY = 200
+
+# Record the metrics exposed at /metrics, see marketplace/metrics.py
+MARKETPLACE_METRICS = True
+
+# Directory shared by the worker processes of the site, where each process
+# writes its metrics so that /metrics can add them up. Leave it unset when the
+# site runs in a single process. It must be emptied whenever the site is
+# deployed
+MARKETPLACE_METRICS_DIR = os.environ.get("MARKETPLACE_METRICS_DIR")
+
+# Minimum number of seconds between two writes of the metrics of a process
+MARKETPLACE_METRICS_FLUSH_INTERVAL = 1.0
+
+# Bearer token the scraper of /metrics must send, if set
+MARKETPLACE_METRICS_TOKEN = os.environ.get("MARKETPLACE_METRICS_TOKEN")
+
+# Whether the site is served through ASGI, set by mymarketplace/asgi.py. The
+# catalog views are then asynchronous, and the checkout views coroutines
+# bounding the blocking views, see below
+MARKETPLACE_ASGI = os.environ.get("MARKETPLACE_ASGI", "") == "1"
+
+# Maximum number of blocking views (the checkout views) running at once per
+# ASGI event loop. Each of them holds a thread and a database connection
+MARKETPLACE_BLOCKING_VIEWS_CONCURRENCY = 32
+
+# Number of seconds a client reads from the primary database after writing to
+# it, instead of from the read replicas which may not have its writes yet
+MARKETPLACE_REPLICA_STICKY_SECONDS = 5
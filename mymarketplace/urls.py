@@ -20,7 +20,7 @@ from django.views.generic import RedirectView
 from django.contrib.auth import views as auth_views
 
 # from marketplace.forms import CustomUserCreationForm
-from marketplace.views import register
+from marketplace.views import metrics, register
 
 urlpatterns = [
     path('', RedirectView.as_view(pattern_name='marketplace:index'), name='index'),
@@ -36,5 +36,6 @@ urlpatterns = [
     path('register', register, name='register'),
     path('logout', auth_views.LogoutView.as_view(), name='logout'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
     path('marketplace/', include('marketplace.urls'))
 ]